@@ -0,0 +1,282 @@
+'''
+Microbenchmarks of the hot paths with synthetic data:
+
+    converter   N2CoolingConverter.interpret_data (update_arrays and the message) for n_values and batch sizes
+    encoding    wire format encode / decode, publish over ZMQ, simple_enc of the converter messages
+    storage     TableWriter append + flush throughput for batch sizes and compression filters
+    bronkhorst  ProPar request encoding, answer decoding and parsing, read_status over a canned port
+
+Every case reports the min. and median time per call of --repeat runs. Results are written as JSON
+(with python and package versions) so runs of different releases can be compared:
+
+    python benchmarks/micro.py --output micro.json
+    python benchmarks/micro.py --only storage --compare micro.json
+'''
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import tempfile
+import statistics
+import numpy as np
+
+from n2_cooling.channels import ChannelRegistry
+
+# records of cooling.py with the default channels (Cooling.temp_type)
+CHANNELS = ChannelRegistry()
+RECORD_TYPE = CHANNELS.dtype
+
+
+def records(n, start=1.6e9):
+    ''' n records of cooling.py with plausible values, 0.5 s apart '''
+    rows = np.zeros(n, dtype=RECORD_TYPE)
+    rows['timestamp'] = start + 0.5 * np.arange(n)
+    rows['temperature_box'] = -20. + np.random.normal(0., 0.1, n)
+    rows['temperature_dut'] = -18. + np.random.normal(0., 0.1, n)
+    rows['humidity_dut'] = 5. + np.random.normal(0., 0.5, n)
+    rows['valve'] = 40. + np.random.normal(0., 1., n)
+    rows['flow_in_l_min'] = 10. + np.random.normal(0., 0.1, n)
+    rows['flow_counter_in_l'] = np.cumsum(np.full(n, 0.08))
+    return rows
+
+
+def measure(function, repeat, number=None, min_time=0.2):
+    '''
+    Time per call of function in s (min. and median of repeat runs). The calls per run are chosen
+    so that one run takes about min_time, unless number is given.
+    '''
+    if number is None:
+        number, duration = 1, 0.
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                function()
+            duration = time.perf_counter() - start
+            if duration >= min_time or number >= 1e6:
+                break
+            number *= 2 if duration <= 0 else max(2, min(int(min_time / duration) + 1, 10))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    return {'min': min(times), 'median': statistics.median(times), 'number': number}
+
+
+def converter_cases(repeat):
+    from n2_cooling.online_monitor.n2_cooling_converter import N2CoolingConverter
+
+    results = {}
+    for n_values in (500, 5000, 50000):
+        for batch in (1, 100):
+            for incremental in (True, False):
+                # only the interpretation is measured, the sockets of the transceiver are not needed
+                converter = N2CoolingConverter.__new__(N2CoolingConverter)
+                converter.config = {'n_values': n_values, 'incremental': incremental}
+                converter.setup_interpretation()
+                converter.raw_data = queue.Queue()  # empty, messages waiting for interpretation are merged
+                data = records(n_values + 100 * batch)
+                meta_data = dict(json.loads(CHANNELS.wire), name='CoolingData')
+                converter.set_channels(data, meta_data)
+                converter.update_arrays(data[:n_values])  # full buffers
+                converter.send_snapshot = False
+                state = {'pos': n_values}
+
+                def interpret():
+                    pos = state['pos'] = state['pos'] + batch if state['pos'] + 2 * batch <= len(data) else n_values
+                    converter.interpret_data([('cooling', (data[pos:pos + batch], meta_data))])
+
+                name = 'interpret_data n_values=%d batch=%d %s' % (n_values, batch, 'delta' if incremental else 'snapshot')
+                results[name] = measure(interpret, repeat)
+    return results
+
+
+def encoding_cases(repeat):
+    import zmq
+    from online_monitor.utils import utils
+    from n2_cooling import wire
+    from n2_cooling.cooling import send_data
+
+    results = {}
+    context = zmq.Context()
+    publisher = context.socket(zmq.PUB)
+    publisher.bind('inproc://micro')
+    subscriber = context.socket(zmq.SUB)
+    subscriber.setsockopt(zmq.SUBSCRIBE, b'')
+    subscriber.connect('inproc://micro')
+    time.sleep(0.2)  # subscription has to arrive
+
+    for batch in (1, 100):
+        data = records(batch)
+        frames = [wire.encode_header('CoolingData', data.dtype, CHANNELS.wire), data.tobytes()]
+        results['wire encode_header batch=%d' % batch] = measure(lambda: wire.encode_header('CoolingData', data.dtype, CHANNELS.wire), repeat)
+        results['wire decode batch=%d' % batch] = measure(lambda: wire.decode(frames), repeat)
+
+        def publish():
+            send_data(publisher, data, 'CoolingData', channels=CHANNELS.wire)
+            wire.decode(subscriber.recv_multipart(copy=False))
+
+        results['send_data + receive batch=%d' % batch] = measure(publish, repeat)
+
+    # messages of the converter to the receivers
+    for n_values in (500, 5000):
+        message = {'type': 'snapshot', 'channels': json.loads(CHANNELS.wire), 'time': np.arange(n_values, dtype=np.float64),
+                   'values': np.zeros((len(CHANNELS), n_values))}
+        encoded = utils.simple_enc(None, message)
+        results['simple_enc snapshot n_values=%d' % n_values] = measure(lambda: utils.simple_enc(None, message), repeat)
+        results['simple_dec snapshot n_values=%d' % n_values] = measure(lambda: utils.simple_dec(encoded), repeat)
+
+    subscriber.close()
+    publisher.close()
+    context.term()
+    return results
+
+
+def storage_cases(repeat, rows=20000):
+    import tables as tb
+    from n2_cooling.storage import TableWriter
+
+    filters = {
+        'none': tb.Filters(complevel=0),
+        'blosc5': tb.Filters(complevel=5, complib='blosc'),
+        'zlib5': tb.Filters(complevel=5, complib='zlib'),
+    }
+    data = records(rows)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for filter_name, filter in filters.items():
+            for batch_size in (1, 64, 1024):
+                times = []
+                for i in range(repeat):
+                    filename = os.path.join(directory, '%s_%d_%d.h5' % (filter_name, batch_size, i))
+                    writer = TableWriter(filename, RECORD_TYPE, batch_size=batch_size, filters=filter,
+                                         index_columns=('timestamp',))
+                    n = rows // 10 if batch_size == 1 else rows  # one flush per row is slow
+                    start = time.perf_counter()
+                    for row in data[:n]:
+                        writer.append(row)
+                    writer.flush()
+                    times.append((time.perf_counter() - start) / n)
+                    writer.close()
+                results['TableWriter append+flush %s batch_size=%d' % (filter_name, batch_size)] = {
+                    'min': min(times), 'median': statistics.median(times), 'number': n,
+                    'rows_per_s': 1. / min(times), 'file_size': os.path.getsize(filename)}
+    return results
+
+
+class CannedPort(object):
+    ''' Serial port which answers every request with the same line '''
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.timeout = None
+        self.in_waiting = 0
+
+    def write(self, data):
+        return len(data)
+
+    def read_until(self, terminator):
+        return self.answer
+
+
+def bronkhorst_cases(repeat):
+    from n2_cooling.bronkhorst import Bronkhorst
+    from n2_cooling.simulator.plant import ThermalModel
+    from n2_cooling.simulator.devices import VirtualBronkhorst
+
+    bronkhorst = Bronkhorst(CannedPort(None))
+    device = VirtualBronkhorst(ThermalModel())
+
+    def answer(names):
+        # answer of the simulated flow controller to the chained request of names, in the order of the driver
+        names = sorted(names, key=lambda name: Bronkhorst.PARAMETERS[name][0])
+        request = bronkhorst.request_message(names)
+        return names, device._answer(bytes.fromhex(request.decode().strip()[1:])[3:])
+
+    names, full_answer = answer(['valve', 'measure', 'counter_value', 'capacity', 'capacity_unit'])
+    _, dynamic_answer = answer(['valve', 'measure', 'counter_value'])
+    device.stop()
+    _, payload = bronkhorst._decode(full_answer)
+
+    results = {
+        'request_message read_status': measure(lambda: bronkhorst.request_message(names), repeat),
+        'decode answer': measure(lambda: bronkhorst._decode(full_answer), repeat),
+        'parse_answer read_status': measure(lambda: bronkhorst.parse_answer(names, payload), repeat),
+    }
+
+    def read_status():
+        bronkhorst.clear_cache()  # capacity and unit are requested every time
+        return bronkhorst.read_status()
+
+    bronkhorst.port.answer = full_answer
+    results['read_status canned port'] = measure(read_status, repeat)
+    bronkhorst.port.answer = dynamic_answer
+    results['read_status canned port, cached static'] = measure(bronkhorst.read_status, repeat)
+    return results
+
+
+CASES = {
+    'converter': converter_cases,
+    'encoding': encoding_cases,
+    'storage': storage_cases,
+    'bronkhorst': bronkhorst_cases,
+}
+
+
+def versions():
+    import importlib
+
+    result = {'python': sys.version.split()[0]}
+    for module in ('n2_cooling', 'numpy', 'tables', 'zmq', 'online_monitor'):
+        try:
+            result[module] = getattr(importlib.import_module(module), '__version__', None)
+        except ImportError:
+            result[module] = None
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Microbenchmarks of converter, encoding, storage and flow controller protocol',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--only', nargs='+', choices=list(CASES), default=list(CASES),
+                        help="Run only these groups")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Runs per case")
+    parser.add_argument('--output', type=str, default=None,
+                        help="Write results as JSON to this file")
+    parser.add_argument('--compare', type=str, default=None,
+                        help="JSON file of an earlier run, print the ratio to it")
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    reference = {}
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)['results']
+
+    results = {'versions': versions(), 'results': {}}
+    for group in args.only:
+        try:
+            results['results'][group] = CASES[group](args.repeat)
+        except ImportError as e:
+            print('%s skipped: %s' % (group, e))
+            continue
+        for name, result in results['results'][group].items():
+            line = '%-11s %-55s %10.2f us' % (group, name, result['min'] * 1e6)
+            old = reference.get(group, {}).get(name)
+            if old:
+                line += '   x%.2f' % (result['min'] / old['min'])
+            print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+'''
+Startup time of the n2_cooling modules and command line tools.
+
+Every measurement runs in a fresh interpreter (min. and median of --repeat runs). Also reports which
+heavy dependencies an import pulls in and the slowest imports from python -X importtime.
+
+    python benchmarks/startup.py --output startup.json
+'''
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+MODULES = ['n2_cooling', 'n2_cooling.cooling', 'n2_cooling.manager', 'n2_cooling.replay', 'n2_cooling.simulator']
+COMMANDS = {
+    'n2cooling --help': ['-m', 'n2_cooling.cooling', '--help'],
+    'n2cooling-manager --help': ['-m', 'n2_cooling.manager', '--help'],
+    'n2cooling-replay --help': ['-m', 'n2_cooling.replay', '--help'],
+    'n2cooling-benchmark --help': ['-m', 'n2_cooling.simulator.benchmark', '--help'],
+}
+HEAVY = ['numpy', 'tables', 'zmq', 'online_monitor', 'simple_pid', 'serial', 'yaml']
+
+
+def run_python(args):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    duration = time.perf_counter() - start
+    if result.returncode:
+        raise RuntimeError('%s failed:\n%s' % (' '.join(args), result.stderr))
+    return duration, result
+
+
+def timing(args, repeat):
+    durations = [run_python(args)[0] for _ in range(repeat)]
+    return {'min': min(durations), 'median': statistics.median(durations)}
+
+
+def heavy_imports(module):
+    ''' Heavy dependencies loaded by importing module '''
+    code = 'import sys, %s; print(" ".join(m for m in %r if m in sys.modules))' % (module, HEAVY)
+    return run_python(['-c', code])[1].stdout.split()
+
+
+def slowest_imports(module, n=10):
+    ''' Largest cumulative import times in s from python -X importtime '''
+    times = []
+    for line in run_python(['-X', 'importtime', '-c', 'import %s' % module])[1].stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times.append((int(cumulative) * 1e-6, name.strip()))
+    return [{'module': name, 'cumulative': cumulative} for cumulative, name in sorted(times, reverse=True)[:n]]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Import and command line startup times',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Fresh interpreters per measurement")
+    parser.add_argument('--output', type=str, default=None,
+                        help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {
+        'python': sys.version.split()[0],
+        'interpreter': timing(['-c', 'pass'], args.repeat),
+        'imports': {},
+        'commands': {},
+    }
+    for module in MODULES:
+        results['imports'][module] = timing(['-c', 'import %s' % module], args.repeat)
+        results['imports'][module]['heavy'] = heavy_imports(module)
+        print('import %-22s %7.1f ms   loads: %s' % (module, results['imports'][module]['min'] * 1e3,
+                                                   ' '.join(results['imports'][module]['heavy']) or '-'))
+    for name, command in COMMANDS.items():
+        results['commands'][name] = timing(command, args.repeat)
+        print('%-29s %7.1f ms' % (name, results['commands'][name]['min'] * 1e3))
+    results['slowest_imports'] = slowest_imports('n2_cooling.cooling')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import os
+import csv
+import logging
+import argparse
+import concurrent.futures
+import numpy as np
+
+from datetime import datetime
+
+
+def dewpoint(temperature, humidity):
+    ''' Dew point in C with the Magnus formula, works on scalars and arrays (humidity in %) '''
+    b, c = 17.67, 243.5
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gamma = np.log(np.asarray(humidity) / 100.) + b * temperature / (c + temperature)
+        return c * gamma / (b - gamma)
+
+
+def read_chunks(filename, chunk_size=100000, table_name='temperature', t_min=None, t_max=None):
+    '''
+    Yield the rows of the table of a measurement file in chunks, never the whole table at once.
+    Only rows with t_min <= timestamp < t_max if given (found with the timestamp index).
+    A run catalog (*.catalog.json) is read as one file, only its segments in the time range are opened.
+    '''
+    import tables as tb
+    from n2_cooling.storage import time_range_rows
+    from n2_cooling.segments import is_catalog, SegmentReader
+
+    if is_catalog(filename):
+        for rows in SegmentReader(filename).read_chunks(chunk_size, t_min, t_max):
+            yield rows
+        return
+    with tb.open_file(filename, 'r') as in_file:
+        table = in_file.get_node(in_file.root, table_name)
+        start, stop = time_range_rows(table, t_min, t_max)
+        for chunk_start in range(start, stop, chunk_size):
+            yield table.read(chunk_start, min(chunk_start + chunk_size, stop))
+
+
+def final_temperature(filename, tail=300., chunk_size=100000, table_name='temperature', t_max=None):
+    ''' Mean DUT temperature of the last tail seconds before t_max (at most chunk_size rows are read) '''
+    import tables as tb
+    from n2_cooling.storage import time_range_rows
+    from n2_cooling.segments import is_catalog, SegmentReader
+
+    if is_catalog(filename):
+        rows = SegmentReader(filename).tail(tail, t_max=t_max)
+    else:
+        with tb.open_file(filename, 'r') as in_file:
+            table = in_file.get_node(in_file.root, table_name)
+            _, stop = time_range_rows(table, None, t_max)
+            rows = table.read(max(stop - chunk_size, 0), stop)
+    if not len(rows):
+        return np.nan
+    timestamps = rows['timestamp'].astype(np.float64)
+    return float(np.nanmean(rows['temperature_dut'][timestamps >= timestamps[-1] - tail]))
+
+
+def analyze_file(filename, setpoint=None, tolerance=0.5, tail=300., chunk_size=100000, table_name='temperature',
+                 t_min=None, t_max=None):
+    '''
+    Summary of one measurement file, computed chunk by chunk:
+    duration, DUT temperature range, dew point and min. distance of the DUT temperature to it,
+    settling time into setpoint +- tolerance, overshoot beyond the setpoint and N2 consumption.
+    Without setpoint the mean DUT temperature of the last tail seconds is taken.
+    With t_min / t_max only this time range is analyzed.
+    '''
+    if setpoint is None:
+        setpoint = final_temperature(filename, tail=tail, chunk_size=chunk_size, table_name=table_name, t_max=t_max)
+
+    n_rows = 0
+    t_start = t_end = first_temperature = np.nan
+    temperature_min, temperature_max, t_sum, t_count = np.inf, -np.inf, 0., 0
+    dp_max, margin_min = -np.inf, np.inf
+    last_outside = None  # time of the last sample outside of the setpoint band
+    after_outside = None  # time of the sample following it
+    consumption, last_counter = 0., np.nan
+    flow_sum, flow_count = 0., 0
+
+    for rows in read_chunks(filename, chunk_size=chunk_size, table_name=table_name, t_min=t_min, t_max=t_max):
+        if not len(rows):
+            continue
+        timestamps = rows['timestamp'].astype(np.float64)
+        temperature = rows['temperature_dut'].astype(np.float64)
+        humidity = rows['humidity_dut'].astype(np.float64)
+        if not n_rows:
+            t_start, first_temperature = timestamps[0], temperature[0]
+        n_rows += len(rows)
+        t_end = timestamps[-1]
+
+        finite = np.isfinite(temperature)
+        if finite.any():
+            temperature_min = min(temperature_min, temperature[finite].min())
+            temperature_max = max(temperature_max, temperature[finite].max())
+            t_sum += temperature[finite].sum()
+            t_count += np.count_nonzero(finite)
+
+        dew = dewpoint(temperature, humidity)
+        valid = np.isfinite(dew) & finite
+        if valid.any():
+            dp_max = max(dp_max, dew[valid].max())
+            margin_min = min(margin_min, (temperature[valid] - dew[valid]).min())
+
+        # settled after the last sample outside of the band
+        if after_outside is None and last_outside is not None:
+            after_outside = timestamps[0]
+        outside = np.nonzero(np.abs(temperature - setpoint) > tolerance)[0]
+        if len(outside):
+            last_outside = timestamps[outside[-1]]
+            after_outside = timestamps[outside[-1] + 1] if outside[-1] + 1 < len(timestamps) else None
+
+        # counter of the flow controller, increments are summed so resets of the counter do not matter
+        counter = rows['flow_counter_in_l'].astype(np.float64)
+        counter = counter[np.isfinite(counter)]
+        if len(counter):
+            increments = np.diff(np.concatenate(([last_counter], counter)) if np.isfinite(last_counter) else counter)
+            consumption += increments[increments > 0].sum()
+            last_counter = counter[-1]
+
+        flow = rows['flow_in_l_min'].astype(np.float64)
+        flow_sum += np.nansum(flow)
+        flow_count += np.count_nonzero(np.isfinite(flow))
+
+    if last_outside is None:
+        settling_time = 0. if n_rows else np.nan
+    elif after_outside is None:
+        settling_time = np.nan  # never settled
+    else:
+        settling_time = after_outside - t_start
+
+    # for cooling the overshoot is below the setpoint, for warming up above
+    if first_temperature >= setpoint:
+        overshoot = max(setpoint - temperature_min, 0.)
+    else:
+        overshoot = max(temperature_max - setpoint, 0.)
+
+    return {
+        'file': os.path.basename(filename),
+        'rows': n_rows,
+        'duration': t_end - t_start,
+        'setpoint': setpoint,
+        'temperature_min': temperature_min if t_count else np.nan,
+        'temperature_max': temperature_max if t_count else np.nan,
+        'temperature_mean': t_sum / t_count if t_count else np.nan,
+        'dewpoint_max': dp_max if np.isfinite(dp_max) else np.nan,
+        'dewpoint_margin': margin_min if np.isfinite(margin_min) else np.nan,
+        'settling_time': settling_time,
+        'overshoot': overshoot if t_count else np.nan,
+        'n2_consumption': consumption,
+        'flow_mean': flow_sum / flow_count if flow_count else np.nan,
+    }
+
+
+def analyze(files, jobs=None, **kwargs):
+    ''' Analyze files in parallel with a process pool (in order of files), failed files are logged and skipped '''
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(analyze_file, filename, **kwargs) for filename in files]
+        for filename, future in zip(files, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.error('Cannot analyze %s: %s', filename, e)
+    return results
+
+
+# column name, header, format
+COLUMNS = [
+    ('file', 'File', '%s'),
+    ('rows', 'Rows', '%d'),
+    ('duration', 'Duration/h', '%.2f'),
+    ('setpoint', 'Setp./C', '%.1f'),
+    ('temperature_min', 'Tmin/C', '%.2f'),
+    ('temperature_mean', 'Tmean/C', '%.2f'),
+    ('dewpoint_max', 'DPmax/C', '%.1f'),
+    ('dewpoint_margin', 'T-DP/C', '%.1f'),
+    ('settling_time', 'Settl./min', '%.1f'),
+    ('overshoot', 'Oversh./C', '%.2f'),
+    ('n2_consumption', 'N2/l', '%.1f'),
+    ('flow_mean', 'Flow/l/min', '%.2f'),
+]
+SCALE = {'duration': 1 / 3600., 'settling_time': 1 / 60.}
+
+
+def format_table(results):
+    ''' Aligned summary table, one line per file '''
+    cells = [[header for _, header, _ in COLUMNS]]
+    for result in results:
+        cells.append([fmt % (result[name] * SCALE.get(name, 1)) if name != 'file' else fmt % result[name]
+                      for name, _, fmt in COLUMNS])
+    widths = [max(len(row[i]) for row in cells) for i in range(len(COLUMNS))]
+    return '\n'.join('  '.join(cell.rjust(width) if i else cell.ljust(width) for i, (cell, width) in enumerate(zip(row, widths)))
+                     for row in cells)
+
+
+def parse_time(value):
+    ''' Unix time from a number or a local ISO date / time string, None stays None '''
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Summary of measurement files: dew point, settling time, overshoot and N2 consumption',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('files', nargs='+',
+                        help="Measurement files (measurement_*.h5) or run catalogs (*.catalog.json)")
+    parser.add_argument('--setpoint', type=float, default=None,
+                        help="Target temperature in Celsius (default: mean of the last --tail seconds)")
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="Temperature band around setpoint for settling time in C")
+    parser.add_argument('--tail', type=float, default=300.,
+                        help="Time span at the end of a run to estimate the setpoint in s")
+    parser.add_argument('--start', type=str, default=None,
+                        help="Analyze only from this time on (Unix time or ISO format, e.g. 2021-05-12T14:00)")
+    parser.add_argument('--end', type=str, default=None,
+                        help="Analyze only until this time (Unix time or ISO format)")
+    parser.add_argument('--chunk-size', type=int, default=100000,
+                        help="Rows read at once from a file")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="Number of files analyzed in parallel (default: number of CPUs)")
+    parser.add_argument('--csv', type=str, default=None,
+                        help="Also write the summary to this CSV file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s [%(name)-15s] - %(levelname)-7s %(message)s')
+    results = analyze(args.files, jobs=args.jobs, setpoint=args.setpoint, tolerance=args.tolerance,
+                      tail=args.tail, chunk_size=args.chunk_size, t_min=parse_time(args.start), t_max=parse_time(args.end))
+    print(format_table(results))
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=[name for name, _, _ in COLUMNS])
+            writer.writeheader()
+            for result in results:
+                writer.writerow(dict((name, result[name]) for name, _, _ in COLUMNS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import time
+import logging
+import threading
+import numpy as np
+
+
+class Arduino(object):
+    '''
+    Readout of the Arduino with NTC and SHT sensor. Every "R" sent is answered by one line of
+    n_values numbers, "tempNTC tempSHT humidSHT" with the default firmware (more with further NTC pins,
+    see channels.py).
+
+    In streaming mode a reader thread requests the next sample as soon as the previous one arrived
+    and stores it in a timestamped ring buffer, so the controller can take the newest sample without
+    waiting for the sensor. With a read timeout on the port, a request which is not answered in time
+    is counted as stall and sent again.
+    '''
+
+    def __init__(self, port, buffer_size=1000, n_values=3):
+        self.log = logging.getLogger('Arduino')
+        self.port = port
+        self.n_values = n_values
+        self.sample_type = np.dtype([('timestamp', 'f8'), ('values', 'f4', (n_values,))])
+        self.buffer = np.zeros(buffer_size, dtype=self.sample_type)
+        self.n_samples = 0  # total number of samples received, buffer index is n_samples % buffer_size
+        self.n_stalls = 0  # requests without answer within the read timeout of the port
+        self._lock = threading.Lock()
+        self._new_sample = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def parse(self, line):
+        ''' Returns the first n_values numbers of one line of the Arduino, ValueError if there are less '''
+        values = line.decode('utf-8').split()
+        if len(values) < self.n_values:
+            raise ValueError('Expected %d values, got %r' % (self.n_values, line))
+        return tuple(float(value) for value in values[:self.n_values])
+
+    def read(self):
+        ''' Request one sample and block until it is received (IOError after the read timeout of the port) '''
+        self.port.reset_input_buffer()  # no late answer of an earlier request
+        self.port.write(b'R')
+        line = self.port.readline()
+        if not line:
+            raise IOError('No answer from the Arduino')
+        return self.parse(line)
+
+    def wait_ready(self, timeout=10.):
+        '''
+        Request samples until the Arduino answers, the Nano resets when the port is opened and ignores
+        requests while booting. The port needs a read timeout. Returns True if an answer was received.
+        '''
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                self.read()
+                return True
+            except (IOError, ValueError, UnicodeDecodeError):  # still booting or boot loader output
+                self.log.debug('Waiting for the Arduino to boot')
+        return False
+
+    @property
+    def streaming(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.streaming:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._stream, name='ArduinoReader', daemon=True)
+        self._thread.start()
+        self.log.info('Started streaming sensor readout')
+
+    def stop(self, timeout=2.):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _stream(self):
+        while not self._stop.is_set():
+            try:
+                self.port.write(b'R')
+                line = self.port.readline()
+            except Exception as e:
+                self.log.error('Serial error in sensor readout: %s', e)
+                self._stop.wait(1.)
+                continue
+            if not line:  # read timeout, request again
+                self.n_stalls += 1
+                self.log.warning('No answer from the Arduino within %s s (%d stalls)', self.port.timeout, self.n_stalls)
+                continue
+            try:
+                values = self.parse(line)
+            except (ValueError, IndexError, UnicodeDecodeError):
+                self.log.debug('Cannot parse sensor line %r', line)
+                continue
+            self._append((time.time(), values))
+
+    def _append(self, sample):
+        with self._new_sample:
+            self.buffer[self.n_samples % len(self.buffer)] = sample
+            self.n_samples += 1
+            self._new_sample.notify_all()
+
+    def latest(self, timeout=None):
+        '''
+        Newest sample as structured array element. Only blocks (up to timeout) if no sample
+        was received yet; returns None if there is still none.
+        '''
+        with self._new_sample:
+            if self.n_samples == 0:
+                self._new_sample.wait_for(lambda: self.n_samples > 0, timeout)
+            if self.n_samples == 0:
+                return None
+            return self.buffer[(self.n_samples - 1) % len(self.buffer)].copy()
+
+    def wait_for_sample(self, n_samples, timeout=None):
+        ''' Block until more than n_samples samples were received; returns True on success '''
+        with self._new_sample:
+            return self._new_sample.wait_for(lambda: self.n_samples > n_samples, timeout)
+
+    def samples(self, n=None):
+        ''' The last n samples (all buffered if None) in chronological order '''
+        with self._lock:
+            n_buffered = min(self.n_samples, len(self.buffer))
+            n = n_buffered if n is None else min(n, n_buffered)
+            indices = np.arange(self.n_samples - n, self.n_samples) % len(self.buffer)
+            return self.buffer[indices]
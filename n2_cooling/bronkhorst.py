@@ -0,0 +1,255 @@
+import time
+import struct
+import logging
+
+from n2_cooling.metrics import Metrics
+
+
+class ProParError(IOError):
+    pass
+
+
+class ProParTimeout(ProParError):
+    pass
+
+
+class Bronkhorst(object):
+    '''
+    Minimal driver for the ProPar ASCII protocol of the Bronkhorst flow controller.
+
+    Several parameters can be requested in one chained message, so a control cycle needs a single
+    round trip on the serial bus. Static parameters (capacity, capacity unit) are only read once.
+
+    Every transaction waits at most timeout seconds for the answer, which has to come from the
+    addressed node and match the command and parameters of the request. Bytes left over from earlier
+    answers are dropped before a request is sent. A failed transaction is repeated up to retries times
+    with exponential backoff, timeouts and invalid answers are counted in the metrics.
+    '''
+
+    # name: (process, parameter byte (type | number), struct format of the value)
+    PARAMETERS = {
+        'measure': (0x01, 0x20, '>H'),
+        'setpoint': (0x01, 0x21, '>H'),
+        'control_mode': (0x01, 0x04, '>B'),
+        'capacity': (0x01, 0x4D, '>f'),
+        'capacity_unit': (0x01, 0x7F, '7s'),
+        'counter_value': (0x68, 0x41, '>f'),
+        'valve': (0x72, 0x41, '>I'),
+        'counter_mode': (0x73, 0x08, '>B'),
+    }
+    STATIC_PARAMETERS = ('capacity', 'capacity_unit')
+
+    # parameter types encoded in bits 5 and 6 of the parameter byte
+    TYPE_CHAR, TYPE_INT, TYPE_LONG, TYPE_STRING = 0x00, 0x20, 0x40, 0x60
+
+    # commands
+    STATUS, SEND, SEND_NO_REPLY, REQUEST = 0x00, 0x01, 0x02, 0x04
+
+    # ticks of the valve output at 100% opening
+    VALVE_SCALE = 5.96368684979e-6
+    # measure and setpoint are given in 1/32000 of the capacity
+    FULL_SCALE = 32000.
+
+    def __init__(self, port, node=0x80, metrics=None, timeout=0.5, retries=3, backoff=0.05, max_backoff=0.5):
+        self.log = logging.getLogger('Bronkhorst')
+        self.port = port
+        self.node = node
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.timeout = timeout  # max. time for one answer (s)
+        self.retries = retries
+        self.backoff = backoff  # wait before the first retry, doubled for every further one (s)
+        self.max_backoff = max_backoff
+        self._static = {}
+
+    def _encode(self, command, payload):
+        message = bytes([len(payload) + 2, self.node, command]) + bytes(payload)
+        return b':' + message.hex().upper().encode() + b'\r\n'
+
+    def _decode(self, line):
+        try:
+            line = line.decode().strip()
+            if not line.startswith(':'):
+                raise ValueError()
+            message = bytes.fromhex(line[1:])
+        except ValueError:
+            raise ProParError('Invalid answer %r' % line)
+        if len(message) < 3 or message[0] != len(message) - 1:
+            raise ProParError('Answer %r has wrong length' % line)
+        if message[1] != self.node:
+            raise ProParError('Answer from node 0x%02X instead of 0x%02X' % (message[1], self.node))
+        return message[2], message[3:]
+
+    def _readline(self, deadline):
+        ''' One answer line, raises ProParTimeout if it is not complete at deadline (monotonic time) '''
+        line = b''
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ProParTimeout('No answer within %.2f s%s' % (self.timeout, ' (got %r)' % line if line else ''))
+            self.port.timeout = remaining
+            line += self.port.read_until(b'\n')
+            if line.endswith(b'\n'):
+                return line
+
+    def _resync(self):
+        ''' Drop late or duplicated answers of earlier requests, they would be taken as answer to the next one '''
+        if self.port.in_waiting:
+            self.port.reset_input_buffer()
+            self.metrics.count('bronkhorst_resync')
+
+    def _transaction(self, message, stage, parse):
+        '''
+        Send message and return parse(command, payload) of the answer. parse raises ProParError if
+        the answer does not belong to the request, then the request is repeated after a backoff.
+        '''
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.metrics.count('bronkhorst_retries')
+                time.sleep(delay)
+                delay = min(2 * delay, self.max_backoff)
+            self._resync()
+            try:
+                with self.metrics.timer(stage):
+                    self.port.write(message)
+                    return parse(*self._decode(self._readline(time.monotonic() + self.timeout)))
+            except ProParTimeout as e:
+                self.metrics.count('bronkhorst_timeouts')
+                error = e
+            except ProParError as e:
+                self.metrics.count('bronkhorst_invalid')
+                error = e
+            self.log.warning('%s (attempt %d of %d)', error, attempt + 1, self.retries + 1)
+        self.metrics.count('bronkhorst_failed')
+        raise error
+
+    def _check_status(self, command, payload):
+        if command != self.STATUS or len(payload) < 1:
+            raise ProParError('Expected status answer, got command 0x%02X' % command)
+        if payload[0] != 0:
+            raise ProParError('Status error 0x%02X at byte %d' % (payload[0], payload[1] if len(payload) > 1 else 0))
+
+    def request_message(self, names):
+        ''' Build one chained request for all parameters in names '''
+        groups = []
+        for name in names:
+            process, parameter, fmt = self.PARAMETERS[name]
+            if groups and groups[-1][0] == process:
+                groups[-1][1].append((parameter, fmt))
+            else:
+                groups.append((process, [(parameter, fmt)]))
+        payload = []
+        for i, (process, parameters) in enumerate(groups):
+            payload.append(process | (0x80 if i < len(groups) - 1 else 0))
+            for j, (parameter, fmt) in enumerate(parameters):
+                payload += [parameter | (0x80 if j < len(parameters) - 1 else 0), process, parameter]
+                if parameter & 0x60 == self.TYPE_STRING:
+                    payload.append(struct.calcsize(fmt))
+        return self._encode(self.REQUEST, payload)
+
+    def parse_answer(self, names, payload):
+        '''
+        Unpack the values of a chained answer in the order of names. Raises ProParError if process
+        and parameter of the answer do not match the request.
+        '''
+        values = {}
+        names = list(names)
+        n = 0
+        pos = 0
+        process_chained = True
+        try:
+            while process_chained:
+                process_chained = payload[pos] & 0x80
+                process = payload[pos] & 0x7F
+                pos += 1
+                parameter_chained = True
+                while parameter_chained:
+                    parameter_chained = payload[pos] & 0x80
+                    if n == len(names):
+                        raise ProParError('Answer has more parameters than requested')
+                    name = names[n]
+                    n += 1
+                    expected_process, expected_parameter, fmt = self.PARAMETERS[name]
+                    if process != expected_process or payload[pos] & 0x7F != expected_parameter:
+                        raise ProParError('Answer for process %d parameter 0x%02X, requested %s' % (process, payload[pos] & 0x7F, name))
+                    pos += 1
+                    if payload[pos - 1] & 0x60 == self.TYPE_STRING:
+                        size = payload[pos] or struct.calcsize(fmt)
+                        pos += 1
+                        values[name] = payload[pos:pos + size].split(b'\x00')[0].decode().strip()
+                    else:
+                        size = struct.calcsize(fmt)
+                        values[name] = struct.unpack(fmt, payload[pos:pos + size])[0]
+                    pos += size
+        except (IndexError, struct.error, UnicodeDecodeError):
+            raise ProParError('Answer too short or invalid for %s' % ', '.join(names))
+        if n != len(names) or pos > len(payload):
+            raise ProParError('Answer does not contain all of %s' % ', '.join(names))
+        return values
+
+    def read(self, *names):
+        '''
+        Read all given parameters in one chained request. Static parameters are taken from cache
+        after the first read. Returns dict of parameter name and raw value.
+        '''
+        values = dict((name, self._static[name]) for name in names if name in self._static)
+        missing = [name for name in names if name not in values]
+        if missing:
+            # group parameters of the same process, the answer is sorted the same way
+            missing.sort(key=lambda name: self.PARAMETERS[name][0])
+
+            def parse(command, payload):
+                if command == self.STATUS:
+                    self._check_status(command, payload)
+                if command != self.SEND_NO_REPLY:
+                    raise ProParError('Expected parameter answer, got command 0x%02X' % command)
+                return self.parse_answer(missing, payload)
+
+            answer = self._transaction(self.request_message(missing), 'bronkhorst_read', parse)
+            for name in self.STATIC_PARAMETERS:
+                if name in answer:
+                    self._static[name] = answer[name]
+            values.update(answer)
+        return values
+
+    def write(self, name, value):
+        ''' Write a parameter and wait for the status answer '''
+        process, parameter, fmt = self.PARAMETERS[name]
+        payload = bytes([process, parameter]) + struct.pack(fmt, value)
+        self._transaction(self._encode(self.SEND, payload), 'bronkhorst_write', self._check_status)
+
+    def clear_cache(self):
+        self._static = {}
+
+    @property
+    def capacity(self):
+        return self.read('capacity')['capacity']
+
+    @property
+    def capacity_unit(self):
+        return self.read('capacity_unit')['capacity_unit']
+
+    def reset_counter(self):
+        # counter mode 1 resets the counter
+        self.write('counter_mode', 1)
+
+    def set_valve(self, value):
+        ''' Set the valve opening in 1/32000 when in valve steering mode '''
+        self.write('setpoint', int(value))
+
+    def get_valve(self):
+        ''' Valve opening in % '''
+        return round(self.read('valve')['valve'] * self.VALVE_SCALE, 3)
+
+    def read_status(self):
+        '''
+        All values the control loop needs in one transaction: valve opening in %, flow in capacity unit
+        and flow counter.
+        '''
+        values = self.read('valve', 'measure', 'counter_value', 'capacity', 'capacity_unit')
+        return {
+            'valve': round(values['valve'] * self.VALVE_SCALE, 3),
+            'flow': values['measure'] / self.FULL_SCALE * values['capacity'],
+            'counter': values['counter_value'],
+            'unit': values['capacity_unit'],
+        }
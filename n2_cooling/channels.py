@@ -0,0 +1,148 @@
+'''
+Channels of the cooling records, defined in the channels section of cooling.yaml (or of a chamber):
+
+    channels:
+      - {name: temperature_box, source: arduino, index: 0, kind: temperature, label: Box temperature with dry ice}
+      - {name: temperature_ntc2, source: arduino, index: 3, kind: temperature, label: NTC at A1}
+      - {name: valve, source: bronkhorst, field: valve, kind: valve}
+
+source arduino takes the value at index of the line of the Arduino, source bronkhorst the field of
+Bronkhorst.read_status (valve, flow or counter). Unit, tolerance of the compression and plot of the online
+monitor follow from kind if not given. From the channels the table dtype, the text file columns, the wire
+header (channel names, kinds, units, labels) and the buffers and curves of the online monitor are built.
+'''
+import json
+import numpy as np
+
+# unit, compression tolerance and plot of the online monitor (None: not plotted) per kind
+KINDS = {
+    'temperature': ('C', 0.1, 'temperature'),
+    'humidity': ('%', 0.5, 'percent'),
+    'valve': ('%', 1.0, 'percent'),
+    'flow': ('l/min', 0.1, None),
+    'counter': ('l', 1.0, None),
+}
+
+DEFAULT_CHANNELS = [
+    {'name': 'temperature_box', 'source': 'arduino', 'index': 0, 'kind': 'temperature',
+     'label': 'Box temperature with dry ice', 'header': 'TEMP NTC in Celsius', 'color': [0, 181, 97]},
+    {'name': 'temperature_dut', 'source': 'arduino', 'index': 1, 'kind': 'temperature',
+     'label': 'Sensor temperature close to DUT', 'header': 'TEMP SHT in Celsius', 'color': [181, 0, 15]},
+    {'name': 'humidity_dut', 'source': 'arduino', 'index': 2, 'kind': 'humidity',
+     'label': 'Sensor humidity close to DUT', 'header': 'HUMIDITY in %', 'color': [181, 0, 15]},
+    {'name': 'valve', 'source': 'bronkhorst', 'field': 'valve', 'kind': 'valve',
+     'label': 'Valve steering', 'header': 'Valve Output in %', 'color': [0, 0, 255]},
+    {'name': 'flow_in_l_min', 'source': 'bronkhorst', 'field': 'flow', 'kind': 'flow',
+     'label': 'N2 flow', 'header': 'flow in l/min'},
+    {'name': 'flow_counter_in_l', 'source': 'bronkhorst', 'field': 'counter', 'kind': 'counter',
+     'label': 'N2 consumption', 'header': 'flow counter in l'},
+]
+
+
+class ChannelRegistry(object):
+    '''
+    Channels of a cooling box (list of dicts, see module docstring). control is the channel the PID
+    controls, dewpoint the temperature and humidity channel the dew point is calculated from.
+    '''
+
+    def __init__(self, channels=None, control='temperature_dut', dewpoint=('temperature_dut', 'humidity_dut')):
+        self.channels = []
+        for channel in channels or DEFAULT_CHANNELS:
+            channel = dict(channel)
+            if channel.get('source') not in ('arduino', 'bronkhorst'):
+                raise ValueError('Channel %s: source has to be arduino or bronkhorst' % channel.get('name'))
+            if channel['source'] == 'arduino' and 'index' not in channel:
+                raise ValueError('Channel %s: index of the value in the Arduino line missing' % channel['name'])
+            unit, tolerance, plot = KINDS.get(channel.get('kind'), ('', None, None))
+            channel.setdefault('unit', unit)
+            channel.setdefault('tolerance', tolerance)
+            channel.setdefault('plot', plot)
+            channel.setdefault('label', channel['name'])
+            channel.setdefault('header', '%s in %s' % (channel['name'], channel['unit']))
+            self.channels.append(channel)
+        self.names = [channel['name'] for channel in self.channels]
+        if len(set(self.names)) != len(self.names) or 'timestamp' in self.names:
+            raise ValueError('Channel names have to be unique and not timestamp')
+        if control not in self.names or self.channels[self.names.index(control)]['source'] != 'arduino':
+            raise ValueError('Control channel %s has to be an Arduino channel' % control)
+        self.control = control
+        self.dewpoint = tuple(dewpoint) if dewpoint and all(name in self.names for name in dewpoint) else None
+
+        # positions in the record of the values taken from the Arduino line and from the flow controller
+        self.arduino_positions = np.array([i for i, channel in enumerate(self.channels) if channel['source'] == 'arduino'], dtype=int)
+        self.arduino_indices = np.array([channel['index'] for channel in self.channels if channel['source'] == 'arduino'], dtype=int)
+        self.n_arduino_values = int(self.arduino_indices.max()) + 1 if len(self.arduino_indices) else 0
+        self.status_fields = [(i, channel['field']) for i, channel in enumerate(self.channels) if channel['source'] == 'bronkhorst']
+        self.control_index = int(self[control]['index'])  # value of the Arduino line the PID controls
+
+        self.dtype = np.dtype([('timestamp', 'f8')] + [(name, 'f4') for name in self.names])
+        self._wire = json.dumps({
+            'channels': [dict((key, channel[key]) for key in ('name', 'kind', 'unit', 'label', 'plot', 'color') if key in channel)
+                         for channel in self.channels],
+            'control': self.control,
+            'dewpoint': self.dewpoint,
+        })
+
+    @classmethod
+    def from_config(cls, config, chamber=None):
+        ''' Channels of a chamber of cooling.yaml (dict), the chamber section overrides the top level one '''
+        section = chamber if chamber is not None and 'channels' in chamber else config
+        kwargs = dict((key, section[key]) for key in ('control', 'dewpoint') if key in section)
+        return cls(section.get('channels'), **kwargs)
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __getitem__(self, name):
+        return self.channels[self.names.index(name)]
+
+    def of_kind(self, *kinds):
+        return [channel['name'] for channel in self.channels if channel.get('kind') in kinds]
+
+    @property
+    def text_columns(self):
+        ''' (column, header) pairs of the text file '''
+        return [(channel['name'], channel['header']) for channel in self.channels] + [('timestamp', 'Time')]
+
+    @property
+    def tolerances(self):
+        ''' Compression tolerance of every channel which has one '''
+        return dict((channel['name'], channel['tolerance']) for channel in self.channels if channel['tolerance'] is not None)
+
+    @property
+    def wire(self):
+        ''' Description for the wire header (JSON string, hashable so the header is encoded once) '''
+        return self._wire
+
+    def record(self, timestamp, values, status):
+        '''
+        One record (structured array scalar) from the values of the Arduino line and the
+        status of the flow controller (dict, see Bronkhorst.read_status); missing values are NaN.
+        '''
+        row = np.full(len(self.channels), np.nan)
+        values = np.asarray(values, dtype=np.float64)
+        available = self.arduino_indices < len(values)
+        row[self.arduino_positions[available]] = values[self.arduino_indices[available]]
+        for position, field in self.status_fields:
+            row[position] = status.get(field, np.nan)
+        return np.array((timestamp,) + tuple(row), dtype=self.dtype)
+
+
+def describe(names):
+    '''
+    Wire description of records without one (older publishers): kinds of known names from the
+    default channels, other columns are shown as they are.
+    '''
+    defaults = dict((channel['name'], channel) for channel in ChannelRegistry().channels)
+    channels = []
+    for name in names:
+        if name == 'timestamp':
+            continue
+        channel = defaults.get(name, {'name': name, 'kind': None, 'unit': '', 'label': name, 'plot': None})
+        channels.append(dict((key, channel[key]) for key in ('name', 'kind', 'unit', 'label', 'plot', 'color') if key in channel))
+    present = set(channel['name'] for channel in channels)
+    return {
+        'channels': channels,
+        'control': 'temperature_dut' if 'temperature_dut' in present else None,
+        'dewpoint': ('temperature_dut', 'humidity_dut') if {'temperature_dut', 'humidity_dut'} <= present else None,
+    }
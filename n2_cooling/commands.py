@@ -0,0 +1,128 @@
+'''
+Command channel of a running cooling: JSON requests on a ZMQ REP socket next to the data socket.
+
+    {"cmd": "setpoint", "value": -25.}                       new setpoint from the next cycle on
+    {"cmd": "ramp", "value": -30., "rate": 0.5}               linear ramp to value with rate in C/min
+    {"cmd": "profile", "points": [[0, -20], [600, -30]]}      setpoints at seconds from now, interpolated
+    {"cmd": "pause"} / {"cmd": "resume"}                      hold the valve output / continue control
+    {"cmd": "status"}                                         setpoint, last values, state of the loop
+
+Every request is answered with {"ok": true, ...} or {"ok": false, "error": "..."}.
+'''
+import json
+import logging
+import argparse
+import threading
+
+
+class CommandServer(object):
+    ''' Answers requests on a REP socket in a thread, handler(command dict) returns the reply dict '''
+
+    def __init__(self, address, handler, context=None):
+        import zmq
+
+        self.log = logging.getLogger('CommandServer')
+        self.address = address
+        self.handler = handler
+        self.context = context or zmq.Context.instance()
+        self.socket = self.context.socket(zmq.REP)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        try:
+            self.socket.bind(address)
+        except zmq.error.ZMQError:
+            self.socket.close()
+            raise
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, name='CommandServer', daemon=True)
+        self._thread.start()
+        self.log.info('Accepting commands at %s', address)
+
+    def _serve(self):
+        import zmq
+
+        while not self._stop.is_set():
+            if not self.socket.poll(100):
+                continue
+            try:
+                command = self.socket.recv_json()
+            except ValueError:
+                self.socket.send_json({'ok': False, 'error': 'Command is not valid JSON'})
+                continue
+            try:
+                reply = self.handler(command)
+            except Exception as e:
+                self.log.warning('Command %s failed: %s', command, e)
+                reply = {'ok': False, 'error': str(e)}
+            try:
+                self.socket.send_json(reply)
+            except (TypeError, ValueError) as e:
+                self.socket.send_json({'ok': False, 'error': 'Cannot encode reply: %s' % e})
+            except zmq.ZMQError as e:
+                self.log.warning('Cannot send reply: %s', e)
+        self.socket.close()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def send_command(address, command, timeout=2.):
+    ''' Send one command (dict) and return the reply, raises IOError if there is no answer within timeout s '''
+    import zmq
+
+    socket = zmq.Context.instance().socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(address)
+    try:
+        socket.send_json(command)
+        if not socket.poll(int(timeout * 1000)):
+            raise IOError('No answer from %s' % address)
+        return socket.recv_json()
+    finally:
+        socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Change setpoint, ramp, profile or pause of a running cooling',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog='examples:\n'
+               '  n2cooling-command setpoint -25\n'
+               '  n2cooling-command ramp -30 --rate 0.5\n'
+               '  n2cooling-command profile "[[0, -20], [3600, -30], [7200, -30], [9000, 20]]"\n'
+               '  n2cooling-command pause\n'
+               '  n2cooling-command status'
+    )
+    parser.add_argument('cmd', choices=['setpoint', 'ramp', 'profile', 'pause', 'resume', 'status'],
+                        help="Command")
+    parser.add_argument('value', nargs='?', default=None,
+                        help="Setpoint in Celsius, for profile the points as JSON list [[s, C], ...]")
+    parser.add_argument('--rate', type=float, default=1.,
+                        help="Ramp rate in C/min")
+    parser.add_argument('--address', type=str, default="tcp://127.0.0.1:5001",
+                        help="Command address of the cooling")
+    parser.add_argument('--timeout', type=float, default=2.,
+                        help="Time to wait for the answer in s")
+    args = parser.parse_args()
+
+    command = {'cmd': args.cmd}
+    if args.cmd in ('setpoint', 'ramp', 'profile') and args.value is None:
+        parser.error('%s needs a value' % args.cmd)
+    if args.cmd == 'profile':
+        command['points'] = json.loads(args.value)
+    elif args.value is not None:
+        command['value'] = float(args.value)
+    if args.cmd == 'ramp':
+        command['rate'] = args.rate
+
+    try:
+        reply = send_command(args.address, command, timeout=args.timeout)
+    except IOError as e:
+        parser.exit(1, '%s\n' % e)
+    print(json.dumps(reply, indent=2))
+    if not reply.get('ok'):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
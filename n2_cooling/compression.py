@@ -0,0 +1,116 @@
+import numpy as np
+
+# Tolerances of the columns of the temperature table for long-term logging (C, %, l/min, l)
+DEFAULT_TOLERANCES = {
+    'temperature_box': 0.1,
+    'temperature_dut': 0.1,
+    'humidity_dut': 0.5,
+    'valve': 1.0,
+    'flow_in_l_min': 0.1,
+    'flow_counter_in_l': 1.0,
+}
+
+
+class Compressor(object):
+    '''
+    Drops rows which can be reconstructed from the kept ones within a tolerance per column.
+
+    mode 'swinging_door': linear interpolation between kept rows deviates at most by the tolerance
+    from every dropped value (swinging door trending, the door pivots are shared by all columns).
+    mode 'deadband': a row is kept if a column moved more than its tolerance since the last kept
+    row, holding the last kept value deviates at most by the tolerance.
+
+    Turning points which differ from the last kept row by more than the tolerance are always kept,
+    so minima and maxima are stored exactly, and a row is kept at least every max_interval seconds.
+    Columns without tolerance are stored but do not decide which rows are kept.
+    '''
+
+    def __init__(self, tolerances=DEFAULT_TOLERANCES, mode='swinging_door', max_interval=60., time_column='timestamp'):
+        if mode not in ('swinging_door', 'deadband'):
+            raise ValueError('Unknown compression mode %s' % mode)
+        self.columns = list(tolerances)
+        self.tolerance = np.array([tolerances[column] for column in self.columns], dtype=np.float64)
+        self.mode = mode
+        self.max_interval = max_interval
+        self.time_column = time_column
+        self.n_in = 0  # rows added
+        self.n_out = 0  # rows kept
+        self.reset()
+
+    def reset(self):
+        self.archived = None  # (time, values) of the last kept row
+        self.held = None  # (row, time, values) of the last row, kept if the next one does not fit
+        self._before_held = None  # values of the row before the held one
+        self._slope_upper = np.full(len(self.columns), -np.inf)
+        self._slope_lower = np.full(len(self.columns), np.inf)
+
+    @property
+    def ratio(self):
+        ''' Rows added per row kept '''
+        return self.n_in / self.n_out if self.n_out else np.nan
+
+    def _values(self, row):
+        return np.array([row[column] for column in self.columns], dtype=np.float64)
+
+    def _keep(self, row, time, values):
+        self.archived = (time, values)
+        self.held, self._before_held = None, None
+        self._slope_upper.fill(-np.inf)
+        self._slope_lower.fill(np.inf)
+        self.n_out += 1
+        return row
+
+    def _slopes(self, time, values):
+        ''' Door slopes including the row at time, None if the row does not fit '''
+        archived_time, archived_values = self.archived
+        nan = np.isnan(values) | np.isnan(archived_values)
+        if np.any(np.isnan(values) != np.isnan(archived_values)):
+            return None  # channel appeared or disappeared
+        if self.mode == 'deadband':
+            if np.any((np.abs(values - archived_values) > self.tolerance)[~nan]):
+                return None
+            return self._slope_upper, self._slope_lower
+        dt = time - archived_time
+        if dt <= 0:
+            return None
+        # doors of half width: a line within all of them deviates at most by half the tolerance, the kept
+        # row is at most half the tolerance away from that line, so interpolation stays within the tolerance
+        with np.errstate(invalid='ignore'):
+            upper = np.fmax(self._slope_upper, (values - archived_values - self.tolerance / 2.) / dt)
+            lower = np.fmin(self._slope_lower, (values - archived_values + self.tolerance / 2.) / dt)
+        if np.any((upper > lower)[~nan]):
+            return None
+        return upper, lower
+
+    def _turning_point(self, values):
+        ''' Held row is a minimum or maximum of a column and away from the last kept row '''
+        if self._before_held is None:
+            return False
+        held_values = self.held[2]
+        with np.errstate(invalid='ignore'):
+            turning = (held_values - self._before_held) * (values - held_values) < 0
+            significant = np.abs(held_values - self.archived[1]) > self.tolerance
+        return bool(np.any(turning & significant))
+
+    def add(self, row):
+        ''' Add one row (record or dict like), returns the list of rows to write (0 to 2 rows) '''
+        self.n_in += 1
+        time, values = float(row[self.time_column]), self._values(row)
+        kept = []
+        if self.held is not None and (self._turning_point(values) or self._slopes(time, values) is None):
+            kept.append(self._keep(*self.held))
+
+        slopes = self._slopes(time, values) if self.archived is not None else None
+        if slopes is None or time - self.archived[0] >= self.max_interval:
+            kept.append(self._keep(row, time, values))
+        else:
+            self._slope_upper, self._slope_lower = slopes
+            self._before_held = self.held[2] if self.held is not None else self.archived[1]
+            self.held = (row, time, values)
+        return kept
+
+    def flush(self):
+        ''' Rows still held back (the last added row if it was not kept yet) '''
+        if self.held is None:
+            return []
+        return [self._keep(*self.held)]
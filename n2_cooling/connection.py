@@ -0,0 +1,72 @@
+import logging
+import threading
+
+
+class Connection(object):
+    '''
+    Serial connections to the Arduino and the Bronkhorst flow controller of one cooling box.
+    A port is opened when its device is used the first time, so creating the connection (and the
+    Cooling owning it) needs neither hardware nor pyserial. Ports can also be pyserial URLs.
+    The Arduino port is read with a timeout and only used once the board answers after its reset.
+    '''
+
+    def __init__(self, arduino_port="/dev/ttyUSB0", bronkhorst_port="/dev/ttyUSB1",
+                 arduino_baudrate=115200, bronkhorst_baudrate=38400, metrics=None, arduino_values=3,
+                 arduino_timeout=2., arduino_boot_timeout=10.):
+        self.log = logging.getLogger('Connection')
+        self.arduino_port = arduino_port
+        self.bronkhorst_port = bronkhorst_port
+        self.arduino_baudrate = arduino_baudrate
+        self.bronkhorst_baudrate = bronkhorst_baudrate
+        self.metrics = metrics
+        self.arduino_values = arduino_values  # numbers per line of the Arduino
+        self.arduino_timeout = arduino_timeout  # read timeout of the Arduino port, longer than one answer (s)
+        self.arduino_boot_timeout = arduino_boot_timeout  # max. time for the reset after opening the port (s)
+        self._arduino = None
+        self._bronkhorst = None
+        self._lock = threading.Lock()  # devices are first used from the I/O worker threads
+
+    def _open(self, port, baudrate, timeout=None):
+        import serial
+        self.log.info('Opening %s', port)
+        return serial.serial_for_url(port, baudrate=baudrate, timeout=timeout)
+
+    @property
+    def arduino(self):
+        if self._arduino is None:
+            with self._lock:
+                if self._arduino is None:
+                    from n2_cooling.arduino import Arduino
+                    arduino = Arduino(self._open(self.arduino_port, self.arduino_baudrate, self.arduino_timeout),
+                                      n_values=self.arduino_values)
+                    # opening the port resets the Nano, requests are lost until the sketch runs
+                    if not arduino.wait_ready(self.arduino_boot_timeout):
+                        arduino.port.close()
+                        raise IOError('No answer from the Arduino on %s within %.0f s' % (self.arduino_port, self.arduino_boot_timeout))
+                    self._arduino = arduino
+        return self._arduino
+
+    @property
+    def bronkhorst(self):
+        if self._bronkhorst is None:
+            with self._lock:
+                if self._bronkhorst is None:
+                    from n2_cooling.bronkhorst import Bronkhorst
+                    self._bronkhorst = Bronkhorst(self._open(self.bronkhorst_port, self.bronkhorst_baudrate),
+                                                  metrics=self.metrics)
+        return self._bronkhorst
+
+    @property
+    def is_open(self):
+        return self._arduino is not None or self._bronkhorst is not None
+
+    def close(self):
+        ''' Stop the sensor readout and close the ports which were opened '''
+        with self._lock:
+            if self._arduino is not None:
+                self._arduino.stop()
+                self._arduino.port.close()
+                self._arduino = None
+            if self._bronkhorst is not None:
+                self._bronkhorst.port.close()
+                self._bronkhorst = None
@@ -1,59 +1,68 @@
+import os
 import time
-import zmq
 import logging
-import numpy as np
-import tables as tb
-import struct
 import argparse
+import threading
+import numpy as np
 
-from simple_pid import PID
-
-from online_monitor.utils import utils
-import serial
-from simple_pid import PID
+from n2_cooling import wire
+from n2_cooling.channels import ChannelRegistry
+from n2_cooling.connection import Connection
+from n2_cooling.scheduler import IOScheduler, CycleTimer
+from n2_cooling.metrics import Metrics
 from datetime import datetime
 from datetime import date
 
-
-# we will use the following ports and baudrate
-ser_arduino = serial.Serial(port="/dev/ttyUSB0", baudrate=115200)
-ser_bronk = serial.Serial(port="/dev/ttyUSB1", baudrate=38400)
+# zmq, tables, pyserial and simple_pid are imported where they are used,
+# importing this module (e.g. for n2cooling --help) opens nothing and stays fast
 
 FORMAT = '%(asctime)s [%(name)-15s] - %(levelname)-7s %(message)s'
-logging.basicConfig(level=logging.INFO, format=FORMAT)
 
-today = str(date.today())
-now = datetime.now()
 
-current_time = now.strftime("%H:%M:%S")
+def send_data(socket, data, name="CoolingData", sequence=None, channels=None):
+    '''
+    Publish one record or an array of records (structured array, see wire.py), False if dropped.
+    channels is the description of the channels (ChannelRegistry.wire) sent in the header.
+    '''
+    return wire.send_records(socket, data, name=name, sequence=sequence, channels=channels)
 
 
-def send_data(socket, data, name="CoolingData"):
-    data_meta_data = dict(
-        name=name,
-        dtype=str(data.dtype),
-        shape=data.shape,
-        timestamp=time.time()
-    )
-
-    try:
-        data_ser = utils.simple_enc(data, meta=data_meta_data)
-        socket.send(data_ser, flags=zmq.NOBLOCK)
-    except zmq.Again:
-        pass
+def send_metrics(socket, metrics, name="CoolingMetrics"):
+    ''' Publish the summary of the loop metrics (no records, everything in the header) '''
+    return wire.send_meta(socket, name, metrics=metrics, timestamp=time.time())
 
 
 class Cooling(object):
-    def __init__(self, conf_file="../cooling.yaml", monitor=True):
+    def __init__(self, conf_file="../cooling.yaml", monitor=True, streaming=True,
+                 arduino_port="/dev/ttyUSB0", bronkhorst_port="/dev/ttyUSB1",
+                 metrics_interval=10., metrics_file=None, chamber=None, pid_parameters=None,
+                 socket=None, socket_lock=None, compression=None, command_address=None, period=0.5, channels=None,
+                 run=None, rotation=None):
+        # Name of the cooling box if several are run from one process (see manager.py)
+        self.chamber = chamber
+        self.data_name = "CoolingData" if chamber is None else "CoolingData." + chamber
+        self.metrics_name = "CoolingMetrics" if chamber is None else "CoolingMetrics." + chamber
+
+        # Name of the measurement files, a run with a given name is continued when restarted
+        self.run = run
+        self.output_name = run or 'measurement_' + ('' if chamber is None else chamber + '_') + str(date.today()) + datetime.now().strftime("%H:%M:%S")
+
+        if os.path.dirname(self.output_name):
+            os.makedirs(os.path.dirname(self.output_name), exist_ok=True)
+
         # Setup logging
-        self.log = logging.getLogger('N2 Cooling')
-        fh = logging.FileHandler('cooling_2021-05-12_2e15.log')
+        self.log = logging.getLogger('N2 Cooling' if chamber is None else 'N2 Cooling.' + chamber)
+        fh = logging.FileHandler(self.output_name + '.log')
         fh.setLevel(logging.INFO)
         fh.setFormatter(logging.Formatter(FORMAT))
         self.log.addHandler(fh)
     
-        # Setup online monitor
-        if monitor:
+        # Setup online monitor, the socket can be shared between chambers (sending guarded by socket_lock)
+        self.socket_lock = socket_lock if socket_lock is not None else threading.Lock()
+        if socket is not None:
+            self.socket = socket
+        elif monitor:
+            import zmq
             try:
                 context = zmq.Context()
                 self.socket = context.socket(zmq.PUB)
@@ -65,28 +74,108 @@ class Cooling(object):
         else:
             self.socket = None
 
+        # Gains and output limits of the PID controlling the valve, with model and feed_forward (n2cooling-tune)
+        # the valve starts at the opening the model predicts for every new setpoint
+        self.pid_parameters = {'Kp': -3000, 'Ki': -80, 'Kd': -150, 'output_limits': (12800, 16640)}
+        if pid_parameters:
+            self.pid_parameters.update(pid_parameters)
+
+        # Latency of every stage of the control loop, published every metrics_interval seconds
+        self.metrics = Metrics()
+        self.metrics_interval = metrics_interval
+        self.metrics_file = metrics_file  # Prometheus text file
+
+        # Channels of the records (list of dicts from cooling.yaml or ChannelRegistry, default: NTC, SHT
+        # temperature and humidity, valve, flow and flow counter), timestamp is indexed for time range queries
+        self.channels = channels if isinstance(channels, ChannelRegistry) else ChannelRegistry(channels)
+
         # Set up temperature log file
-        self.temp_type = np.dtype([
-            ('timestamp', 'u4'),
-            ('temperature_box', 'f4'),
-            ('temperature_dut', 'f4'),
-            ('humidity_dut', 'f4'),
-            ('valve', 'i4'),
-            ('flow_in_l_min','f4'),
-            ('flow_counter_in_l','f4')
-        ])
-        self.output_file = tb.open_file('measurement_' + today + current_time + '.h5', 'a')
-        if '/temperature' in self.output_file:  # Table already exists
-            self.temp_table = self.output_file.root.temperature
+        self.temp_type = self.channels.dtype
+        # Rows are written in batches from a background thread, together with the text file.
+        # With a run name or rotation (dict with max_size in MB and max_interval in h) the run is split
+        # into segment files listed in <run>.catalog.json (see segments.py)
+        writer_kwargs = dict(text_columns=self.channels.text_columns, batch_size=64, max_age=10.,
+                             index_columns=('timestamp',), metrics=self.metrics)
+        if run or rotation:
+            from n2_cooling.segments import RotatingWriter
+            rotation = rotation or {}
+            max_size, max_interval = rotation.get('max_size'), rotation.get('max_interval')
+            self.writer = RotatingWriter(self.output_name, self.temp_type, text=True,
+                                         max_size=max_size * 1e6 if max_size else None,
+                                         max_interval=max_interval * 3600. if max_interval else None, **writer_kwargs)
         else:
-            self.temp_table = self.output_file.create_table(self.output_file.root,
-                                                            name='temperature',
-                                                            description=self.temp_type,
-                                                            filters=tb.Filters(complevel=5, complib='blosc')
-                                                            )            
+            from n2_cooling.storage import TableWriter
+            self.writer = TableWriter(self.output_name + '.h5', self.temp_type, text_file=self.output_name + '.txt',
+                                      **writer_kwargs)
+
+        # Optional compression in front of the writer, keeps only rows needed to reconstruct the
+        # curves within the tolerances (dict with tolerances, mode and max_interval, see compression.py)
+        self.compressor = None
+        if compression:
+            from n2_cooling.compression import Compressor
+            self.compressor = Compressor(**dict({'tolerances': self.channels.tolerances}, **compression))
+
+        # Serial ports are opened on first use of a device, ports can also be pyserial URLs
+        self.connection = Connection(arduino_port, bronkhorst_port, metrics=self.metrics,
+                                     arduino_values=self.channels.n_arduino_values)
+
+        # In streaming mode the newest sensor sample is taken without waiting for the Arduino
+        self.streaming = streaming
+        self.max_sample_age = 5.  # warn if newest sensor sample is older than this (s)
+
+        # One I/O worker per serial port, both devices are read in parallel every cycle
+        self.scheduler = IOScheduler(devices=('arduino', 'bronkhorst'))
+
+        # Control cycles start every period seconds (CycleTimer), I/O not finished within 80 % of it is stale
+        self.period = period
+        self.cycle_timer = None
+
+        # Set to leave the control loop
+        self._stop = threading.Event()
+
+        # Setpoint (or profile of setpoints) and pause can be changed by commands while the loop runs
+        self._setpoint_lock = threading.Lock()
+        self.setpoint = None
+        self.profile = None  # (start time, times from start in s, setpoints)
+        self.paused = False
+        self.setpoint_step = False  # new setpoint, the PID starts from the feed-forward output
+        self.last_record = None
+        self.n_cycles = 0
+        self.n_sent = 0  # sequence number of the records sent to the online monitor
+        self.command_server = None
+        if command_address:
+            import zmq
+            from n2_cooling.commands import CommandServer
+            try:
+                self.command_server = CommandServer(command_address, self.handle_command)
+            except zmq.error.ZMQError as e:
+                self.log.warning("Cannot open command socket %s: %s", command_address, e)
 
     def __del__(self):
-        self.output_file.close()
+        if self.command_server is not None:
+            self.command_server.close()
+        self.scheduler.shutdown()
+        self.connection.close()
+        self.writer.close()
+
+    @property
+    def output_file(self):
+        ''' HDF5 file written now (the current segment with rotation) '''
+        return self.writer.output_file
+
+    @property
+    def temp_table(self):
+        return self.writer.table
+
+    @property
+    def arduino(self):
+        ''' Sensor readout (NTC and SHT85) '''
+        return self.connection.arduino
+
+    @property
+    def bronkhorst(self):
+        ''' Flow controller driver, all parameters of one cycle are read in one transaction '''
+        return self.connection.bronkhorst
 
     def mean(self,list):
         sum_of_list = 0
@@ -97,169 +186,294 @@ class Cooling(object):
 
     def get_valve(self):
         # get the valve opening
-        ser_bronk.write(bytes(b':06800472417241\r\n'))
-        
-        # answer does read the confirmation of the command
-        answer=ser_bronk.readline().decode()
-       
-        while len(answer)<20:
-            answer = ser_bronk.readline().decode()
-        answer=round(int(answer[11:-2], 16) * 5.96368684979e-6, 3)
-        
-        return answer
+        return self.bronkhorst.get_valve()
 
     def get_temps(self):
         '''
-        This func will ask for data by writing "R" in the Serial port. It will receive a Array with 3 elements.
-        ([tempNTC,tempSHT, humidityDHT])
+        This func will ask for data by writing "R" in the Serial port. It will receive a list with all values
+        of the Arduino line ([tempNTC, tempSHT, humiditySHT] with the default firmware, see channels.py).
+        In streaming mode the newest sample of the reader thread is returned without waiting.
+        The valve opening is read together with the flow values in PID_controller.
         '''
-        # start process in arduino with command 'R'
-        ser_arduino.write(bytes(b'R'))
-       
-        time.sleep(1)
-
-        # output is from type bytes. Convert to string
-        read_values = ser_arduino.readline().decode("utf-8")
-        values = read_values.split(" ")
-
-
-        tempNTC = values[0]
-        tempSHT = values[1]
-        humidSHT = values[2]
-
-        valve = self.get_valve()
-
-        return [tempNTC, tempSHT, humidSHT, valve]
+        with self.metrics.timer('arduino_read'):
+            return self._read_temps()
+
+    def _read_temps(self):
+        if self.streaming:
+            # newest sample of the reader thread, only waits for the very first one
+            self.arduino.start()
+            sample = self.arduino.latest(timeout=self.max_sample_age)
+            if sample is None:
+                raise RuntimeError('No data from sensor readout')
+            age = time.time() - sample['timestamp']
+            if age > self.max_sample_age:
+                self.log.warning('Newest sensor sample is %.1f s old', age)
+            values = sample['values']
+        else:
+            # start process in arduino with command 'R' and wait for the answer
+            values = self.arduino.read()
+        return [round(float(value), 2) for value in values]
 
-    def setvalve_readtemp(self, control_val, ports=serial.Serial(port="/dev/ttyUSB1", baudrate=38400)):
+    def setvalve_readtemp(self, control_val):
         '''
         This function will be used in the PID. Sets the Valve and returns the temp for the PID loop
         '''
-        # set Mode 18 (setpoint will be controlling the valve)
-        ser_bronk.write(bytes(b':058001010414\r\n'))
-
-        control_val = str(hex(int(control_val)))[2:]
-      
-        if len(control_val) == 1:
-            control_val='000' + str(control_val)
-           
-        if len(control_val) == 2:
-            control_val='00' + str(control_val)
-
-        if len(control_val)==3:
-            control_val='0'+str(control_val)
-            
-        # writing the new setpoint
-        ports.write(b':0680010121' + control_val.encode() + b'\r\n') 
-        clearing_port = ports.readline()
+        # writing the new setpoint, the instrument is in valve steering mode (see PID_controller)
+        self.bronkhorst.set_valve(control_val)
 
         # let PID controller in valve settle
         time.sleep(.2)
         
-        # SHT output
-        temp = self.get_temps()[1]
+        # SHT output (control channel)
+        temp = self.get_temps()[self.channels.control_index]
  
         return float(temp)
 
+    def setvalve_readstatus(self, control_val):
+        '''
+        Sets the valve and returns valve opening, flow and flow counter after the valve settled.
+        Only talks to the flow controller, so it can run in parallel to the sensor readout.
+        '''
+        self.bronkhorst.set_valve(control_val)
+
+        # let PID controller in valve settle
+        time.sleep(.2)
+
+        return self.bronkhorst.read_status()
+
+    def set_setpoint(self, value):
+        ''' New setpoint in C from the next cycle on, stops a running ramp or profile '''
+        with self._setpoint_lock:
+            self.setpoint = float(value)
+            self.profile = None
+            self.setpoint_step = True
+        self.log.info('Setpoint %.2f C', self.setpoint)
+
+    def set_profile(self, points):
+        ''' Setpoints [(s from now, C), ...] linearly interpolated, the last one is kept afterwards '''
+        points = sorted((float(t), float(value)) for t, value in points)
+        if not points or points[0][0] < 0:
+            raise ValueError('Profile needs points at times >= 0')
+        times, values = np.array(points).T
+        with self._setpoint_lock:
+            self.profile = (time.time(), times, values)
+        self.log.info('Setpoint profile from %.2f C to %.2f C in %.0f s', values[0], values[-1], times[-1])
+
+    def ramp(self, value, rate):
+        ''' Linear ramp from the current setpoint to value with rate in C/min '''
+        if rate <= 0:
+            raise ValueError('Ramp rate has to be positive')
+        current = self.current_setpoint()
+        if current is None:
+            raise ValueError('No setpoint to start the ramp from')
+        self.set_profile([(0., current), (abs(float(value) - current) / rate * 60., value)])
+
+    def feed_forward(self, setpoint):
+        ''' PID output holding setpoint according to the model in pid_parameters, None without model '''
+        if not self.pid_parameters.get('feed_forward') or 'model' not in self.pid_parameters:
+            return None
+        from n2_cooling.tuning import feed_forward
+        return feed_forward(self.pid_parameters['model'], setpoint, self.pid_parameters['output_limits'])
+
+    def current_setpoint(self):
+        with self._setpoint_lock:
+            if self.profile is not None:
+                start, times, values = self.profile
+                elapsed = time.time() - start
+                if elapsed < times[-1]:
+                    return float(np.interp(elapsed, times, values))
+                self.setpoint, self.profile = float(values[-1]), None
+            return self.setpoint
+
+    def pause(self):
+        ''' Hold the valve at the current output, sensors are still read and logged '''
+        self.paused = True
+        self.log.info('Control paused')
+
+    def resume(self):
+        self.paused = False
+        self.log.info('Control resumed')
+
+    def status(self):
+        status = {
+            'chamber': self.chamber,
+            'setpoint': self.current_setpoint(),
+            'profile_remaining': None,
+            'paused': self.paused,
+            'cycles': self.n_cycles,
+        }
+        profile = self.profile
+        if profile is not None:
+            status['profile_remaining'] = max(profile[0] + profile[1][-1] - time.time(), 0.)
+            status['target'] = float(profile[2][-1])
+        record = self.last_record
+        if record is not None:
+            status.update((name, float(record[name])) for name in record.dtype.names)
+        return status
+
+    def handle_command(self, command):
+        ''' Answer a request of the command channel (see commands.py) '''
+        cmd = command.get('cmd')
+        if cmd == 'setpoint':
+            self.set_setpoint(command['value'])
+        elif cmd == 'ramp':
+            self.ramp(command['value'], float(command.get('rate', 1.)))
+        elif cmd == 'profile':
+            self.set_profile(command['points'])
+        elif cmd == 'pause':
+            self.pause()
+        elif cmd == 'resume':
+            self.resume()
+        elif cmd != 'status':
+            return {'ok': False, 'error': 'Unknown command %s' % cmd}
+        reply = self.status()
+        reply['ok'] = True
+        return reply
+
     def PID_controller(self, user_input):
        
         logging.info('Starting cooling process...')
 
-        with open('measurement_' + today + current_time + '.txt', 'w') as f:
+        try:
             '''
             This function will include thw hole PID controller. It uses mainly the simple_PID package
             '''
+            from simple_pid import PID
 
-            pid = PID(Kp=-3000, Ki=-80, Kd=-150,output_limits=(12800, 16640), setpoint=user_input)
+            self.set_setpoint(user_input)
+            pid = PID(Kp=self.pid_parameters['Kp'], Ki=self.pid_parameters['Ki'], Kd=self.pid_parameters['Kd'],
+                      output_limits=tuple(self.pid_parameters['output_limits']), setpoint=user_input)
+            control = None
+
+            # set Mode 20 (setpoint will be controlling the valve)
+            self.bronkhorst.write('control_mode', 20)
             start = self.setvalve_readtemp(0)
 
-            # writing the headline of the data file
-            write_flg = 1
             rst_flg = 0
+            last_metrics = time.time()
+            timer = self.cycle_timer = CycleTimer(self.period, metrics=self.metrics)
 
-            while True:
+            while not self._stop.is_set():
                 # Reset counter (counter returns floats) value 01 resets counter!
                 if rst_flg == 0:
-                    ser_bronk.write(bytes(b':058001730801\r\n'))
-                    reader=ser_bronk.readline().decode("utf-8")
+                    self.bronkhorst.reset_counter()
                     logging.info("Restarting flow counter: DONE")
-                    
-                    # read also capacity unit
-                    ser_bronk.write(bytes(b':078004017F017F07\r\n'))
-                    # unit will give you a hex string which can be converted to string. The last 7 bytes contain the data
-                    unit_hex = ser_bronk.readline().decode("utf-8")
-                    unit_string = bytes.fromhex(unit_hex[13:]).decode('utf-8')
+
+                    # read also capacity unit, it is cached by the driver
+                    unit_string = self.bronkhorst.capacity_unit
                     rst_flg=1
-                self.get_valve()
-                # Compute new output from the PID according to the systems current value
-                control = pid(start)
-
-                # Feed the PID output to the system and get its current value
-                start = self.setvalve_readtemp(control)
-
-                # printing the measurement
-                measurement=self.get_temps()
-               
-                print("VALVE: ", measurement[3], "%")
-                print('TEMP NTC: ', measurement[0], "°C")
-                print("TEMP SHT: ", measurement[1], "°C")
-                print("HUMID: ", measurement[2], "% \r\n")#, humids = self.get_temps()
-
-                ser_bronk.write(bytes(b':06030468416841\r\n'))
-                counter = ser_bronk.readline().decode("utf-8")
-                counter_float = struct.unpack('!f',bytes.fromhex(str(counter[11:])))[0]
-                print("Flow counter: ", counter_float)
-
-                # monitoring flow (the value has to be then calculated see manual!)
-                ser_bronk.write(bytes(b':06800401210120\r\n'))
-                flow_hex = ser_bronk.readline().decode()[11:-2]
-                flow_int = int(flow_hex, 16)
-
-                # Read capacity 100% (necessary for calculating flow, given in hex convert to float)
-                ser_bronk.write(bytes(b':068004014D014D\r\n'))
-                cap_hex = ser_bronk.readline().decode()[11:-2]
-                cap = struct.unpack('!f',bytes.fromhex(str(cap_hex)))[0]
-
-                # calculate flow as mentioned
-                flow_in_unit = flow_int / 32000 * cap
-                print("flow in ", unit_string," : ", round(flow_in_unit,2), '\n')
-                print('_ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ \n')
-
-                # send data to online monitor (first in the converter)
-                if self.socket:
-                    send_data(self.socket, data=np.array([measurement[0],measurement[1],measurement[2]], dtype=np.float64)) 
-
-                if write_flg == 1:
-                    f.write('TEMP NTC in Celsius:   ')
-                    f.write('TEMP SHT in Celsius:   ')
-                    f.write('HUMIDITY in %:   ')
-                    f.write('Valve Output in %:   ')
-                    f.write('flow in l/min:   ')
-                    f.write('flow counter in l:   ')
-                    f.write('Time'   +'\n')
-                    write_flg = 0
-
-                f.write(measurement[0] + "                  ")
-                f.write(measurement[1] + "                  ")
-                f.write(measurement[2] + "                  ")
-                f.write(str(measurement[3]) + "                  ")
-                f.write(str(round(flow_in_unit,2)) + "                  ")
-                f.write(str(round(counter_float,2)) + "                  ")
-                f.write(str(int(time.time())) + "\n")
-
-                self.temp_table.append([(int(time.time()), measurement[0], measurement[1], measurement[2], measurement[3], round(flow_in_unit, 2), round(counter_float, 2))])
-                self.temp_table.flush()
-
-                time.sleep(0.05)
-
-    def run(self, valve=0x000000):
+
+                # Wait for the start of the next cycle, dt is the time since the last one
+                dt = timer.wait()
+                cycle_start = time.perf_counter()
+
+                # Compute new output from the PID according to the systems current value,
+                # setpoint and pause are taken from the command channel every cycle
+                with self.metrics.timer('pid'):
+                    pid.setpoint = self.current_setpoint()
+                    if self.setpoint_step and not self.paused:
+                        # start from the valve opening of the new setpoint, the integral corrects the model error
+                        self.setpoint_step = False
+                        output = self.feed_forward(pid.setpoint)
+                        if output is not None:
+                            pid.set_auto_mode(False)
+                            pid.set_auto_mode(True, last_output=output)
+                            self.log.info('Valve feed-forward %.0f for %.2f C', output, pid.setpoint)
+                    if self.paused == pid.auto_mode:
+                        # bumpless switching, the integral continues from the held output
+                        pid.set_auto_mode(not self.paused, last_output=control)
+                    control = pid(start, dt=dt)
+                    if control is None:  # paused before the first output
+                        control = pid.output_limits[0]
+
+                # Feed the PID output to the system and read sensors and flow controller in parallel
+                with self.metrics.timer('io'):
+                    snapshot, stale = self.scheduler.snapshot({
+                        'status': ('bronkhorst', self.setvalve_readstatus, control),
+                        'measurement': ('arduino', self.get_temps),
+                    }, timeout=max(0.8 * self.period - timer.elapsed(), 0.))
+                self.metrics.count('stale', len(stale))
+                if snapshot['measurement'] is None:
+                    logging.warning('No sensor data yet, skipping cycle')
+                    continue
+                measurement = list(snapshot['measurement'])
+                start = float(measurement[self.channels.control_index])
+
+                # valve, flow and flow counter are read in one transaction (capacity is cached)
+                # no old values are logged if the flow controller did not answer in this cycle
+                status = snapshot['status']
+                if status is None or 'status' in stale:
+                    status = {}
+                # one record of all channels (channels.py), missing values are NaN
+                record = self.channels.record(time.time(), measurement, status)
+
+                # cycle is late, skip output to the console and the online monitor, the row is still logged
+                late = timer.late()
+                if late:
+                    self.metrics.count('late_cycles')
+
+                if not late:
+                    for channel in self.channels.channels:
+                        unit = unit_string if channel.get('kind') == 'flow' else channel['unit']
+                        print("%s: " % channel['label'], round(float(record[channel['name']]), 2), unit)
+                    print('_ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ \n')
+
+                # send the full record to online monitor (first in the converter)
+                if self.socket and not late:
+                    self.n_sent += 1  # the converter counts the gaps as dropped messages
+                    with self.metrics.timer('zmq_send'), self.socket_lock:
+                        if not send_data(self.socket, record, name=self.data_name, sequence=self.n_sent,
+                                         channels=self.channels.wire):
+                            self.metrics.count('zmq_dropped')
+
+                self.last_record = record
+                self.n_cycles += 1
+
+                with self.metrics.timer('log'):
+                    for row in (self.compressor.add(record) if self.compressor is not None else (record,)):
+                        self.writer.append(row)
+
+                self.metrics.observe('cycle', time.perf_counter() - cycle_start)
+                if time.time() - last_metrics > self.metrics_interval and not timer.late():
+                    self.publish_metrics()
+                    last_metrics = time.time()
+        finally:
+            if self.cycle_timer is not None:
+                self.log.info('%(cycles)d cycles of %(period).3f s, %(overruns)d overruns, jitter p99 %(jitter_p99).4f s', self.cycle_timer.stats())
+            # write all buffered rows
+            if self.compressor is not None:
+                for row in self.compressor.flush():
+                    self.writer.append(row)
+                self.log.info('Logged %d of %d rows (compression %.0f)', self.compressor.n_out, self.compressor.n_in, self.compressor.ratio)
+            self.writer.flush()
+
+    def publish_metrics(self):
+        ''' Send latency summary to the online monitor and write the Prometheus file '''
+        summary = self.metrics.snapshot()
+        if self.socket:
+            with self.socket_lock:
+                send_metrics(self.socket, summary, name=self.metrics_name)
+        if self.metrics_file:
+            try:
+                self.metrics.write_prometheus(self.metrics_file)
+            except IOError as e:
+                self.log.warning("Cannot write metrics file: %s", e)
+        return summary
+
+    def stop(self):
+        ''' Leave the control loop after the current cycle '''
+        self._stop.set()
+
+    def run(self, setpoint=None):
         time.sleep(2)
 
         logging.info('Starting...')
-        logging.info('Type in cooling temperature in Celsius:  ')
-        user_input = input()
-        logging.info('To change the cooling temperature restart the cooling.py')
-        self.PID_controller(float(user_input))
+        if setpoint is None:
+            logging.info('Type in cooling temperature in Celsius:  ')
+            setpoint = float(input())
+        if self.command_server is not None:
+            logging.info('To change the cooling temperature use n2cooling-command --address %s', self.command_server.address)
+        self.PID_controller(float(setpoint))
 
 
 def main():
@@ -268,16 +482,46 @@ def main():
         description='Temperature control',
         formatter_class=argparse.RawTextHelpFormatter
     )
-    parser.add_argument('--setpoint', type=float, default=-20.0,
-                        help="Target temperature in Celsius")
+    parser.add_argument('--setpoint', type=float, default=None,
+                        help="Target temperature in Celsius (asked for if not given)")
     parser.add_argument('--logfile', type=str, default="temperature.log",
                         help="Filename for log file")
     parser.add_argument('--monitor', type=str, default="tcp://127.0.0.1:5000",
                         help="Online monitor address including port")
+    parser.add_argument('--command', type=str, default="tcp://127.0.0.1:5001",
+                        help="Address for setpoint, ramp, pause and status commands (n2cooling-command)")
+    parser.add_argument('--period', type=float, default=0.5,
+                        help="Period of the control loop in s")
+    parser.add_argument('--poll', action='store_true',
+                        help="Request every sensor sample instead of streaming readout")
+    parser.add_argument('--arduino', type=str, default="/dev/ttyUSB0",
+                        help="Serial port of the Arduino")
+    parser.add_argument('--bronkhorst', type=str, default="/dev/ttyUSB1",
+                        help="Serial port of the Bronkhorst flow controller")
+    parser.add_argument('--compress', choices=['swinging_door', 'deadband'], default=None,
+                        help="Log only rows needed to reconstruct the curves within the default tolerances")
+    parser.add_argument('--heartbeat', type=float, default=60.,
+                        help="Max. time between logged rows with --compress in s")
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help="Write loop latency metrics in Prometheus text format to this file")
+    parser.add_argument('--run', type=str, default=None,
+                        help="Name of the run, measurement files are segments listed in <run>.catalog.json,\n"
+                             "a run started again with the same name is continued")
+    parser.add_argument('--rotate-size', type=float, default=None,
+                        help="Start a new segment file when the current one is larger than this (MB)")
+    parser.add_argument('--rotate-interval', type=float, default=None,
+                        help="Start a new segment file every this many hours")
     args = parser.parse_args()
 
-    cooling = Cooling( monitor=args.monitor)
-    cooling.run()
+    logging.basicConfig(level=logging.INFO, format=FORMAT)
+    cooling = Cooling(monitor=args.monitor, streaming=not args.poll,
+                      arduino_port=args.arduino, bronkhorst_port=args.bronkhorst,
+                      metrics_file=args.metrics_file,
+                      compression=dict(mode=args.compress, max_interval=args.heartbeat) if args.compress else None,
+                      command_address=args.command or None, period=args.period, run=args.run,
+                      rotation=dict(max_size=args.rotate_size, max_interval=args.rotate_interval)
+                      if args.rotate_size or args.rotate_interval else None)
+    cooling.run(args.setpoint)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+import numpy as np
+
+from n2_cooling.ring_buffer import RingBuffer
+
+
+class DecimationLevel(object):
+    '''
+    Min, max and mean of all channels in buckets of fixed length (resolution in s).
+    Closed buckets are stored in ring buffers of fixed capacity.
+    '''
+
+    def __init__(self, resolution, n_channels, capacity):
+        self.resolution = resolution
+        self.time = RingBuffer(capacity)  # bucket start
+        self.min = RingBuffer(capacity, shape=(n_channels,))
+        self.max = RingBuffer(capacity, shape=(n_channels,))
+        self.mean = RingBuffer(capacity, shape=(n_channels,))
+        self.bucket = None  # start of the open bucket
+        self._n_channels = n_channels
+
+    def _open(self, bucket):
+        self.bucket = bucket
+        self._min = np.full(self._n_channels, np.nan)
+        self._max = np.full(self._n_channels, np.nan)
+        self._sum = np.zeros(self._n_channels)
+        self._count = np.zeros(self._n_channels)
+
+    def add(self, timestamp, minimum, maximum, total, count):
+        '''
+        Add a finer bucket (or a single value with minimum = maximum = total and count = 1).
+        Returns the closed bucket (start, min, max, sum, count) if timestamp started a new one, otherwise None.
+        '''
+        closed = None
+        bucket = timestamp // self.resolution * self.resolution
+        if self.bucket is not None and bucket != self.bucket:
+            closed = self.close()
+        if self.bucket is None:
+            self._open(bucket)
+        self._min = np.fmin(self._min, minimum)
+        self._max = np.fmax(self._max, maximum)
+        self._sum += total
+        self._count += count
+        return closed
+
+    def close(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self._sum / self._count
+        closed = (self.bucket, self._min, self._max, self._sum, self._count)
+        self.time.append(self.bucket)
+        self.min.append(self._min)
+        self.max.append(self._max)
+        self.mean.append(mean)
+        self.bucket = None
+        return closed
+
+
+class DecimationPyramid(object):
+    '''
+    History of several channels at increasing bucket lengths (e.g. seconds, minutes, hours).
+    Every level has the same capacity, so memory is bounded while coarse levels cover the whole run.
+    A raw value only updates the finest level, coarser levels are fed with the closed buckets of
+    the next finer one.
+    '''
+
+    def __init__(self, n_channels, resolutions=(1, 60, 3600), capacity=2000):
+        self.n_channels = n_channels
+        self.levels = [DecimationLevel(resolution, n_channels, capacity) for resolution in sorted(resolutions)]
+
+    def add(self, timestamp, values):
+        values = np.asarray(values, dtype=np.float64)
+        finite = np.isfinite(values)
+        bucket = (timestamp, values, values, np.where(finite, values, 0.), finite.astype(np.float64))
+        for level in self.levels:
+            bucket = level.add(*bucket)
+            if bucket is None:
+                break
+
+    def query(self, t_min, t_max, max_points=2000):
+        '''
+        Buckets between t_min and t_max of the finest level which covers t_min with at most
+        max_points buckets in the range; the coarsest level if none does.
+        Returns dict with resolution, time (n), min, max and mean (n x channels) or None if empty.
+        '''
+        selected = None
+        for level in self.levels:
+            times = level.time.data()
+            if not len(times):
+                continue
+            selected = level, times
+            in_range = np.count_nonzero((times >= t_min) & (times <= t_max))
+            if times[0] <= t_min and in_range <= max_points:
+                break
+        if selected is None:
+            return None
+        level, times = selected
+        selection = (times >= t_min - level.resolution) & (times <= t_max)
+        return {
+            "resolution": level.resolution,
+            "time": times[selection],
+            "min": level.min.data()[selection],
+            "max": level.max.data()[selection],
+            "mean": level.mean.data()[selection],
+        }
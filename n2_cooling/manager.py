@@ -0,0 +1,111 @@
+import time
+import logging
+import argparse
+import threading
+import yaml
+
+from n2_cooling.cooling import Cooling, FORMAT
+from n2_cooling.channels import ChannelRegistry
+
+
+class CoolingManager(object):
+    '''
+    Runs one Cooling per chamber defined in the chambers section of cooling.yaml, every control
+    loop in its own thread. All chambers publish on one online monitor socket with their chamber
+    name in the data name (e.g. CoolingData.box1), the converter selects its chamber.
+    '''
+
+    def __init__(self, config_file="cooling.yaml", monitor=None):
+        self.log = logging.getLogger('CoolingManager')
+        with open(config_file) as f:
+            self.config = yaml.safe_load(f)
+        if not self.config.get('chambers'):
+            raise ValueError('No chambers defined in %s' % config_file)
+
+        # One socket for all chambers, sending is guarded by a lock since ZMQ sockets are not thread safe
+        self.context = None
+        self.socket = None
+        self.socket_lock = threading.Lock()
+        monitor = monitor or self.config.get('monitor')
+        if monitor:
+            import zmq
+            try:
+                self.context = zmq.Context()
+                self.socket = self.context.socket(zmq.PUB)
+                self.socket.bind(monitor)
+                self.log.info("Sending data to server %s" % monitor)
+            except zmq.error.ZMQError:
+                self.log.warning("Cannot connect to socket for data sending")
+                self.socket = None
+
+        self.coolings = {}
+        self.setpoints = {}
+        for chamber in self.config['chambers']:
+            name = chamber['name']
+            if name in self.coolings:
+                raise ValueError('Chamber %s defined twice' % name)
+            self.coolings[name] = Cooling(monitor=False, socket=self.socket, socket_lock=self.socket_lock,
+                                          chamber=name,
+                                          streaming=chamber.get('streaming', True),
+                                          arduino_port=chamber['arduino_port'],
+                                          bronkhorst_port=chamber['bronkhorst_port'],
+                                          pid_parameters=chamber.get('pid'),
+                                          metrics_file=chamber.get('metrics_file'),
+                                          compression=chamber.get('compression'),
+                                          command_address=chamber.get('command'),
+                                          period=float(chamber.get('period', 0.5)),
+                                          channels=ChannelRegistry.from_config(self.config, chamber),
+                                          run=chamber.get('run'),
+                                          rotation=chamber.get('rotation'))
+            self.setpoints[name] = float(chamber.get('setpoint', -20.))
+        self.threads = {}
+
+    def _run_chamber(self, name):
+        try:
+            self.coolings[name].PID_controller(self.setpoints[name])
+        except Exception:
+            self.log.exception('Control loop of chamber %s stopped', name)
+
+    def start(self):
+        for name in self.coolings:
+            self.log.info('Starting chamber %s with setpoint %.1f C', name, self.setpoints[name])
+            self.threads[name] = threading.Thread(target=self._run_chamber, args=(name,), name=name, daemon=True)
+            self.threads[name].start()
+
+    def stop(self, timeout=10.):
+        for cooling in self.coolings.values():
+            cooling.stop()
+        for thread in self.threads.values():
+            thread.join(timeout)
+        for cooling in self.coolings.values():
+            cooling.writer.close()
+
+    def run(self):
+        ''' Run all chambers until interrupted (Ctrl-C) or all control loops ended '''
+        self.start()
+        try:
+            while any(thread.is_alive() for thread in self.threads.values()):
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            self.log.info('Stopping all chambers')
+        finally:
+            self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Temperature control of several cooling boxes defined in the configuration',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--config', type=str, default="cooling.yaml",
+                        help="Configuration with chambers section")
+    parser.add_argument('--monitor', type=str, default=None,
+                        help="Online monitor address including port (default from configuration)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format=FORMAT)
+    CoolingManager(args.config, monitor=args.monitor).run()
+
+
+if __name__ == "__main__":
+    main()
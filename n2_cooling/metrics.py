@@ -0,0 +1,135 @@
+import os
+import math
+import time
+import threading
+import contextlib
+
+
+class LatencyHistogram(object):
+    '''
+    Histogram of durations with logarithmic buckets (per_decade buckets per factor 10 between
+    min_value and max_value in s). Observing a value is O(1) and needs no memory allocation.
+    '''
+
+    def __init__(self, min_value=1e-6, max_value=100., per_decade=8):
+        self.min_value = min_value
+        self.per_decade = per_decade
+        self.n_buckets = int(math.ceil(math.log10(max_value / min_value) * per_decade)) + 1
+        # upper bound of every bucket, the last one collects everything above max_value
+        self.bounds = [min_value * 10 ** (i / per_decade) for i in range(self.n_buckets - 1)] + [float('inf')]
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * self.n_buckets
+            self.count = 0
+            self.sum = 0.
+            self.max = 0.
+
+    def observe(self, value):
+        index = 0 if value <= self.min_value else min(int(math.ceil(math.log10(value / self.min_value) * self.per_decade)), self.n_buckets - 1)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q):
+        ''' Upper bound of the bucket containing the q-th percentile (max. value for the last bucket) '''
+        if not self.count:
+            return float('nan')
+        rank = q / 100. * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else float('nan')
+
+
+class Metrics(object):
+    '''
+    Latency histograms of the stages of the control loop. Use as
+
+        with metrics.timer('stage'):
+            ...
+    '''
+
+    def __init__(self, prefix='n2cooling'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.start = time.time()
+        self._lock = threading.Lock()
+        self._last_snapshot = (time.time(), {})
+
+    def histogram(self, stage):
+        if stage not in self.histograms:
+            with self._lock:
+                self.histograms.setdefault(stage, LatencyHistogram())
+        return self.histograms[stage]
+
+    def observe(self, stage, value):
+        self.histogram(stage).observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(stage).observe(time.perf_counter() - start)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        '''
+        Summary of all stages: number of calls, rate (1/s) since the last snapshot, mean, p50, p99
+        and max in s. Counters are given with their total value.
+        '''
+        now = time.time()
+        last_time, last_counts = self._last_snapshot
+        stages = {}
+        for stage, histogram in list(self.histograms.items()):
+            stages[stage] = {
+                'count': histogram.count,
+                'rate': (histogram.count - last_counts.get(stage, 0)) / max(now - last_time, 1e-9),
+                'mean': histogram.mean,
+                'p50': histogram.percentile(50),
+                'p99': histogram.percentile(99),
+                'max': histogram.max,
+            }
+        self._last_snapshot = (now, dict((stage, values['count']) for stage, values in stages.items()))
+        return {'timestamp': now, 'uptime': now - self.start, 'stages': stages, 'counters': dict(self.counters)}
+
+    def to_prometheus(self):
+        ''' All histograms and counters in the Prometheus text exposition format '''
+        name = self.prefix + '_stage_duration_seconds'
+        lines = ['# HELP %s Duration of the stages of the cooling control loop' % name, '# TYPE %s histogram' % name]
+        for stage, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                le = '+Inf' if math.isinf(bound) else '%.6g' % bound
+                lines.append('%s_bucket{stage="%s",le="%s"} %d' % (name, stage, le, cumulative))
+            lines.append('%s_sum{stage="%s"} %.9g' % (name, stage, histogram.sum))
+            lines.append('%s_count{stage="%s"} %d' % (name, stage, histogram.count))
+        for counter, value in sorted(self.counters.items()):
+            lines.append('# TYPE %s_%s_total counter' % (self.prefix, counter))
+            lines.append('%s_%s_total %d' % (self.prefix, counter, value))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        ''' Write to file for the node exporter textfile collector, replaced atomically '''
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, filename)
@@ -1,9 +1,17 @@
 import numpy as np
 import time
-from collections import deque #rolling lists
+import logging
+import zmq
+import queue
+import threading
 
 from online_monitor.utils import utils
 from online_monitor.converter.transceiver import Transceiver
+from n2_cooling import wire
+from n2_cooling.channels import describe
+from n2_cooling.ring_buffer import RingBuffer, ChannelBuffer, WindowStats
+from n2_cooling.decimation import DecimationPyramid
+from n2_cooling.analysis import dewpoint
 
 
 class N2CoolingConverter(Transceiver):
@@ -17,144 +25,304 @@ class N2CoolingConverter(Transceiver):
 
         self.set_bidirectional_communication()
 
-    def deserialize_data(self, data):
-        return utils.simple_dec(data)
+    def _setup_frontend(self):
+        # as in Transceiver, but with configurable high-water mark (has to be set before connecting)
+        self.frontends = []
+        self.fe_poller = zmq.Poller()
+        for address in self.frontend_address:
+            socket = self.context.socket(self.frontend_socket_type)
+            socket.setsockopt(zmq.LINGER, 500)
+            socket.set_hwm(int(self.config.get('frontend_hwm', 1000)))
+            if self.frontend_socket_type == zmq.SUB:
+                socket.setsockopt_string(zmq.SUBSCRIBE, u'')
+            socket.connect(address)
+            self.frontends.append((address, socket))
+            self.fe_poller.register(socket, zmq.POLLIN)
+        self.raw_data = queue.Queue()
+        self.fe_stop = threading.Event()
+
+    def _setup_backend(self):
+        self.backends = []
+        self.be_poller = zmq.Poller()
+        for address in self.backend_address:
+            socket = self.context.socket(self.backend_socket_type)
+            socket.setsockopt(zmq.LINGER, 500)
+            socket.set_hwm(int(self.config.get('backend_hwm', 10)))
+            socket.bind(address)
+            self.backends.append((address, socket))
+            if self.backend_socket_type != zmq.DEALER:
+                self.be_poller.register(socket, zmq.POLLIN)
+        self.be_stop = threading.Event()
+
+    def recv_data(self):
+        # messages of cooling.py are multipart (header and records), receive all frames without copy
+        while not self.fe_stop.is_set():
+            self.fe_poller.poll(1)  # max block 1 ms
+            messages = []
+            for actual_frontend in self.frontends:
+                # everything received since the last poll
+                while True:
+                    try:
+                        frames = actual_frontend[1].recv_multipart(flags=zmq.NOBLOCK, copy=False)
+                    except zmq.Again:  # no data
+                        break
+                    messages.append((actual_frontend[0], self.deserialize_data(frames)))
+                    self.count_dropped(messages[-1][1][1])
+            for message in messages:
+                self.raw_data.put_nowait([message])
+
+    def count_dropped(self, meta_data):
+        sequence = meta_data.get("seq")
+        if sequence is None:
+            return
+        name = meta_data.get("name")
+        last = self.last_sequences.get(name)
+        if last is not None and sequence > last + 1:
+            self.n_dropped += sequence - last - 1
+        self.last_sequences[name] = sequence
+
+    def take_queued(self):
+        queued = []
+        while True:
+            try:
+                queued.extend(self.raw_data.get_nowait())
+            except queue.Empty:
+                return queued
+
+    def conflate(self, messages):
+        '''
+        One message per frontend and name: records of the same kind are concatenated, so no value is lost
+        for the plots, of messages without records (latest-state, e.g. metrics) only the newest is kept.
+        '''
+        merged = {}
+        for address, (records, meta_data) in messages:
+            key = (address, meta_data.get("name"))
+            if key not in merged:
+                merged[key] = (address, [] if records is None else [records], meta_data)
+                continue
+            self.n_conflated += 1
+            _, previous, _ = merged[key]
+            if records is not None and (not previous or previous[-1].dtype == records.dtype):
+                previous.append(records)
+            elif records is not None:
+                previous[:] = [records]  # format changed, older records cannot be merged
+            merged[key] = (address, previous, meta_data)
+        result = []
+        for address, records, meta_data in merged.values():
+            if not records:
+                records = None
+            elif len(records) == 1:
+                records = records[0]
+            else:
+                records = np.concatenate(records)
+            result.append((address, (records, meta_data)))
+        return result
+
+    def deserialize_data(self, frames):
+        if wire.is_wire_message(frames):
+            return wire.decode(frames)
+        # single frame of older publishers: [tempNTC, tempSHT, humidSHT] with timestamp in meta data
+        data, meta_data = utils.simple_dec(frames[0].bytes)
+        if data is None:
+            return None, meta_data
+        records = np.zeros(1, dtype=[('timestamp', 'f8'), ('temperature_box', 'f8'), ('temperature_dut', 'f8'), ('humidity_dut', 'f8')])
+        records['timestamp'] = meta_data['timestamp']
+        records['temperature_box'], records['temperature_dut'], records['humidity_dut'] = data[:3]
+        return records, meta_data
 
     def setup_interpretation(self):
         # Maximum amount of values before override
-        self.n_values = 500
+        self.n_values = int(self.config.get('n_values', 500))
         self.last_timestamp = time.time()
+        self.avg_window = 180  # Time span in s taken into account for averaging
+
+        # Publish only new values, the full history only on request of a receiver (connect, reset, gap)
+        self.incremental = bool(self.config.get('incremental', True))
+        self.sequence = 0
+
+        # Chamber to show if several chambers publish on the same socket (n2cooling-manager). The buffers
+        # hold one chamber only, if none is set the first one received is shown and the others are ignored
+        self.chamber = self.config.get('chamber')
+        self.ignored_chambers = set()
+
+        # Channels of the records (description in the header of cooling.py, see channels.py),
+        # set with the first records and again whenever the publisher changes them
+        self.description = describe([])
+        self.channel_names = []
+
+        # Long history as min/max/mean buckets of several lengths in s, sent for the range a receiver shows
+        self.resolutions = self.config.get('resolutions', [1, 60, 3600])
+        self.history_capacity = int(self.config.get('history_capacity', 2000))
+        self.history_request = None
+
+        # Message counters of the pipeline, reported in stats
+        self.n_dropped = 0  # lost before the converter (gaps in the sequence numbers of each name)
+        self.n_conflated = 0  # merged into a later message because the interpretation was behind
+        self.n_backend_dropped = 0  # not taken in time by the receivers (backend at high-water mark)
+
+        # Messages waiting for interpretation are merged with the one taken by the main loop
+        self.conflate_queued = bool(self.config.get('conflate', True))
+        self.last_sequences = {}
 
         # Init result hists
         self.reset()
 
     def reset(self):
-        print('RESET')
-        self.temp_arrays = {"temp_sensor": [], "temp_box": []}#, "Valve_output": []}
-        print(self.temp_arrays)
-        self.humidity_arrays = {
-            "humidity_sensor": []
-            
-        }
-        self.timestamps = []
+        # Preallocated circular buffers (channels x time for the values), appending does not copy the history
+        self.timestamps = RingBuffer(self.n_values)
+        self.values = ChannelBuffer(len(self.channel_names), self.n_values)
+        self.pyramid = DecimationPyramid(len(self.channel_names), resolutions=self.resolutions, capacity=self.history_capacity)
 
-        self.averages = {
-            "temp_sensor_avg": 0,
-        }
+        # Statistics of the temperatures over the last avg_window seconds, updated with every value
+        self.stats_channels = [self.channel_names.index(channel['name']) for channel in self.description['channels']
+                               if channel.get('kind') == 'temperature']
+        self.window_stats = dict((self.channel_names[i], WindowStats(self.avg_window)) for i in self.stats_channels)
+        self.averages = dict((self.channel_names[i], np.nan) for i in self.stats_channels)
         self.dewpoint = None
+        dewpoint_channels = self.description.get('dewpoint')
+        self.dewpoint_channels = [self.channel_names.index(name) for name in dewpoint_channels] if dewpoint_channels else None
 
         self.last_timestamp = time.time()
-        self.avg_window = 180  # Amount of values to be taken into account for averaging    
-        
-    
-    
-    def update_arrays(self, data, meta_data):
-
-        print("data")
-        print('META DATA')
-        # print(meta_data)
-        for idx, key in enumerate(self.temp_arrays):
-            #print(self.temp_arrays)
-            #print(idx,key)
-            #self.temp_arrays[key] = np.roll(self.temp_arrays[key], -1)
-            # self.temp_arrays[key].extend(data[0])
-            # print("updated")
-            # print(self.temp_arrays[key])
-            print(key)
-            print(len(self.temp_arrays[key]))
-            
-            #set data_indx because for temp_box other index in data is needed than for temp_sensor (see output get_temps)
-            
-            if key=="temp_box":
-                data_indx=0
-            # if key=="Valve_output":
-            #     data_indx=2
-            else:
-                data_indx=1
-            
-            
-            if len(self.temp_arrays[key])<self.n_values:
-                self.temp_arrays[key].append(data[data_indx])
-                print("KEY", key)
-                print("temp_arrays[KEY]",self.temp_arrays[key])
-            else:
-                self.temp_arrays[key]=self.temp_arrays[key][1:]
-                self.temp_arrays[key].append(data[data_indx])
-                print("KEY", key)
-                print("temp_arrays[KEY]",self.temp_arrays[key])
-        for idx, key in enumerate(self.humidity_arrays):
-            #self.humidity_arrays[key] = np.roll(self.humidity_arrays[key], -1)
-            if len(self.humidity_arrays[key])<self.n_values:
-                self.humidity_arrays[key].append(data[2])
-            else:
-                self.humidity_arrays[key]=self.humidity_arrays[key][1:]
-                self.humidity_arrays[key].append(data[2])
-        # self.timestamps = np.roll(self.timestamps, -1)
-            # print('Hier kommt die Metadata')
-            # print(meta_data)
-            # print(type(meta_data['timestamp']))
-            # print(type(self.timestamps),self.timestamps)
-            # self.timestamps.append(meta_data["timestamp"])
-            # self.last_timestamp = meta_data['timestamp']
-            if len(self.timestamps)<self.n_values:
-                self.timestamps.append(meta_data["timestamp"])
-            else:
-                self.timestamps=self.timestamps[1:]
-                self.timestamps.append(meta_data["timestamp"])
-            # print(self.last_timestamp)
-        
-    
-    
-    
-    def calculate_dewpoint(self, data):
-        b, c = 17.67, 243.5
-        temp = data[0]
-        rh = data[1]
-        gamma = np.log(rh / 100.) + b * temp / (c + temp)
-        self.dewpoint = c * gamma / (b - gamma)
-        
-        
-    
+        self.send_snapshot = True  # receivers have to drop their history
+
+    def set_channels(self, records, meta_data):
+        ''' Take the channels of the records, the buffers are reset if they changed '''
+        description = {"channels": meta_data["channels"], "control": meta_data.get("control"),
+                       "dewpoint": meta_data.get("dewpoint")} if "channels" in meta_data else describe(records.dtype.names)
+        names = [channel["name"] for channel in description["channels"]]
+        if names == self.channel_names and description == self.description:
+            return
+        self.description = description
+        self.channel_names = names
+        self.reset()
+
+    def channel_values(self, records):
+        ''' Values of all channels as 2-D array (channels x time), channels missing in the records are NaN '''
+        values = np.empty((len(self.channel_names), len(records)))
+        for i, name in enumerate(self.channel_names):
+            # older publishers do not send every field
+            values[i] = records[name] if name in records.dtype.names else np.nan
+        return values
+
+    def update_arrays(self, records):
+        timestamps = records["timestamp"].astype(np.float64)
+        values = self.channel_values(records)
+        self.timestamps.extend(timestamps)
+        self.values.extend(values)
+        # min. and max. of the window are kept in monotonic queues, these are filled value by value
+        for i in self.stats_channels:
+            stats = self.window_stats[self.channel_names[i]]
+            for timestamp, value in zip(timestamps, values[i]):
+                stats.add(timestamp, value)
+        for timestamp, row in zip(timestamps, values.T):
+            self.pyramid.add(timestamp, row)
+        self.last_timestamp = timestamps[-1]
+        return values
+
+    def calculate_dewpoint(self, values):
+        if self.dewpoint_channels is None:
+            self.dewpoint = None
+            return
+        temp, rh = values[self.dewpoint_channels, -1]
+        self.dewpoint = float(dewpoint(temp, rh))
+
     def interpret_data(self, data):
-        
-        data, meta_data = data[0][1]
-        # print("META DATA")
-        print(data)
-        self.update_arrays(data,meta_data)
-        self.calculate_dewpoint(data)
-        
-        #print(data)
-        # Calculate recent average of curves (timespan can be defined in GUI)
-        #selection = np.isfinite(self.temp_arrays["temp_sensor"])
-        #print(self.temp_arrays["temp_sensor"])
-        #print(type(self.temp_arrays["temp_sensor"]))
-        #extender=[0]*(self.avg_window-len(data))
-        #selection = np.isfinite(self.temp_arrays["temp_sensor"])
-        # print(self.temp_arrays["temp_sensor"])
-        self.averages["temp_sensor_avg"] = np.mean(self.temp_arrays["temp_sensor"])
-
-        interpreted_data = {
-            "temp": self.temp_arrays,
-            "humidity": self.humidity_arrays,
-            "time": self.timestamps,
-            "stats": {"avg": self.averages, "last_timestamp": self.last_timestamp, "dp": self.dewpoint},
-        }
+        if self.conflate_queued:
+            # only this thread takes from the queue, so draining it cannot race with the main loop
+            data = self.conflate(data + self.take_queued())
+        interpreted_data = []
+        for message in data:
+            interpreted_data.extend(self.interpret_message(message) or [])
+        return interpreted_data
+
+    def interpret_message(self, message):
+        records, meta_data = message[1]
+        name, _, chamber = meta_data.get("name", "").partition(".")
+        if self.chamber is None:
+            self.chamber = chamber
+        if chamber != self.chamber:
+            if chamber not in self.ignored_chambers:
+                self.ignored_chambers.add(chamber)
+                logging.warning("Ignoring data of chamber '%s', showing '%s' (set chamber in the converter config)", chamber, self.chamber)
+            return
+        if name == "CoolingMetrics":
+            # loop latency summary of cooling.py, forwarded as it is
+            return [{"type": "metrics", "metrics": meta_data["metrics"]}]
+        if records is None or not len(records):
+            return
+        self.set_channels(records, meta_data)
+        values = self.update_arrays(records)
+        self.calculate_dewpoint(values)
+
+        # Recent average of the temperatures (timespan can be defined in GUI)
+        for name, stats in self.window_stats.items():
+            self.averages[name] = stats.mean
+        window_stats = dict((name, stats.stats()) for name, stats in self.window_stats.items())
+
+        # values of all channels as one array (channels x time), the receivers select their curves by channel name
+        self.sequence += 1
+        if self.send_snapshot or not self.incremental:
+            self.send_snapshot = False
+            interpreted_data = {
+                "type": "snapshot",
+                "channels": self.description,
+                "values": self.values.data(),
+                "time": self.timestamps.data(),
+            }
+        else:
+            interpreted_data = {
+                "type": "delta",
+                "values": values,
+                "time": records["timestamp"].astype(np.float64),
+            }
+        if self.history_request is not None:
+            interpreted_data["history"] = self.get_history(*self.history_request)
+            self.history_request = None
+        interpreted_data["seq"] = self.sequence
+        interpreted_data["stats"] = {"avg": self.averages, "control": self.description.get("control"), "window": window_stats, "last_timestamp": self.last_timestamp, "dp": self.dewpoint,
+                                     "pipeline": {"dropped": self.n_dropped, "conflated": self.n_conflated,
+                                                  "backend_dropped": self.n_backend_dropped, "delay": float(time.time() - self.last_timestamp)}}
 
         return [interpreted_data]
 
+    def get_history(self, t_min, t_max, max_points):
+        history = self.pyramid.query(t_min, t_max, max_points)
+        if history is None:
+            return None
+        return {
+            "resolution": history["resolution"],
+            "time": history["time"],
+            "channels": dict((name, {"min": history["min"][:, i], "max": history["max"][:, i], "mean": history["mean"][:, i]})
+                             for i, name in enumerate(self.channel_names)),
+        }
+
     def serialize_data(self, data):
         return utils.simple_enc(None, data)
 
+    def send_data(self, data):
+        # never block on slow receivers, they see the gap in seq and request a snapshot
+        for frontend_data in data:
+            serialized_data = self.serialize_data(frontend_data)
+            for actual_backend in self.backends:
+                try:
+                    actual_backend[1].send(serialized_data, flags=zmq.NOBLOCK)
+                except zmq.Again:
+                    self.n_backend_dropped += 1
+
     def handle_command(self, command):
         # received signal is 'ACTIVETAB tab' where tab is the name (str) of the selected tab in online monitor
         if command[0] == "RESET":
             self.reset()
+        elif command[0].startswith("HISTORY"):
+            # receiver shows the time range 'HISTORY t_min t_max max_points', send buckets with next data
+            _, t_min, t_max, max_points = command[0].split()
+            self.history_request = (float(t_min), float(t_max), int(max_points))
+        elif command[0] == "SNAPSHOT":
+            # receiver connected or missed data, send full history with next data
+            self.send_snapshot = True
         else:
             self.avg_window = int(command[0])
-
-    
-
-
-        
-   
-
+            # rebuild window statistics from the buffered history
+            timestamps, values = self.timestamps.data(), self.values.data()
+            for i in self.stats_channels:
+                self.window_stats[self.channel_names[i]].set_window(self.avg_window, timestamps, values[i])
@@ -9,30 +9,80 @@ from time import perf_counter
 
 from datetime import datetime
 import time
+import logging
 
 from online_monitor.utils import utils
 from online_monitor.receiver.receiver import Receiver
 import n2_cooling_converter
 import numpy as np
+from n2_cooling.ring_buffer import RingBuffer, ChannelBuffer
+from n2_cooling.commands import send_command
 
 
 
 
 
 class TimeAxisItem(pg.AxisItem):
+    ''' Axis with local date and time labels, labels are formatted once per (value, spacing) '''
+
+    max_labels = 2000
+
+    def __init__(self, *args, **kwargs):
+        super(TimeAxisItem, self).__init__(*args, **kwargs)
+        self.log = logging.getLogger('TimeAxisItem')
+        self.labels = {}
+
     def tickStrings(self, values, scale, spacing):
-        print('VALUES DIE ANKOMMEN')
-        print(values)
-        return [datetime.fromtimestamp(value).strftime("%m/%d/%Y, %H:%M:%S") for value in values]
-            
-        
+        if spacing >= 86400:
+            fmt = "%m/%d/%Y"
+        elif spacing >= 60:
+            fmt = "%m/%d/%Y, %H:%M"
+        else:
+            fmt = "%m/%d/%Y, %H:%M:%S"
+        if len(self.labels) > self.max_labels:
+            self.labels.clear()
+        strings = []
+        for value in values:
+            key = (value, spacing)
+            if key not in self.labels:
+                self.labels[key] = datetime.fromtimestamp(value).strftime(fmt)
+            strings.append(self.labels[key])
+        self.log.debug("Ticks %s spacing %s", values, spacing)
+        return strings
 
 
 class N2Cooling(Receiver):
     def setup_receiver(self):
         self.set_bidirectional_communication()  # We want to change converter settings
+        self.log = logging.getLogger('N2CoolingReceiver')
         self.avg_window = 180
 
+        # Own history, the converter only sends new values after the first full snapshot
+        self.n_values = int(self.config.get('n_values', 500))
+        self.description = None  # channels of the converter (see channels.py), sent with every snapshot
+        self.channel_names = []
+        self.channels_outdated = False  # curves have to be rebuilt for new channels
+        self.last_sequence = None
+        self.snapshot_requested = None  # time of pending snapshot request
+        self.reset_buffers()
+        self.request_snapshot()
+
+        # Decimated history of the converter for time ranges beyond the own history
+        self.history = None
+        self.history_points = int(self.config.get('history_points', 2000))
+        self.history_requested = None  # last requested (t_min, t_max)
+        self.history_request_time = 0.
+
+        # Command address of cooling.py to change setpoint and pause control (None: no controls)
+        self.command_address = self.config.get('command')
+
+        # Messages only update the buffers, plots and labels are redrawn at most max_fps times per s
+        self.max_fps = float(self.config.get('max_fps', 10))
+        self.pending_stats = None
+        self.pending_metrics = None
+        self.plots_outdated = False
+        self.n_messages = 0  # messages since the last redraw
+
     def setup_widgets(self, parent, name):
         dock_area = DockArea()
         parent.addTab(dock_area, name)
@@ -47,7 +97,7 @@ class N2Cooling(Receiver):
         cw.setStyleSheet("QWidget {background-color:white}")
         layout = QtWidgets.QGridLayout()
         cw.setLayout(layout)
-        self.avg_sensor_temp_label = QtWidgets.QLabel("Mean sensor temperature over last %d s\n" % self.avg_window)
+        self.avg_sensor_temp_label = QtWidgets.QLabel("Mean temperature over last %d s\n" % self.avg_window)
         self.dewpoint_label = QtWidgets.QLabel("Dew point:\n-- C")
         self.last_timestamp_label = QtWidgets.QLabel("Last timestamp:\n%s" % "No data yet")
         self.avg_setting = Qt.QSpinBox()
@@ -57,11 +107,30 @@ class N2Cooling(Receiver):
         self.avg_setting.setPrefix("Average over ")
         self.avg_setting.setSuffix(" s")
         self.reset_button = QtWidgets.QPushButton("Reset")
+        self.metrics_label = QtWidgets.QLabel("Loop rate:\n-- Hz")
         layout.addWidget(self.avg_sensor_temp_label, 0, 0, 1, 1)
         layout.addWidget(self.avg_setting, 0, 1, 1, 1)
         layout.addWidget(self.dewpoint_label, 0, 2, 1, 1)
         layout.addWidget(self.last_timestamp_label, 0, 3, 1, 1)
         layout.addWidget(self.reset_button, 0, 4, 1, 1)
+        layout.addWidget(self.metrics_label, 1, 0, 1, 5)
+        if self.command_address:
+            self.setpoint_setting = QtWidgets.QDoubleSpinBox()
+            self.setpoint_setting.setRange(-60., 40.)
+            self.setpoint_setting.setDecimals(1)
+            self.setpoint_setting.setValue(-20.)
+            self.setpoint_setting.setPrefix("Setpoint ")
+            self.setpoint_setting.setSuffix(" C")
+            self.setpoint_button = QtWidgets.QPushButton("Set")
+            self.pause_button = QtWidgets.QPushButton("Pause")
+            self.pause_button.setCheckable(True)
+            self.control_label = QtWidgets.QLabel("Control:\n--")
+            layout.addWidget(self.setpoint_setting, 2, 0, 1, 1)
+            layout.addWidget(self.setpoint_button, 2, 1, 1, 1)
+            layout.addWidget(self.pause_button, 2, 2, 1, 1)
+            layout.addWidget(self.control_label, 2, 3, 1, 2)
+            self.setpoint_button.clicked.connect(lambda: self.send_cooling_command(cmd="setpoint", value=self.setpoint_setting.value()))
+            self.pause_button.toggled.connect(lambda paused: self.send_cooling_command(cmd="pause" if paused else "resume"))
         dock_status.addWidget(cw)
 
         # Connect widgets
@@ -84,34 +153,18 @@ class N2Cooling(Receiver):
 
         plot_humidity.setXLink(plot_temp)
 
-        self.temp_sensor_curve = pg.PlotCurveItem(pen=pg.mkPen(color=(181, 0, 15), width=2))
-        self.temp_box_curve = pg.PlotCurveItem(pen=pg.mkPen(color=(0, 181, 97), width=2))
-        self.humid_sensor_curve = pg.PlotCurveItem(pen=pg.mkPen((181, 0, 15), width=2))
-        self.valve_steering_curve=pg.PlotCurveItem(pen=pg.mkPen(color=((0,0,255)), width=2))
-
-
-        # add legend
+        # add legend, the curves are added for the channels of the converter (set_curves)
         legend_temp = pg.LegendItem(offset=(50, 1))
         legend_temp.setParentItem(plot_temp)
-        legend_temp.addItem(self.temp_sensor_curve, "Sensor temperature close to DUT")
-        legend_temp.addItem(self.temp_box_curve, "Box temperature with dry ice")
-        
         legend_humid_sensor = pg.LegendItem(offset=(50, 1))
         legend_humid_sensor.setParentItem(plot_humidity)
-        legend_humid_sensor.addItem(self.humid_sensor_curve, "Sensor humidity close to DUT")
-        # hat probleme gemacht
-        legend_temp.addItem(self.valve_steering_curve,"Valve steering")
 
-        # add items to plots and customize plots viewboxes
-        plot_temp.addItem(self.temp_sensor_curve)
-        plot_temp.addItem(self.temp_box_curve)
+        # customize plots viewboxes
         vb = plot_temp.vb.setBackgroundColor("#E6E5F4")
         plot_temp.getAxis("left").setZValue(0)
         plot_temp.getAxis("left").setGrid(155)
         plot_temp.getAxis("bottom").setStyle(showValues=False)
 
-        plot_humidity.addItem(self.humid_sensor_curve)
-        plot_humidity.addItem(self.valve_steering_curve)
         plot_humidity.vb.setBackgroundColor("#E6E5F4")
         plot_humidity.showGrid(x=True, y=True)
         plot_humidity.getAxis("left").setZValue(0)
@@ -121,47 +174,187 @@ class N2Cooling(Receiver):
         cooling_graphics.addItem(plot_humidity, row=1, col=1, rowspan=1, colspan=3)
         dock_values.addWidget(cooling_graphics)
 
-        # add dict of all used plotcurveitems for individual handling of each plot
-        self.plots = {
-            "temp_sensor": self.temp_sensor_curve,
-            "temp_box": self.temp_box_curve,
-            "humidity_sensor": self.humid_sensor_curve,
-            "valve_steering": self.valve_steering_curve
+        # request decimated history when the visible time range changes (delayed until zooming stopped)
+        self.plot_temp = plot_temp
+        self.history_timer = QtCore.QTimer()
+        self.history_timer.setSingleShot(True)
+        self.history_timer.timeout.connect(self.request_history)
+        plot_temp.sigXRangeChanged.connect(lambda: self.history_timer.start(300))
+
+        # plot and legend of each plot kind of the channels, dict of the plotdataitem of every shown channel
+        self.channel_plots = {
+            "temperature": (plot_temp, legend_temp),
+            "percent": (plot_humidity, legend_humid_sensor),
         }
+        self.plots = {}
+        self.curve_items = []  # (plot, legend, curve) to remove if the channels change
         self.plot_delay = 0
 
+        # redraw from a timer, not for every message
+        self.render_timer = QtCore.QTimer()
+        self.render_timer.timeout.connect(self.render)
+        self.render_timer.start(int(1000. / self.max_fps))
+
     def deserialize_data(self, data):
         _, meta = utils.simple_dec(data)
         return meta
 
+    def reset_buffers(self):
+        # values of all channels (channels x time)
+        self.time_buffer = RingBuffer(self.n_values)
+        self.buffers = ChannelBuffer(len(self.channel_names), self.n_values)
+
+    def set_curves(self):
+        ''' One curve per plotted channel, in the plot of its kind (temperature or percent) '''
+        for plot, legend, curve in self.curve_items:
+            plot.removeItem(curve)
+            legend.removeItem(curve)
+        self.plots, self.curve_items = {}, []
+        for i, channel in enumerate(self.description["channels"]):
+            if channel.get("plot") not in self.channel_plots:
+                continue
+            plot, legend = self.channel_plots[channel["plot"]]
+            color = tuple(channel["color"]) if channel.get("color") else pg.intColor(i, hues=len(self.channel_names))
+            # only the visible part is drawn, with min/max (peak) downsampling to about the pixel width
+            curve = pg.PlotDataItem(pen=pg.mkPen(color=color, width=2))
+            curve.setClipToView(True)
+            curve.setDownsampling(auto=True, method="peak")
+            plot.addItem(curve)
+            legend.addItem(curve, channel.get("label", channel["name"]))
+            self.plots[channel["name"]] = curve
+            self.curve_items.append((plot, legend, curve))
+
+    def request_snapshot(self):
+        # do not request again while waiting for the answer
+        if self.snapshot_requested is None or time.time() - self.snapshot_requested > 5.:
+            self.snapshot_requested = time.time()
+            self.send_command("SNAPSHOT")
+
+    def request_history(self, force=False):
+        if force and time.time() - self.history_request_time < 5.:
+            return  # answer still pending
+        t_min, t_max = self.plot_temp.vb.viewRange()[0]
+        timestamps = self.time_buffer.data()
+        if not force and self.history is None and len(timestamps) and timestamps[0] <= t_min:
+            return  # own history is sufficient
+        if not force and self.history_requested is not None:
+            last_min, last_max = self.history_requested
+            span = max(t_max - t_min, 1e-3)
+            if abs(t_min - last_min) < 0.1 * span and abs(t_max - last_max) < 0.1 * span:
+                return  # same range already requested
+        self.history_requested = (t_min, t_max)
+        self.history_request_time = time.time()
+        self.send_command("HISTORY %f %f %d" % (t_min, t_max, self.history_points))
+
+    def history_curve(self, key, t_max):
+        ''' Min/max envelope of the decimated history of channel key before t_max as (time, values) '''
+        if self.history is None or key not in self.history["channels"]:
+            return np.empty(0), np.empty(0)
+        channel = self.history["channels"][key]
+        resolution = self.history["resolution"]
+        selection = self.history["time"] + resolution <= t_max
+        # every bucket is drawn as vertical line from minimum to maximum at its center
+        times = np.repeat(self.history["time"][selection] + resolution / 2., 2)
+        values = np.column_stack((channel["min"][selection], channel["max"][selection])).ravel()
+        return times, values
+
+    def update_buffers(self, data):
+        if data.get("type", "snapshot") == "snapshot":
+            if data["channels"] != self.description:
+                self.description = data["channels"]
+                self.channel_names = [channel["name"] for channel in self.description["channels"]]
+                self.channels_outdated = True
+            self.reset_buffers()
+            self.snapshot_requested = None
+            self.history, self.history_requested = None, None
+        elif self.last_sequence is None or data["seq"] != self.last_sequence + 1:
+            # missed messages, new values are still valid but history is incomplete
+            self.request_snapshot()
+        self.last_sequence = data.get("seq")
+        if len(data["values"]) != len(self.channel_names):
+            return  # channels changed, wait for the snapshot
+
+        self.time_buffer.extend(data["time"])
+        if data.get("history") is not None:
+            self.history = data["history"]
+        self.buffers.extend(data["values"])
+
+    def update_metrics(self, metrics):
+        ''' Show loop rate and median / 99th percentile latency of every stage of the control loop '''
+        stages = metrics["stages"]
+        text = "Loop rate: %.2f Hz" % stages["cycle"]["rate"] if "cycle" in stages else "Loop rate: -- Hz"
+        text += "\n" + "   ".join("%s: %.1f / %.1f ms" % (stage, values["p50"] * 1e3, values["p99"] * 1e3)
+                                   for stage, values in sorted(stages.items()) if values["count"])
+        self.metrics_label.setText(text)
+
     def handle_data_if_active(self, data):
-        # look for TLU data in data stream
-        print("in handler")
-        if "temp" in data:
-            for key in data["temp"]:
-                print("laengen")
-                print(len(data['time']),'VS',len(data['temp'][key]))
-                print(len(data['time']),'VS',len(data['temp'][key]))
-                self.plots[key].setData(data["time"], data["temp"][key], autoDownsample=True)
-                print(data)
-                # print('VALUES')
-                # print(data['temp'][key])
-                # print(np.arange(len(data["temp"][key])))
-        if "humidity" in data:
-            for key in data["humidity"]:
-                self.plots[key].setData(data["time"], data["humidity"][key], autoDownsample=True)
+        # only collect, render() draws the latest state
+        self.n_messages += 1
+        if data.get("type") == "metrics":
+            self.pending_metrics = data["metrics"]
+            return
+        self.update_buffers(data)
+        self.pending_stats = data["stats"]
+        self.plots_outdated = True
+
+    def render(self):
+        ''' Draw curves and labels if messages arrived since the last call '''
+        if self.pending_metrics is not None:
+            self.update_metrics(self.pending_metrics)
+            self.pending_metrics = None
+        if not self.plots_outdated:
+            return
+        self.plots_outdated = False
+        start = perf_counter()
+        if self.channels_outdated:
+            self.channels_outdated = False
+            self.set_curves()
+
+        timestamps = self.time_buffer.data()
+        rows = self.buffers.data()
+        for i, name in enumerate(self.channel_names):
+            if name not in self.plots:
+                continue
+            times, values = timestamps, rows[i]
+            if self.history is not None:
+                # older part from the decimated history
+                history_times, history_values = self.history_curve(name, times[0] if len(times) else np.inf)
+                times, values = np.concatenate((history_times, times)), np.concatenate((history_values, values))
+            self.plots[name].setData(times, values)
+
+        # own history moved past the end of the decimated history, fill the gap
+        if self.history is not None and len(self.history["time"]) and len(timestamps):
+            if self.history["time"][-1] + 2 * self.history["resolution"] < timestamps[0]:
+                self.request_history(force=True)
 
         # set timestamp, plot delay and readour rate
-        self.avg_sensor_temp_label.setText(
-            "Mean sensor temperature over last %d s:\n%.2f C"
-            % (self.avg_window, data["stats"]["avg"]["temp_sensor_avg"])
-        )
-        self.dewpoint_label.setText("Dew point:\n%.1f C" % data["stats"]["dp"])
-        self.last_timestamp_label.setText(
-            "Last timestamp:\n%s" % datetime.fromtimestamp(data["stats"]["last_timestamp"]).strftime("%x %X")
-        )
-        # now = ptime.time()
-        now=perf_counter()
+        stats = self.pending_stats
+        control = stats.get("control")
+        if control in stats["avg"]:
+            label = self.description["channels"][self.channel_names.index(control)].get("label", control)
+            self.avg_sensor_temp_label.setText("Mean %s over last %d s:\n%.2f C" % (label, self.avg_window, stats["avg"][control]))
+        self.dewpoint_label.setText("Dew point:\n%s C" % ("--" if stats["dp"] is None else "%.1f" % stats["dp"]))
+        text = "Last timestamp:\n%s" % datetime.fromtimestamp(stats["last_timestamp"]).strftime("%x %X")
+        pipeline = stats.get("pipeline")
+        if pipeline is not None:
+            text += "\nDelay %.1f s, dropped %d, conflated %d" % (pipeline["delay"], pipeline["dropped"] + pipeline["backend_dropped"],
+                                                               pipeline["conflated"])
+        self.last_timestamp_label.setText(text)
+        self.log.debug("Redraw of %d points for %d messages in %.1f ms", len(timestamps), self.n_messages, (perf_counter() - start) * 1e3)
+        self.n_messages = 0
+
+    def send_cooling_command(self, **command):
+        ''' Send command to cooling.py (not to the converter) and show its state '''
+        try:
+            reply = send_command(self.command_address, command, timeout=0.5)
+        except IOError as e:
+            self.control_label.setText("Control:\n%s" % e)
+            return
+        if not reply.get("ok"):
+            self.control_label.setText("Control:\n%s" % reply.get("error"))
+            return
+        self.control_label.setText("Control: %s\nSetpoint %.1f C" % ("paused" if reply["paused"] else "running", reply["setpoint"]))
+
     def _update_avg_window(self, value):
         self.avg_window = value
         self.send_command(str(value))
@@ -0,0 +1,168 @@
+import time
+import logging
+import argparse
+import yaml
+import zmq
+import numpy as np
+import tables as tb
+
+from online_monitor.utils import utils
+from n2_cooling.cooling import send_data
+
+
+def read_chunks(filename, chunk_size=1000, table_name='temperature'):
+    ''' Yield the rows of the temperature table of a measurement file (or of all segments of a run catalog) in chunks '''
+    from n2_cooling.segments import is_catalog, SegmentReader
+
+    if is_catalog(filename):
+        for rows in SegmentReader(filename).read_chunks(chunk_size):
+            yield rows
+        return
+    with tb.open_file(filename, 'r') as in_file:
+        table = in_file.get_node(in_file.root, table_name)
+        for start in range(0, table.nrows, chunk_size):
+            yield table.read(start, start + chunk_size)
+
+
+def frontend_from_config(config_file):
+    ''' Frontend address of the first converter in the online monitor configuration '''
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    return next(iter(config['converter'].values()))['frontend']
+
+
+class Replay(object):
+    '''
+    Publishes recorded measurements with the same wire format as cooling.py. With speed > 0 the
+    recorded timing is reproduced speed times faster, speed = 0 sends as fast as possible.
+    If the converter backend is given, the processed messages are counted to measure the message
+    rate the converter can sustain (do not connect a receiver at the same time, the converter
+    distributes its messages to all connected receivers).
+    '''
+
+    def __init__(self, frontend, backend=None, speed=1., chunk_size=1000, hwm=1000, report_interval=1.):
+        self.log = logging.getLogger('Replay')
+        self.speed = speed
+        self.chunk_size = chunk_size
+        self.report_interval = report_interval
+
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.set_hwm(hwm)
+        self.socket.bind(frontend)
+        self.log.info('Sending data to %s', frontend)
+
+        self.backend = None
+        if backend:
+            self.backend = self.context.socket(zmq.DEALER)
+            self.backend.connect(backend)
+            self.log.info('Counting converter output at %s', backend)
+
+        self.n_sent = 0
+        self.n_received = 0
+        self.n_missed = 0  # gaps in the sequence numbers of the converter
+        self._last_sequence = None
+        self.pipeline = None  # message counters of the converter
+
+    def _receive(self):
+        while True:
+            try:
+                message = self.backend.recv(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.n_received += 1
+            meta_data = utils.simple_dec(message)[1]
+            sequence = meta_data.get('seq')
+            self.pipeline = meta_data.get('stats', {}).get('pipeline', self.pipeline)
+            if sequence is not None and self._last_sequence is not None and sequence > self._last_sequence + 1:
+                self.n_missed += sequence - self._last_sequence - 1
+            self._last_sequence = sequence
+
+    def run(self, files):
+        time.sleep(1.)  # give subscribers time to connect
+        start = time.perf_counter()
+        last_report, last_sent, last_received = start, 0, 0
+        first_timestamp = None
+        for filename in files:
+            self.log.info('Replaying %s', filename)
+            for rows in read_chunks(filename, self.chunk_size):
+                timestamps = rows['timestamp'].astype(np.float64)
+                if first_timestamp is None and len(rows):
+                    first_timestamp = timestamps[0]
+                for index, timestamp in enumerate(timestamps):
+                    if self.speed > 0:
+                        delay = (timestamp - first_timestamp) / self.speed - (time.perf_counter() - start)
+                        if delay > 0:
+                            time.sleep(delay)
+                    self.n_sent += 1
+                    send_data(self.socket, rows[index:index + 1], sequence=self.n_sent)
+                    if self.backend is not None:
+                        self._receive()
+                    now = time.perf_counter()
+                    if now - last_report > self.report_interval:
+                        self.log.info('Sent %.0f msg/s, converter processed %.0f msg/s', (self.n_sent - last_sent) / (now - last_report),
+                                      (self.n_received - last_received) / (now - last_report))
+                        last_report, last_sent, last_received = now, self.n_sent, self.n_received
+
+        # collect converter output of the last messages
+        if self.backend is not None:
+            end = time.perf_counter() + 2.
+            while time.perf_counter() < end:
+                self._receive()
+                time.sleep(0.01)
+        duration = time.perf_counter() - start
+        return {
+            'sent': self.n_sent,
+            'received': self.n_received,
+            'missed': self.n_missed,
+            'pipeline': self.pipeline,
+            'duration': duration,
+            'sent_rate': self.n_sent / duration,
+            'received_rate': self.n_received / duration,
+        }
+
+    def close(self):
+        self.socket.close()
+        if self.backend is not None:
+            self.backend.close()
+        self.context.term()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay measurement files to the online monitor',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('files', nargs='+',
+                        help="Measurement files (measurement_*.h5) or run catalogs (*.catalog.json)")
+    parser.add_argument('--speed', type=float, default=1.,
+                        help="Speed-up of the recorded timing, 0 sends as fast as possible")
+    parser.add_argument('--config', type=str, default=None,
+                        help="Online monitor configuration to take the frontend address from")
+    parser.add_argument('--frontend', type=str, default="tcp://127.0.0.1:5000",
+                        help="Address to publish data on")
+    parser.add_argument('--backend', type=str, default=None,
+                        help="Converter backend to count processed messages (no receiver connected)")
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help="Rows read at once from the file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)-15s] - %(levelname)-7s %(message)s')
+    frontend = frontend_from_config(args.config) if args.config else args.frontend
+
+    replay = Replay(frontend, backend=args.backend, speed=args.speed, chunk_size=args.chunk_size)
+    try:
+        results = replay.run(args.files)
+    finally:
+        replay.close()
+    logging.info('Sent %d messages in %.1f s (%.0f msg/s)', results['sent'], results['duration'], results['sent_rate'])
+    if args.backend:
+        logging.info('Converter processed %d messages (%.0f msg/s), %d missed',
+                     results['received'], results['received_rate'], results['missed'])
+        if results['pipeline'] is not None:
+            logging.info('Converter: %(dropped)d dropped, %(conflated)d conflated, %(backend_dropped)d not taken by receivers, '
+                         'display delay %(delay).2f s', results['pipeline'])
+
+
+if __name__ == "__main__":
+    main()
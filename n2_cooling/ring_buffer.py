@@ -0,0 +1,157 @@
+import math
+from collections import deque
+import numpy as np
+
+
+class RingBuffer(object):
+    '''
+    Fixed capacity circular buffer on a preallocated NumPy array. Appending is O(1), the oldest
+    value is overwritten once the buffer is full. Every entry can itself be an array of the given shape.
+    '''
+
+    def __init__(self, capacity, dtype='f8', shape=()):
+        self.capacity = capacity
+        shape = (capacity,) + tuple(shape)
+        self._data = np.full(shape, np.nan, dtype=dtype) if np.dtype(dtype).kind == 'f' else np.zeros(shape, dtype=dtype)
+        self.n_total = 0  # number of values appended since creation
+
+    def __len__(self):
+        return min(self.n_total, self.capacity)
+
+    def append(self, value):
+        self._data[self.n_total % self.capacity] = value
+        self.n_total += 1
+
+    def extend(self, values):
+        values = np.asarray(values)[-self.capacity:]
+        indices = (self.n_total + np.arange(len(values))) % self.capacity
+        self._data[indices] = values
+        self.n_total += len(values)
+
+    def data(self, n=None):
+        ''' Copy of the last n (default all) values in chronological order '''
+        n = len(self) if n is None else min(n, len(self))
+        start = (self.n_total - n) % self.capacity
+        if start + n <= self.capacity:
+            return self._data[start:start + n].copy()
+        return np.concatenate((self._data[start:], self._data[:start + n - self.capacity]))
+
+    @property
+    def last(self):
+        if self.n_total == 0:
+            return None
+        return self._data[(self.n_total - 1) % self.capacity]
+
+
+class ChannelBuffer(object):
+    '''
+    Circular buffer of the values of several channels, stored channels x time. The history of every
+    channel and the chronological copy of all channels are contiguous, appending writes one column per value.
+    '''
+
+    def __init__(self, n_channels, capacity, dtype='f8'):
+        self.capacity = capacity
+        self._data = np.full((n_channels, capacity), np.nan, dtype=dtype)
+        self.n_total = 0
+
+    def __len__(self):
+        return min(self.n_total, self.capacity)
+
+    @property
+    def n_channels(self):
+        return self._data.shape[0]
+
+    def extend(self, values):
+        ''' Append values of all channels (channels x time) '''
+        values = np.asarray(values)[:, -self.capacity:]
+        n = values.shape[1]
+        start = self.n_total % self.capacity
+        first = min(n, self.capacity - start)
+        self._data[:, start:start + first] = values[:, :first]
+        self._data[:, :n - first] = values[:, first:]
+        self.n_total += n
+
+    def data(self, n=None):
+        ''' Copy of the last n (default all) values of all channels in chronological order (channels x time) '''
+        n = len(self) if n is None else min(n, len(self))
+        start = (self.n_total - n) % self.capacity
+        if start + n <= self.capacity:
+            return self._data[:, start:start + n].copy()
+        return np.concatenate((self._data[:, start:], self._data[:, :start + n - self.capacity]), axis=1)
+
+
+class WindowStats(object):
+    '''
+    Mean, standard deviation, minimum and maximum of all values of the last window seconds.
+    Every value is added and removed once (running sums and monotonic queues), so the cost per
+    sample does not depend on the window length. Non-finite values are ignored.
+    '''
+
+    def __init__(self, window):
+        self.window = window
+        self.clear()
+
+    def clear(self):
+        self._values = deque()  # (timestamp, value)
+        self._min = deque()  # increasing values, candidates for minimum
+        self._max = deque()  # decreasing values, candidates for maximum
+        self._sum = 0.
+        self._sum_sq = 0.
+
+    def add(self, timestamp, value):
+        if not math.isfinite(value):
+            return
+        self._values.append((timestamp, value))
+        self._sum += value
+        self._sum_sq += value * value
+        while self._min and self._min[-1][1] > value:
+            self._min.pop()
+        self._min.append((timestamp, value))
+        while self._max and self._max[-1][1] < value:
+            self._max.pop()
+        self._max.append((timestamp, value))
+        self._evict(timestamp - self.window)
+
+    def _evict(self, oldest):
+        while self._values and self._values[0][0] < oldest:
+            _, value = self._values.popleft()
+            self._sum -= value
+            self._sum_sq -= value * value
+        while self._min and self._min[0][0] < oldest:
+            self._min.popleft()
+        while self._max and self._max[0][0] < oldest:
+            self._max.popleft()
+        if not self._values:  # avoid drift of the running sums
+            self._sum, self._sum_sq = 0., 0.
+
+    def set_window(self, window, timestamps=(), values=()):
+        ''' Change window length, statistics are rebuilt from the given history '''
+        self.window = window
+        self.clear()
+        for timestamp, value in zip(timestamps, values):
+            self.add(timestamp, value)
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def mean(self):
+        return self._sum / len(self._values) if self._values else np.nan
+
+    @property
+    def std(self):
+        if not self._values:
+            return np.nan
+        mean = self.mean
+        return math.sqrt(max(self._sum_sq / len(self._values) - mean * mean, 0.))
+
+    @property
+    def min(self):
+        return self._min[0][1] if self._min else np.nan
+
+    @property
+    def max(self):
+        return self._max[0][1] if self._max else np.nan
+
+    def stats(self):
+        return {'mean': self.mean, 'std': self.std, 'min': self.min, 'max': self.max}
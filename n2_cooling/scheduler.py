@@ -0,0 +1,144 @@
+import time
+import logging
+import concurrent.futures
+
+
+class IOScheduler(object):
+    '''
+    Runs the I/O of every device in its own worker thread. Requests to the same device are executed
+    in the order they were submitted, requests to different devices run in parallel.
+
+    snapshot() submits the requests of one control cycle to all devices and waits for them, so the
+    cycle takes as long as the slowest device. A stalled device does not block the others: its
+    last value is returned and it is reported as stale.
+    '''
+
+    def __init__(self, devices=(), timeout=5.):
+        self.log = logging.getLogger('IOScheduler')
+        self.timeout = timeout  # max time to wait for a snapshot (s)
+        self.workers = {}
+        self.values = {}  # last valid result of every request
+        self.timestamps = {}  # time of last valid result of every request
+        self._pending = {}
+        for device in devices:
+            self.add_device(device)
+
+    def add_device(self, device):
+        if device not in self.workers:
+            self.workers[device] = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=device)
+        return self.workers[device]
+
+    def submit(self, device, func, *args, **kwargs):
+        ''' Queue func(*args, **kwargs) on the worker of device, returns a Future '''
+        return self.add_device(device).submit(func, *args, **kwargs)
+
+    def snapshot(self, requests, timeout=None):
+        '''
+        Execute requests of one cycle and wait for all results.
+
+        requests: dict of name and (device, func, *args)
+        Returns (values, stale): dict of name and result, and list of names without new result.
+        A request that is still running from an earlier cycle is not submitted again.
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        for name, (device, func, *args) in requests.items():
+            if name in self._pending and not self._pending[name].done():
+                continue
+            self._pending[name] = self.submit(device, func, *args)
+
+        futures = [self._pending[name] for name in requests]
+        concurrent.futures.wait(futures, timeout=timeout)
+
+        stale = []
+        now = time.time()
+        for name in requests:
+            future = self._pending[name]
+            if not future.done():
+                self.log.warning('Request %s not finished within %.1f s', name, timeout)
+                stale.append(name)
+                continue
+            del self._pending[name]
+            try:
+                self.values[name] = future.result()
+                self.timestamps[name] = now
+            except Exception as e:
+                self.log.warning('Request %s failed: %s', name, e)
+                stale.append(name)
+        return dict((name, self.values.get(name)) for name in requests), stale
+
+    def shutdown(self, wait=False):
+        for worker in self.workers.values():
+            worker.shutdown(wait=wait)
+        self.workers = {}
+
+
+class CycleTimer(object):
+    '''
+    Starts control cycles at a fixed period on a grid of monotonic deadlines (start + n * period),
+    so sleep inaccuracies and cycle durations do not add up. A cycle which does not finish before the
+    next deadline is an overrun, the missed deadlines are skipped instead of running cycles back to
+    back. Jitter (wake-up time after the deadline) and the real time between cycle starts are
+    recorded in the metrics as 'jitter' and 'period'.
+    '''
+
+    def __init__(self, period, metrics=None):
+        from n2_cooling.metrics import Metrics
+
+        if period <= 0:
+            raise ValueError('Period has to be positive')
+        self.log = logging.getLogger('CycleTimer')
+        self.period = period
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.deadline = None  # start of the current cycle
+        self.cycle_start = None  # actual start of the current cycle
+        self.dt = period  # time since start of the last cycle (s)
+        self.n_cycles = 0
+        self.n_overruns = 0
+        self.n_missed = 0  # deadlines skipped because of overruns
+
+    def wait(self):
+        ''' Sleep until the start of the next cycle, returns the time since the start of the last cycle '''
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        else:
+            self.deadline += self.period
+            if now > self.deadline:
+                # overrun, continue at the next deadline in the future without catching up
+                missed = int((now - self.deadline) // self.period) + 1
+                self.n_overruns += 1
+                self.n_missed += missed
+                self.metrics.count('overruns')
+                self.metrics.count('missed_cycles', missed)
+                self.log.debug('Cycle overrun by %.3f s', now - self.deadline + self.period)
+                self.deadline += missed * self.period
+            time.sleep(max(self.deadline - time.monotonic(), 0.))
+
+        start = time.monotonic()
+        self.metrics.observe('jitter', start - self.deadline)
+        if self.cycle_start is not None:
+            self.dt = start - self.cycle_start
+            self.metrics.observe('period', self.dt)
+        self.cycle_start = start
+        self.n_cycles += 1
+        return self.dt
+
+    def elapsed(self):
+        ''' Time since the deadline of the current cycle '''
+        return time.monotonic() - self.deadline
+
+    def late(self, fraction=1.):
+        ''' Current cycle took longer than fraction of the period, non-critical stages should be skipped '''
+        return self.elapsed() > fraction * self.period
+
+    def stats(self):
+        jitter = self.metrics.histogram('jitter')
+        return {
+            'period': self.period,
+            'cycles': self.n_cycles,
+            'overruns': self.n_overruns,
+            'missed': self.n_missed,
+            'jitter_p50': jitter.percentile(50),
+            'jitter_p99': jitter.percentile(99),
+            'jitter_max': jitter.max,
+        }
@@ -0,0 +1,304 @@
+'''
+Measurement runs split into segment files. The writer starts a new file when the current one reaches
+max_size bytes or is older than max_interval seconds. A small catalog next to the segments
+(<run>.catalog.json) lists every segment with its time range and row count:
+
+    {"run": "measurement_box1", "table": "temperature", "dtype": [...],
+     "segments": [{"file": "measurement_box1_0000.h5", "t_min": 1620820800.1, "t_max": 1620907199.8,
+                   "rows": 172799, "open": false}, ...]}
+
+A restarted run with the same name continues the catalog with a new segment. Segments which were still
+open (e.g. after a crash) are scanned once and closed. SegmentReader reads the segments of a catalog as
+one time ordered table, only the segments overlapping the requested time range are opened.
+'''
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+import numpy as np
+import tables as tb
+
+from n2_cooling.storage import TableWriter, hdf5_lock, read_time_range, time_range_rows
+
+CATALOG_SUFFIX = '.catalog.json'
+
+
+def is_catalog(filename):
+    return filename.endswith(CATALOG_SUFFIX)
+
+
+def catalog_file(run, directory='.'):
+    return os.path.join(directory, run + CATALOG_SUFFIX)
+
+
+class Catalog(object):
+    ''' Segments of a run, kept in a JSON file which is replaced atomically on every change '''
+
+    def __init__(self, filename, run=None, table_name='temperature'):
+        self.filename = filename
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.data = json.load(f)
+        else:
+            run = run or os.path.basename(filename)[:-len(CATALOG_SUFFIX)]
+            self.data = {'run': run, 'table': table_name, 'dtype': None, 'segments': []}
+
+    @property
+    def run(self):
+        return self.data['run']
+
+    @property
+    def table_name(self):
+        return self.data['table']
+
+    @property
+    def segments(self):
+        return self.data['segments']
+
+    @property
+    def dtype(self):
+        if self.data['dtype'] is None:
+            return None
+        return np.lib.format.descr_to_dtype([tuple(field) for field in self.data['dtype']])
+
+    def path(self, segment):
+        return os.path.join(self.directory, segment['file'])
+
+    def save(self):
+        with self._lock:
+            temporary = self.filename + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(self.data, f, indent=1)
+            os.replace(temporary, self.filename)
+
+    def recover(self, time_column='timestamp'):
+        ''' Close segments left open by a run which did not end cleanly, with their rows and time range '''
+        changed = False
+        for segment in list(self.segments):
+            if not segment.get('open'):
+                continue
+            changed = True
+            path = self.path(segment)
+            if not os.path.exists(path):
+                self.segments.remove(segment)
+                continue
+            try:
+                with hdf5_lock, tb.open_file(path, 'r') as in_file:
+                    table = in_file.get_node(in_file.root, self.table_name)
+                    segment['rows'] = int(table.nrows)
+                    if table.nrows:
+                        segment['t_min'] = float(table.read(0, 1, field=time_column)[0])
+                        segment['t_max'] = float(table.read(table.nrows - 1, table.nrows, field=time_column)[0])
+            except (IOError, tb.NoSuchNodeError, tb.HDF5ExtError) as e:
+                logging.getLogger('Catalog').warning('Cannot read segment %s: %s', path, e)
+            segment['open'] = False
+        if changed:
+            self.save()
+
+
+class RotatingWriter(object):
+    '''
+    TableWriter which continues in a new segment file <run>_<number>.h5 (with text mirror <run>_<number>.txt
+    if text is set, run can include a directory relative to directory) when the current one reaches max_size
+    bytes or is older than max_interval seconds (None: no limit). Segments are recorded in the catalog of the
+    run. The previous segment is closed in a thread, so rotating does not delay append by more than creating
+    the next file (HDF5 calls of both are serialized by storage.hdf5_lock). The segment is closed in the
+    catalog when the writer is closed, also at interpreter exit.
+    '''
+
+    def __init__(self, run, dtype, directory='.', max_size=None, max_interval=None, text=False, text_columns=None,
+                 table_name='temperature', time_column='timestamp', size_check_interval=1., catalog_interval=60.,
+                 **writer_kwargs):
+        self.log = logging.getLogger('RotatingWriter')
+        # segments and catalog are in the directory of the run, the catalog lists the file names only
+        self.run = os.path.basename(run)
+        self.directory = os.path.join(directory, os.path.dirname(run))
+        os.makedirs(self.directory, exist_ok=True)
+        self.dtype = np.dtype(dtype)
+        self.max_size = max_size
+        self.max_interval = max_interval
+        self.text = text
+        self.text_columns = text_columns
+        self.table_name = table_name
+        self.time_column = time_column
+        self.size_check_interval = size_check_interval  # getsize is not called on every append (s)
+        self.catalog_interval = catalog_interval  # progress of the open segment is saved this often (s)
+        self.writer_kwargs = writer_kwargs
+
+        self.catalog = Catalog(catalog_file(self.run, self.directory), run=self.run, table_name=table_name)
+        self.catalog.recover(time_column)
+        descr = json.loads(json.dumps(np.lib.format.dtype_to_descr(self.dtype)))  # as stored in the catalog
+        if self.catalog.data['dtype'] is None:
+            self.catalog.data['dtype'] = descr
+        elif self.catalog.data['dtype'] != descr:
+            raise ValueError('Run %s was written with other columns, use a new run name' % run)
+
+        self.writer = None
+        self.segment = None
+        self._closing = []  # threads closing previous segments
+        self._closed = False
+        self._open_segment()
+        atexit.register(self.close)
+
+    @property
+    def output_file(self):
+        return self.writer.output_file
+
+    @property
+    def table(self):
+        return self.writer.table
+
+    @property
+    def filename(self):
+        return self.catalog.path(self.segment)
+
+    def _open_segment(self):
+        numbers = [int(os.path.splitext(segment['file'])[0].rsplit('_', 1)[1]) for segment in self.catalog.segments]
+        name = '%s_%04d' % (self.run, max(numbers) + 1 if numbers else 0)
+        self.segment = {'file': name + '.h5', 't_min': None, 't_max': None, 'rows': 0, 'open': True}
+        self.writer = TableWriter(os.path.join(self.directory, name + '.h5'), self.dtype, table_name=self.table_name,
+                                  text_file=os.path.join(self.directory, name + '.txt') if self.text else None,
+                                  text_columns=self.text_columns, **self.writer_kwargs)
+        self._opened = time.time()
+        self._size_checked = self._catalog_saved = time.monotonic()
+        self.catalog.segments.append(self.segment)
+        self.catalog.save()
+        self.log.info('Writing %s', self.filename)
+
+    def _close_segment(self, writer, segment):
+        writer.close()
+        segment['open'] = False
+        self.catalog.save()
+
+    def rotation_due(self):
+        if not self.segment['rows']:
+            return False
+        if self.max_interval is not None and time.time() - self._opened >= self.max_interval:
+            return True
+        if self.max_size is not None and time.monotonic() - self._size_checked >= self.size_check_interval:
+            self._size_checked = time.monotonic()
+            return os.path.getsize(self.filename) >= self.max_size
+        return False
+
+    def rotate(self):
+        ''' Continue in a new segment, the current one is closed in the background '''
+        writer, segment = self.writer, self.segment
+        self._open_segment()
+        thread = threading.Thread(target=self._close_segment, args=(writer, segment), name='SegmentClose', daemon=True)
+        thread.start()
+        self._closing = [t for t in self._closing if t.is_alive()] + [thread]
+
+    def append(self, row):
+        ''' Add one row (record or tuple in order of dtype) '''
+        if self.rotation_due():
+            self.rotate()
+        self.writer.append(row)
+        timestamp = float(row[self.time_column] if hasattr(row, 'dtype') else row[self.dtype.names.index(self.time_column)])
+        if self.segment['t_min'] is None:
+            self.segment['t_min'] = timestamp
+        self.segment['t_max'] = timestamp
+        self.segment['rows'] += 1
+        if time.monotonic() - self._catalog_saved >= self.catalog_interval:
+            self._catalog_saved = time.monotonic()
+            self.catalog.save()
+
+    def flush(self):
+        ''' Write all buffered rows and record the progress of the open segment in the catalog '''
+        self.writer.flush()
+        self.catalog.save()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for thread in self._closing:
+            thread.join()
+        self._close_segment(self.writer, self.segment)
+        atexit.unregister(self.close)
+
+
+class SegmentReader(object):
+    '''
+    Segments of a run (catalog file) read as one table. Rows are in time order, a time range opens
+    only the segments overlapping it and reads them with the timestamp index.
+    '''
+
+    def __init__(self, filename, time_column='timestamp'):
+        self.catalog = Catalog(filename)
+        self.time_column = time_column
+
+    @property
+    def dtype(self):
+        return self.catalog.dtype
+
+    def __len__(self):
+        return sum(segment['rows'] for segment in self.catalog.segments)
+
+    @property
+    def time_range(self):
+        ''' First and last timestamp of the run (open segments: as of the last catalog update) '''
+        segments = [segment for segment in self.catalog.segments if segment['rows']]
+        if not segments:
+            return None, None
+        return segments[0]['t_min'], segments[-1]['t_max']
+
+    def files(self, t_min=None, t_max=None):
+        ''' Segment files with rows in t_min <= timestamp < t_max, open segments are always included '''
+        files = []
+        for segment in self.catalog.segments:
+            if not segment.get('open'):
+                if not segment['rows']:
+                    continue
+                if t_min is not None and segment['t_max'] < t_min:
+                    continue
+                if t_max is not None and segment['t_min'] >= t_max:
+                    continue
+            files.append(self.catalog.path(segment))
+        return files
+
+    def read_chunks(self, chunk_size=100000, t_min=None, t_max=None):
+        ''' Yield the rows with t_min <= timestamp < t_max in chunks of at most chunk_size rows '''
+        for filename in self.files(t_min, t_max):
+            with tb.open_file(filename, 'r') as in_file:
+                table = in_file.get_node(in_file.root, self.catalog.table_name)
+                start, stop = time_range_rows(table, t_min, t_max, self.time_column)
+                for chunk_start in range(start, stop, chunk_size):
+                    yield table.read(chunk_start, min(chunk_start + chunk_size, stop))
+
+    def read(self, t_min=None, t_max=None, field=None):
+        ''' Rows (or only field) with t_min <= timestamp < t_max as one array '''
+        parts = []
+        for filename in self.files(t_min, t_max):
+            with tb.open_file(filename, 'r') as in_file:
+                table = in_file.get_node(in_file.root, self.catalog.table_name)
+                parts.append(read_time_range(table, t_min, t_max, field=field, column=self.time_column))
+        if not parts:
+            empty = np.zeros(0, dtype=self.dtype)
+            return empty if field is None else empty[field]
+        return np.concatenate(parts)
+
+    def tail(self, duration, t_max=None, field=None):
+        ''' Rows of the last duration seconds (before t_max), only the last segments are opened '''
+        _, t_end = self.time_range
+        if t_end is None:
+            return self.read(t_max=t_max, field=field)
+        if t_max is not None:
+            t_end = min(t_end, t_max)
+        return self.read(t_min=t_end - duration, t_max=t_max, field=field)
+
+    def export(self, filename, t_min=None, t_max=None, chunk_size=100000,
+               filters=tb.Filters(complevel=5, complib='blosc')):
+        ''' Copy the rows with t_min <= timestamp < t_max into one measurement file, returns the number of rows '''
+        n_rows = 0
+        with tb.open_file(filename, 'w') as out_file:
+            table = out_file.create_table(out_file.root, name=self.catalog.table_name, description=self.dtype,
+                                          filters=filters)
+            for rows in self.read_chunks(chunk_size, t_min, t_max):
+                table.append(rows)
+                n_rows += len(rows)
+            table.colinstances[self.time_column].create_index()
+        return n_rows
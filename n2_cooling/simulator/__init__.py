@@ -0,0 +1,4 @@
+from n2_cooling.simulator.plant import ThermalModel
+from n2_cooling.simulator.devices import VirtualArduino, VirtualBronkhorst
+
+__all__ = ['ThermalModel', 'VirtualArduino', 'VirtualBronkhorst']
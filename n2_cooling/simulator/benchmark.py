@@ -0,0 +1,177 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import contextlib
+import numpy as np
+
+from n2_cooling.cooling import Cooling
+from n2_cooling.simulator.plant import ThermalModel
+from n2_cooling.simulator.devices import VirtualArduino, VirtualBronkhorst
+
+
+def timed(func, latencies):
+    ''' Wrap func to append its execution time to the list latencies '''
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def settling_time(times, values, setpoint, tolerance):
+    ''' First time after which all values stay within setpoint +- tolerance, None if never '''
+    outside = np.nonzero(np.abs(np.asarray(values) - setpoint) > tolerance)[0]
+    if len(outside) == 0:
+        return times[0] if len(times) else None
+    if outside[-1] == len(values) - 1:
+        return None
+    return times[outside[-1] + 1]
+
+
+def run_benchmark(duration=60., setpoint=-20., speedup=60., arduino_delay=0.5, bronkhorst_delay=0.002,
+                  streaming=True, tolerance=0.5, period=0.5, bus_errors=0., pid_parameters=None):
+    '''
+    Run Cooling.PID_controller against the simulated plant for duration seconds (wall-clock)
+    and return loop rate, latency per stage and settling time (simulated time).
+    '''
+    plant = ThermalModel(speedup=speedup)
+    arduino = VirtualArduino(plant, delay=arduino_delay).start()
+    bronkhorst = VirtualBronkhorst(plant, delay=bronkhorst_delay, error_rate=bus_errors).start()
+
+    cooling = Cooling(monitor=False, streaming=streaming, arduino_port=arduino.port, bronkhorst_port=bronkhorst.port,
+                      period=period, pid_parameters=pid_parameters)
+
+    latencies = {}
+    trace = []  # (simulated time, DUT temperature) of every temperature readout
+
+    def get_temps(get_temps=cooling.get_temps):
+        values = get_temps()
+        trace.append((plant.sim_time, float(values[cooling.channels.control_index])))
+        return values
+
+    cooling.get_temps = timed(get_temps, latencies.setdefault('arduino', []))
+    cooling.setvalve_readstatus = timed(cooling.setvalve_readstatus, latencies.setdefault('bronkhorst', []))
+    cooling.scheduler.snapshot = timed(cooling.scheduler.snapshot, latencies.setdefault('io', []))
+    cooling.writer.append = timed(cooling.writer.append, latencies.setdefault('storage', []))
+
+    loop = threading.Thread(target=cooling.PID_controller, args=(setpoint,), daemon=True)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        loop.start()
+        time.sleep(duration)
+        cooling.stop()
+        loop.join(10.)
+        elapsed = time.perf_counter() - start
+
+    n_cycles = len(latencies['io'])
+    cooling.scheduler.shutdown()
+    cooling.connection.close()
+    cooling.writer.close()
+    arduino.stop()
+    bronkhorst.stop()
+
+    times = [t for t, _ in trace]
+    values = [v for _, v in trace]
+    return {
+        'duration': elapsed,
+        'cycles': n_cycles,
+        'cycles_per_s': n_cycles / elapsed,
+        'latency': dict((stage, {
+            'mean': float(np.mean(values_)) if values_ else None,
+            'p50': float(np.percentile(values_, 50)) if values_ else None,
+            'p99': float(np.percentile(values_, 99)) if values_ else None,
+            'max': float(np.max(values_)) if values_ else None,
+            'n': len(values_),
+        }) for stage, values_ in latencies.items()),
+        'simulated_time': plant.sim_time,
+        'settling_time': settling_time(times, values, setpoint, tolerance),
+        'final_temperature': values[-1] if values else None,
+        'overshoot': max(setpoint - min(values), 0.) if values and values[0] > setpoint else None,
+        'serial_requests': {'arduino': arduino.n_requests, 'bronkhorst': bronkhorst.n_requests},
+        'timing': cooling.cycle_timer.stats() if cooling.cycle_timer is not None else None,
+        'bus_errors': bronkhorst.n_errors,
+        'counters': dict(cooling.metrics.counters),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the cooling control loop against a simulated cooling box',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--duration', type=float, default=60.,
+                        help="Wall-clock duration of the benchmark in s")
+    parser.add_argument('--setpoint', type=float, default=-20.0,
+                        help="Target temperature in Celsius")
+    parser.add_argument('--speedup', type=float, default=60.,
+                        help="Simulated time per wall-clock time")
+    parser.add_argument('--arduino-delay', type=float, default=0.5,
+                        help="Answer delay of the Arduino in s")
+    parser.add_argument('--bronkhorst-delay', type=float, default=0.002,
+                        help="Answer delay of the flow controller in s")
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="Temperature band around setpoint for settling time in C")
+    parser.add_argument('--period', type=float, default=0.5,
+                        help="Period of the control loop in s")
+    parser.add_argument('--bus-errors', type=float, default=0.,
+                        help="Fraction of flow controller answers which are lost, truncated or duplicated")
+    parser.add_argument('--poll', action='store_true',
+                        help="Request every sensor sample instead of streaming readout")
+    parser.add_argument('--config', type=str, default=None,
+                        help="Take the PID parameters of --chamber from this cooling.yaml")
+    parser.add_argument('--chamber', type=str, default=None,
+                        help="Chamber of --config (default: the first one)")
+    parser.add_argument('--output', type=str, default=None,
+                        help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    pid_parameters = None
+    if args.config:
+        import yaml
+        from n2_cooling.tuning import chamber_pid
+
+        chamber = args.chamber
+        if chamber is None:
+            with open(args.config) as f:
+                chamber = yaml.safe_load(f)['chambers'][0]['name']
+        pid_parameters = chamber_pid(args.config, chamber)
+
+    output = os.path.abspath(args.output) if args.output else None
+    # Measurement and log files of the run go into a temporary folder
+    os.chdir(tempfile.mkdtemp(prefix='n2cooling_benchmark_'))
+    print('Measurement files in %s' % os.getcwd())
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = run_benchmark(duration=args.duration, setpoint=args.setpoint, speedup=args.speedup,
+                            arduino_delay=args.arduino_delay, bronkhorst_delay=args.bronkhorst_delay,
+                            streaming=not args.poll, tolerance=args.tolerance, period=args.period,
+                            bus_errors=args.bus_errors, pid_parameters=pid_parameters)
+
+    print('Cycles: %d in %.1f s (%.2f cycles/s)' % (results['cycles'], results['duration'], results['cycles_per_s']))
+    for stage, latency in results['latency'].items():
+        if latency['n']:
+            print('%-12s p50 %8.2f ms   p99 %8.2f ms   max %8.2f ms' % (stage, latency['p50'] * 1e3, latency['p99'] * 1e3, latency['max'] * 1e3))
+    if results['timing'] is not None:
+        print('Period %(period).3f s: %(overruns)d overruns, jitter p50 %(jitter_p50).4f s   p99 %(jitter_p99).4f s   max %(jitter_max).4f s' % results['timing'])
+    if results['bus_errors']:
+        print('Bus errors: %d injected, counters %s' % (results['bus_errors'], ', '.join('%s %d' % item for item in sorted(results['counters'].items()))))
+    if results['settling_time'] is None:
+        print('Not settled within %.0f s simulated time' % results['simulated_time'])
+    else:
+        print('Settling time: %.0f s (simulated)' % results['settling_time'])
+    if results['overshoot'] is not None:
+        print('Overshoot: %.2f C' % results['overshoot'])
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+import os
+import tty
+import time
+import random
+import struct
+import logging
+import threading
+
+from n2_cooling.bronkhorst import Bronkhorst
+
+
+class VirtualDevice(object):
+    '''
+    Serial device emulated on a pseudo terminal. The port name to open with pyserial is given by
+    self.port, the device answers in its own thread.
+    '''
+
+    def __init__(self, plant):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.plant = plant
+        self._master, slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(slave)
+        self._slave = slave
+        self.port = os.ttyname(slave)
+        self.n_requests = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, name=self.__class__.__name__, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def write(self, data):
+        os.write(self._master, data)
+
+    def _serve(self):
+        buffer = b''
+        while not self._stop.is_set():
+            try:
+                buffer += os.read(self._master, 1024)
+            except OSError:  # closed
+                break
+            buffer = self.handle(buffer)
+
+    def handle(self, buffer):
+        ''' Answer all complete requests in buffer, returns the unprocessed rest '''
+        raise NotImplementedError()
+
+
+class VirtualArduino(VirtualDevice):
+    '''
+    Answers every "R" with "tempNTC tempSHT humidSHT" after delay seconds, like the firmware which
+    only checks the serial input after every averaging loop.
+    '''
+
+    def __init__(self, plant, delay=0.5, noise=0.):
+        super(VirtualArduino, self).__init__(plant)
+        self.delay = delay  # time until the answer is sent (s)
+        self.noise = noise  # gaussian noise added to every value
+
+    def handle(self, buffer):
+        for char in buffer:
+            if char == ord('R'):
+                time.sleep(self.delay)
+                self.plant.update()
+                self.n_requests += 1
+                values = (self.plant.temperature_box, self.plant.temperature_dut, self.plant.humidity)
+                if self.noise:
+                    values = tuple(value + random.gauss(0., self.noise) for value in values)
+                self.write(b'%.2f %.2f %.2f \n' % values)
+        return b''
+
+
+class VirtualBronkhorst(VirtualDevice):
+    '''
+    Answers the ProPar ASCII requests used by the Bronkhorst driver. In valve steering mode
+    the setpoint sets the valve opening of the plant. With error_rate > 0 this fraction of the
+    answers is lost, truncated or sent twice to emulate a noisy bus.
+    '''
+
+    def __init__(self, plant, delay=0.002, node=0x80, error_rate=0.):
+        super(VirtualBronkhorst, self).__init__(plant)
+        self.delay = delay  # processing time of one message (s)
+        self.node = node
+        self.error_rate = error_rate
+        self.n_errors = 0
+        self.parameters = dict(((process, parameter), name) for name, (process, parameter, _) in Bronkhorst.PARAMETERS.items())
+        self.values = {
+            'setpoint': 0,
+            'control_mode': 0,
+            'counter_mode': 0,
+            'capacity': plant.capacity,
+            'capacity_unit': 'ln/min ',
+        }
+
+    def value(self, name):
+        if name == 'measure':
+            return int(round(self.plant.flow / self.plant.capacity * Bronkhorst.FULL_SCALE))
+        if name == 'valve':
+            return int(self.plant.valve * 100. / Bronkhorst.VALVE_SCALE)
+        if name == 'counter_value':
+            return self.plant.counter
+        return self.values[name]
+
+    def write(self, data):
+        if self.error_rate and random.random() < self.error_rate:
+            self.n_errors += 1
+            error = random.choice(('lost', 'truncated', 'duplicated'))
+            if error == 'lost':
+                return
+            if error == 'truncated':
+                data = data[:random.randrange(1, len(data) - 2)] + b'\r\n'
+            else:
+                data = data + data
+        super(VirtualBronkhorst, self).write(data)
+
+    def _frame(self, command, payload):
+        message = bytes([len(payload) + 2, self.node, command]) + bytes(payload)
+        return b':' + message.hex().upper().encode() + b'\r\n'
+
+    def _status(self, status=0, index=0):
+        return self._frame(Bronkhorst.STATUS, [status, index])
+
+    def _answer(self, payload):
+        ''' Encode the answer to a (chained) parameter request '''
+        answer = b''
+        pos = 0
+        process_chained = True
+        while process_chained:
+            process_chained = payload[pos] & 0x80
+            answer += payload[pos:pos + 1]
+            pos += 1
+            parameter_chained = True
+            while parameter_chained:
+                index, process, parameter = payload[pos:pos + 3]
+                parameter_chained = index & 0x80
+                pos += 3
+                name = self.parameters[(process, parameter)]
+                fmt = Bronkhorst.PARAMETERS[name][2]
+                answer += bytes([index])
+                if parameter & 0x60 == Bronkhorst.TYPE_STRING:
+                    size = payload[pos]
+                    pos += 1
+                    answer += bytes([size]) + self.value(name).encode().ljust(size, b'\x00')[:size]
+                else:
+                    answer += struct.pack(fmt, self.value(name))
+        return self._frame(Bronkhorst.SEND_NO_REPLY, answer)
+
+    def _write(self, payload):
+        name = self.parameters[(payload[0], payload[1])]
+        value = struct.unpack(Bronkhorst.PARAMETERS[name][2], payload[2:])[0]
+        if name == 'counter_mode' and value == 1:
+            self.plant.reset_counter()
+        elif name == 'setpoint' and self.values['control_mode'] == 20:
+            self.plant.set_valve(value / Bronkhorst.FULL_SCALE)
+        self.values[name] = value
+
+    def handle(self, buffer):
+        while b'\r\n' in buffer:
+            line, buffer = buffer.split(b'\r\n', 1)
+            time.sleep(self.delay)
+            self.n_requests += 1
+            self.plant.update()
+            try:
+                message = bytes.fromhex(line.decode().lstrip(':'))
+                command, payload = message[2], message[3:]
+                if command == Bronkhorst.REQUEST:
+                    self.write(self._answer(payload))
+                elif command in (Bronkhorst.SEND, Bronkhorst.SEND_NO_REPLY):
+                    self._write(payload)
+                    if command == Bronkhorst.SEND:
+                        self.write(self._status(index=len(message) + 1))
+                else:
+                    self.write(self._status(status=0x07))  # command not supported
+            except (ValueError, IndexError, KeyError, struct.error):
+                self.log.warning('Cannot handle message %r', line)
+                self.write(self._status(status=0x03))  # process claimed / invalid message
+        return buffer
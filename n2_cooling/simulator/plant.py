@@ -0,0 +1,78 @@
+import time
+import threading
+
+
+class ThermalModel(object):
+    '''
+    First-order thermal model of the cooling box.
+
+    The valve opening sets the N2 flow, which pulls the box temperature towards the N2 temperature
+    against the heat leak to ambient. The DUT (SHT sensor) follows the box temperature with its own
+    time constant and the humidity is flushed out by the dry N2 flow.
+    Simulated time runs speedup times faster than wall-clock time.
+    '''
+
+    def __init__(self, t_ambient=22., t_n2=-80., coupling=1.55, tau_box=120., tau_dut=30.,
+                 humidity_ambient=40., tau_humidity=600., flush=0.02,
+                 valve_closed=0.38, valve_open=0.55, capacity=20., speedup=1., max_step=0.5):
+        self.t_ambient = t_ambient  # ambient temperature (C)
+        self.t_n2 = t_n2  # temperature of the incoming N2 (C)
+        self.coupling = coupling  # thermal coupling of full N2 flow relative to ambient heat leak
+        self.tau_box = tau_box  # time constant of the box (s)
+        self.tau_dut = tau_dut  # time constant of the DUT to the box (s)
+        self.humidity_ambient = humidity_ambient  # rel. humidity the box tends to without flow (%)
+        self.tau_humidity = tau_humidity  # time constant of the humidity leak (s)
+        self.flush = flush  # humidity flush rate at full flow (1/s)
+        self.valve_closed = valve_closed  # valve opening where the flow starts
+        self.valve_open = valve_open  # valve opening with full flow
+        self.capacity = capacity  # full flow (l/min)
+        self.speedup = speedup
+        self.max_step = max_step  # max. integration step (simulated s)
+
+        self.temperature_box = t_ambient
+        self.temperature_dut = t_ambient
+        self.humidity = humidity_ambient
+        self.valve = 0.  # valve opening (0..1)
+        self.counter = 0.  # total flow (l)
+        self.sim_time = 0.
+
+        self._lock = threading.Lock()
+        self._last_update = time.monotonic()
+
+    @property
+    def flow_fraction(self):
+        fraction = (self.valve - self.valve_closed) / (self.valve_open - self.valve_closed)
+        return min(max(fraction, 0.), 1.)
+
+    @property
+    def flow(self):
+        ''' Flow in l/min '''
+        return self.flow_fraction * self.capacity
+
+    def step(self, dt):
+        ''' Integrate the model by dt simulated seconds '''
+        while dt > 0:
+            h = min(dt, self.max_step)
+            f = self.flow_fraction
+            self.temperature_box += h / self.tau_box * (
+                self.t_ambient - self.temperature_box + self.coupling * f * (self.t_n2 - self.temperature_box))
+            self.temperature_dut += h / self.tau_dut * (self.temperature_box - self.temperature_dut)
+            self.humidity += h * ((self.humidity_ambient - self.humidity) / self.tau_humidity - self.flush * f * self.humidity)
+            self.counter += self.flow / 60. * h
+            self.sim_time += h
+            dt -= h
+
+    def update(self):
+        ''' Advance the model to the current wall-clock time '''
+        with self._lock:
+            now = time.monotonic()
+            self.step((now - self._last_update) * self.speedup)
+            self._last_update = now
+
+    def set_valve(self, valve):
+        with self._lock:
+            self.valve = min(max(valve, 0.), 1.)
+
+    def reset_counter(self):
+        with self._lock:
+            self.counter = 0.
@@ -0,0 +1,170 @@
+import time
+import queue
+import atexit
+import logging
+import threading
+import numpy as np
+import tables as tb
+
+from n2_cooling.metrics import Metrics
+
+# HDF5 (and PyTables) is not thread safe: every call of the writers (several chambers, segments closed
+# while the next one is written) is made while holding this lock
+hdf5_lock = threading.Lock()
+
+
+class TableWriter(object):
+    '''
+    Writes rows to a PyTables table from a background thread.
+
+    Rows are collected in a preallocated structured array and handed to the writer thread when
+    batch_size rows are buffered or the oldest buffered row is older than max_age seconds. The writer
+    thread appends and flushes the table once per batch and writes the same rows to an optional
+    text (or CSV) mirror. All buffered rows are written when the writer is closed, also at interpreter
+    exit. Columns in index_columns get a PyTables index, which is updated with every flush.
+    '''
+
+    def __init__(self, filename, dtype, table_name='temperature', text_file=None, text_columns=None,
+                 batch_size=64, max_age=10., filters=tb.Filters(complevel=5, complib='blosc'),
+                 chunkshape=None, expectedrows=1000000, index_columns=(), metrics=None):
+        self.log = logging.getLogger('TableWriter')
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.dtype = np.dtype(dtype)
+        self.batch_size = batch_size
+        self.max_age = max_age  # max. time rows are kept in the buffer (s)
+
+        with hdf5_lock:
+            self.output_file = tb.open_file(filename, 'a')
+            if '/' + table_name in self.output_file:  # Table already exists
+                self.table = self.output_file.get_node(self.output_file.root, table_name)
+            else:
+                self.table = self.output_file.create_table(self.output_file.root,
+                                                           name=table_name,
+                                                           description=self.dtype,
+                                                           filters=filters,
+                                                           chunkshape=chunkshape,
+                                                           expectedrows=expectedrows)
+            for name in index_columns:
+                column = self.table.colinstances[name]
+                if not column.is_indexed:
+                    column.create_index()
+
+        # Text mirror of the table, list of (column name, header) pairs; csv if file name ends with .csv
+        self.text = None
+        if text_file is not None:
+            self.text_columns = text_columns or [(name, name) for name in self.dtype.names]
+            self.text_delimiter = ',' if text_file.endswith('.csv') else ' ' * 18
+            self.text_fmt = ['%d' if self.dtype[name].kind in 'iu' else '%.2f' for name, _ in self.text_columns]
+            self.text = open(text_file, 'w')
+            self.text.write((',' if text_file.endswith('.csv') else ':   ').join(header for _, header in self.text_columns) + '\n')
+
+        self._buffer = np.zeros(batch_size, dtype=self.dtype)
+        self._n_buffered = 0
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._write, name='TableWriter', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def append(self, row):
+        ''' Add one row (tuple in order of dtype) '''
+        with self._lock:
+            self._buffer[self._n_buffered] = row
+            self._n_buffered += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if self._n_buffered >= self.batch_size or time.monotonic() - self._oldest > self.max_age:
+                self._submit()
+
+    def _submit(self):
+        if self._n_buffered:
+            self._queue.put(self._buffer[:self._n_buffered].copy())
+            self._n_buffered = 0
+            self._oldest = None
+
+    def _write(self):
+        while True:
+            try:
+                rows = self._queue.get(timeout=self.max_age)
+            except queue.Empty:
+                # nothing arrived for a while, write rows which are buffered too long
+                with self._lock:
+                    if self._oldest is not None and time.monotonic() - self._oldest > self.max_age:
+                        self._submit()
+                continue
+            if rows is None:
+                self._queue.task_done()
+                break
+            try:
+                with self.metrics.timer('hdf5_write'), hdf5_lock:
+                    self.table.append(rows)
+                    self.table.flush()
+                if self.text is not None:
+                    with self.metrics.timer('text_write'):
+                        np.savetxt(self.text, rows[[name for name, _ in self.text_columns]],
+                                   fmt=self.text_fmt, delimiter=self.text_delimiter)
+                        self.text.flush()
+            except Exception as e:
+                self.log.error('Cannot write %d rows: %s', len(rows), e)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        ''' Write all buffered rows and wait until they are on disk '''
+        with self._lock:
+            self._submit()
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        if self.text is not None:
+            self.text.close()
+        with hdf5_lock:
+            self.output_file.close()
+        atexit.unregister(self.close)
+
+
+def time_condition(t_min=None, t_max=None, column='timestamp'):
+    ''' Condition for read_where / get_where_list selecting t_min <= column < t_max (None: open end) '''
+    condition, condvars = [], {}
+    if t_min is not None:
+        condition.append('(%s >= t_min)' % column)
+        condvars['t_min'] = float(t_min)
+    if t_max is not None:
+        condition.append('(%s < t_max)' % column)
+        condvars['t_max'] = float(t_max)
+    return ' & '.join(condition), condvars
+
+
+def read_time_range(table, t_min=None, t_max=None, field=None, column='timestamp'):
+    '''
+    Rows (or only field) of table with t_min <= timestamp < t_max as NumPy array.
+    The rows are in time order, so the range is located with the index of the timestamp column
+    (in-kernel scan without index) and read as one slice.
+    '''
+    rows = table.read(*time_range_rows(table, t_min, t_max, column))
+    return rows if field is None else rows[field]
+
+
+def time_range_rows(table, t_min=None, t_max=None, column='timestamp'):
+    ''' First and last + 1 row number of the time range, rows are in time order '''
+    if t_min is None and t_max is None:
+        return 0, table.nrows
+    condition, condvars = time_condition(t_min, t_max, column)
+    rows = table.get_where_list(condition, condvars=condvars, sort=True)
+    if not len(rows):
+        return 0, 0
+    return int(rows[0]), int(rows[-1]) + 1
+
+
+def read_file_range(filename, t_min=None, t_max=None, field=None, table_name='temperature'):
+    ''' Rows of the measurement file with t_min <= timestamp < t_max (Unix time in s) '''
+    with tb.open_file(filename, 'r') as in_file:
+        return read_time_range(in_file.get_node(in_file.root, table_name), t_min, t_max, field=field)
@@ -0,0 +1,302 @@
+'''
+PID gains from recorded measurements.
+
+A first order plus dead time (FOPDT) model from valve opening (%) to DUT temperature (C)
+
+    tau * dT/dt = -T + gain * valve(t - dead_time) + offset
+
+is fitted to the temperature table of measurement files: for a grid of time constants and dead times the
+model response is linear in gain and offset, which follow by least squares, the pair with the smallest
+deviation is taken. The PID gains follow from the model with IMC or SIMC rules for a closed loop time constant tau_c,
+the model also gives the valve opening (feed-forward) needed to hold a setpoint.
+'''
+import re
+import logging
+import argparse
+import numpy as np
+
+from datetime import datetime
+
+# PID output (Bronkhorst setpoint in 1/32000 of full scale) per % valve opening
+OUTPUT_PER_PERCENT = 32000 / 100.
+
+
+def read_measurements(files, t_min=None, t_max=None, chunk_size=100000, table_name='temperature'):
+    ''' Timestamps, valve opening (%) and DUT temperature (C) of all files in time order, rows with NaN are skipped '''
+    from n2_cooling.analysis import read_chunks
+
+    columns = {'timestamp': [], 'valve': [], 'temperature_dut': []}
+    for filename in files:
+        for rows in read_chunks(filename, chunk_size=chunk_size, table_name=table_name, t_min=t_min, t_max=t_max):
+            for name, values in columns.items():
+                values.append(rows[name].astype(np.float64))
+    if not columns['timestamp']:
+        raise ValueError('No data in %s' % ', '.join(files))
+    timestamps, valve, temperature = (np.concatenate(columns[name]) for name in ('timestamp', 'valve', 'temperature_dut'))
+    order = np.argsort(timestamps, kind='stable')
+    timestamps, valve, temperature = timestamps[order], valve[order], temperature[order]
+    finite = np.isfinite(timestamps) & np.isfinite(valve) & np.isfinite(temperature)
+    return timestamps[finite], valve[finite], temperature[finite]
+
+
+def resample(timestamps, valve, temperature, dt=None, max_gap=5., max_samples=20000):
+    '''
+    Valve and temperature on a regular grid with step dt (default: median sample distance, larger if there
+    would be more than max_samples). Grid points further than max_gap * dt from the next sample are marked
+    invalid, so gaps between runs are not fitted.
+    '''
+    if len(timestamps) < 10:
+        raise ValueError('Too few samples (%d) for a fit' % len(timestamps))
+    if dt is None:
+        dt = max(float(np.median(np.diff(timestamps))), (timestamps[-1] - timestamps[0]) / max_samples)
+    if dt <= 0:
+        raise ValueError('Sample distance has to be positive')
+    grid = np.arange(timestamps[0], timestamps[-1], dt)
+    index = np.clip(np.searchsorted(timestamps, grid), 1, len(timestamps) - 1)
+    distance = np.minimum(grid - timestamps[index - 1], timestamps[index] - grid)
+    valid = distance <= max_gap * dt
+    return dt, np.interp(grid, timestamps, valve), np.interp(grid, timestamps, temperature), valid
+
+
+def _first_order(signal, a):
+    ''' Response x[k] = a * x[k-1] + (1 - a) * signal[k-1] (x[0] = 0) for every a, FFT convolution '''
+    n = len(signal)
+    size = 1 << int(np.ceil(np.log2(2 * n)))
+    kernel = np.zeros((len(a), n))
+    kernel[:, 1:] = (1. - a)[:, np.newaxis] * a[:, np.newaxis] ** np.arange(n - 1)
+    return np.fft.irfft(np.fft.rfft(kernel, size) * np.fft.rfft(signal, size), size)[:, :n]
+
+
+def fit_fopdt(valve, temperature, dt, valid=None, max_dead_time=60., n_time_constants=40):
+    '''
+    Fit of the FOPDT model to regularly sampled valve opening and temperature by the error of the simulated
+    response (unbiased also for data taken with the PID running). For every time constant and dead time on a
+    grid, gain, offset and initial deviation follow by linear least squares, the best pair is refined once.
+    Returns dict with gain (C per %), time_constant (s), dead_time (s), offset (C at closed valve) and rmse (C).
+    '''
+    n = len(temperature)
+    if valid is None:
+        valid = np.ones(n, dtype=bool)
+    if np.ptp(valve[valid]) == 0:
+        raise ValueError('Valve opening does not change, the data cannot be fitted')
+    max_delay = min(int(round(max_dead_time / dt)), n // 2)
+    k = np.arange(n)
+
+    def search(time_constants):
+        a = np.exp(-dt / time_constants)
+        responses = _first_order(valve - valve[0], a)  # relative to the first value for numerical range
+        best = None
+        for i in range(len(a)):
+            decay = a[i] ** k
+            for delay in range(max_delay + 1):
+                delayed = np.concatenate((np.zeros(delay), responses[i, :n - delay]))
+                design = np.column_stack((delayed, 1. - decay, decay))[valid]
+                coefficients, _, _, _ = np.linalg.lstsq(design, temperature[valid], rcond=None)
+                sse = np.sum((design.dot(coefficients) - temperature[valid]) ** 2)
+                if best is None or sse < best[0]:
+                    best = (sse, time_constants[i], delay, coefficients)
+        return best
+
+    span = dt * n
+    grid = np.geomspace(dt, span, n_time_constants)
+    best = search(grid)
+    step = grid[1] / grid[0]
+    best = min(best, search(np.geomspace(best[1] / step, best[1] * step, 9)), key=lambda result: result[0])
+    sse, time_constant, delay, (gain, offset, _) = best
+    if time_constant >= span:
+        raise ValueError('Time constant longer than the data, select a longer time range')
+    return {
+        'gain': gain,
+        'time_constant': time_constant,
+        'dead_time': delay * dt,
+        'offset': offset - gain * valve[0],
+        'rmse': float(np.sqrt(sse / np.count_nonzero(valid))),
+    }
+
+
+def pid_gains(model, tau_c=None, rule='imc'):
+    '''
+    Kp, Ki, Kd for simple_pid (output in Bronkhorst setpoint units, time in s) from the FOPDT model.
+    tau_c is the closed loop time constant, default the dead time (but at least a tenth of the time constant);
+    smaller values give faster control, larger ones are more robust against errors of the model.
+    rule 'imc': PID of the internal model control rules, 'simc': PI of the SIMC rules (Kd = 0).
+    '''
+    gain, tau, theta = model['gain'], model['time_constant'], model['dead_time']
+    if tau_c is None:
+        tau_c = max(theta, 0.1 * tau)
+    if rule == 'imc':
+        kc = (2. * tau + theta) / (gain * (2. * tau_c + theta))
+        ti = tau + theta / 2.
+        td = tau * theta / (2. * tau + theta)
+    elif rule == 'simc':
+        kc = tau / (gain * (tau_c + theta))
+        ti = min(tau, 4. * (tau_c + theta))
+        td = 0.
+    else:
+        raise ValueError('Unknown tuning rule %s' % rule)
+    kp = kc * OUTPUT_PER_PERCENT
+    return {'Kp': kp, 'Ki': kp / ti, 'Kd': kp * td, 'tau_c': tau_c}
+
+
+def feed_forward(model, setpoint, output_limits=None):
+    ''' PID output (Bronkhorst setpoint units) which holds setpoint in steady state according to the model '''
+    output = (setpoint - model['offset']) / model['gain'] * OUTPUT_PER_PERCENT
+    if output_limits is not None:
+        output = min(max(output, output_limits[0]), output_limits[1])
+    return output
+
+
+def _format(value):
+    if isinstance(value, bool):
+        return 'True' if value else 'False'
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(_format(item) for item in value)
+    if isinstance(value, float):
+        return '%.6g' % value
+    return str(value)
+
+
+def pid_block(pid, indent, comment=None):
+    ''' Lines of the pid entry of a chamber in cooling.yaml (nested dicts are indented further) '''
+    lines = ['%spid :%s' % (' ' * indent, '  # ' + comment if comment else '')]
+
+    def add(values, level):
+        for key, value in values.items():
+            if isinstance(value, dict):
+                lines.append('%s%s :' % (' ' * level, key))
+                add(value, level + 2)
+            else:
+                lines.append('%s%s : %s' % (' ' * level, key, _format(value)))
+
+    add(pid, indent + 2)
+    return lines
+
+
+def write_chamber_pid(config_file, chamber, pid, comment=None):
+    '''
+    Replace the pid entry of chamber in cooling.yaml (or add it), the rest of the file including comments
+    stays as it is. The result is parsed again before it is written.
+    '''
+    import yaml
+
+    with open(config_file) as f:
+        lines = f.read().splitlines()
+    indentation = lambda line: len(line) - len(line.lstrip())
+    for start, line in enumerate(lines):
+        match = re.match(r'^(\s*)-\s*name\s*:\s*([^#]*?)\s*(#.*)?$', line)
+        if match and match.group(2).strip('\'"') == chamber:
+            item_indent = len(match.group(1))
+            key_indent = line.index('name')
+            break
+    else:
+        raise ValueError('Chamber %s not found in %s' % (chamber, config_file))
+
+    # end of the chamber entry: next line with at most the indentation of its list item
+    end = start + 1
+    while end < len(lines) and (not lines[end].strip() or indentation(lines[end]) > item_indent):
+        end += 1
+    while end > start + 1 and not lines[end - 1].strip():
+        end -= 1
+
+    block = pid_block(pid, key_indent, comment)
+    for pid_start in range(start + 1, end):
+        if indentation(lines[pid_start]) == key_indent and re.match(r'^\s*pid\s*:', lines[pid_start]):
+            pid_end = pid_start + 1
+            while pid_end < end and (not lines[pid_end].strip() or indentation(lines[pid_end]) > key_indent):
+                pid_end += 1
+            while not lines[pid_end - 1].strip():
+                pid_end -= 1
+            lines[pid_start:pid_end] = block
+            break
+    else:
+        lines[end:end] = block
+
+    text = '\n'.join(lines) + '\n'
+    chambers = dict((entry['name'], entry) for entry in yaml.safe_load(text)['chambers'])
+    if chambers[chamber]['pid']['Kp'] != float(_format(pid['Kp'])):
+        raise RuntimeError('Cannot update the pid entry of %s in %s' % (chamber, config_file))
+    with open(config_file, 'w') as f:
+        f.write(text)
+
+
+def chamber_pid(config_file, chamber):
+    ''' Current pid entry of chamber in cooling.yaml, empty dict if there is none '''
+    import yaml
+
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    for entry in config.get('chambers') or []:
+        if entry['name'] == chamber:
+            return dict(entry.get('pid') or {})
+    raise ValueError('Chamber %s not found in %s' % (chamber, config_file))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fit a first order plus dead time model (valve -> DUT temperature) to measurement files\n'
+                    'and derive PID gains and valve feed-forward for cooling.yaml',
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog='example:\n'
+               '  n2cooling-tune measurement_box1_*.h5 --chamber box1 --start 2021-05-12T14:00 --write'
+    )
+    parser.add_argument('files', nargs='+',
+                        help="Measurement files (measurement_*.h5) or run catalogs with changes of the valve opening")
+    parser.add_argument('--config', type=str, default='cooling.yaml',
+                        help="Configuration with the chambers")
+    parser.add_argument('--chamber', type=str, default=None,
+                        help="Chamber to tune (default: the first one in the configuration)")
+    parser.add_argument('--start', type=str, default=None,
+                        help="Fit only from this time on (Unix time or ISO format)")
+    parser.add_argument('--end', type=str, default=None,
+                        help="Fit only until this time (Unix time or ISO format)")
+    parser.add_argument('--dt', type=float, default=None,
+                        help="Sample distance of the fit in s (default: median of the file)")
+    parser.add_argument('--max-dead-time', type=float, default=60.,
+                        help="Largest dead time tried in s")
+    parser.add_argument('--rule', choices=['imc', 'simc'], default='imc',
+                        help="Tuning rule: imc (PID) or simc (PI)")
+    parser.add_argument('--tau-c', type=float, default=None,
+                        help="Closed loop time constant in s, smaller is faster, larger more robust\n"
+                             "(default: dead time, at least a tenth of the time constant)")
+    parser.add_argument('--no-feed-forward', action='store_true',
+                        help="Do not start the valve at the opening predicted for the setpoint")
+    parser.add_argument('--write', action='store_true',
+                        help="Write the gains into the configuration (otherwise only print them)")
+    args = parser.parse_args()
+
+    import yaml
+    from n2_cooling.analysis import parse_time
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)-15s] - %(levelname)-7s %(message)s')
+    with open(args.config) as f:
+        chambers = yaml.safe_load(f)['chambers']
+    chamber = args.chamber if args.chamber is not None else chambers[0]['name']
+    pid = chamber_pid(args.config, chamber)
+    setpoint = dict((entry['name'], entry.get('setpoint')) for entry in chambers).get(chamber)
+
+    timestamps, valve, temperature = read_measurements(args.files, t_min=parse_time(args.start), t_max=parse_time(args.end))
+    dt, valve, temperature, valid = resample(timestamps, valve, temperature, dt=args.dt)
+    model = fit_fopdt(valve, temperature, dt, valid=valid, max_dead_time=args.max_dead_time)
+    gains = pid_gains(model, tau_c=args.tau_c, rule=args.rule)
+
+    print('Model from %d samples (dt %.2f s): gain %.3f C/%%, time constant %.1f s, dead time %.1f s, offset %.1f C'
+          % (np.count_nonzero(valid), dt, model['gain'], model['time_constant'], model['dead_time'], model['offset']))
+    print('RMS deviation of the model response %.3f C' % model['rmse'])
+    print('PID (%s, tau_c %.1f s): Kp %.1f, Ki %.2f, Kd %.1f' % (args.rule, gains['tau_c'], gains['Kp'], gains['Ki'], gains['Kd']))
+    if setpoint is not None:
+        print('Valve opening for the setpoint %.1f C: %.1f %%' % (setpoint, feed_forward(model, setpoint) / OUTPUT_PER_PERCENT))
+
+    pid.update(Kp=float(gains['Kp']), Ki=float(gains['Ki']), Kd=float(gains['Kd']))
+    pid.setdefault('output_limits', [12800, 16640])
+    pid['feed_forward'] = not args.no_feed_forward
+    pid['model'] = dict((key, float(model[key])) for key in ('gain', 'time_constant', 'dead_time', 'offset'))
+    comment = 'n2cooling-tune %s, %s' % (datetime.now().strftime('%Y-%m-%d %H:%M'), args.rule)
+    if args.write:
+        write_chamber_pid(args.config, chamber, pid, comment=comment)
+        print('Written to chamber %s of %s' % (chamber, args.config))
+    else:
+        print('\n'.join(pid_block(pid, 4, comment)))
+
+
+if __name__ == "__main__":
+    main()
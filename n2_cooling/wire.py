@@ -0,0 +1,93 @@
+'''
+Wire format between cooling.py and the online monitor converter.
+
+A message is sent as ZMQ multipart: a small JSON header frame (prefixed with MAGIC) with the data name,
+the dtype of the records and optionally the description of the channels (see channels.py), followed by
+the raw buffer of a structured array of one or more records.
+The header of a name and dtype is encoded once and cached, the records are sent without copy and the
+receiver maps them with np.frombuffer. Messages without records (e.g. metrics) consist of the header only.
+An optional third frame holds a sequence number (uint64) per publisher and name, the receiver counts the
+messages lost in between (a PUB socket drops messages at its high-water mark without notice).
+'''
+import json
+import struct
+import functools
+import numpy as np
+
+MAGIC = b'N2W1'
+
+
+@functools.lru_cache(maxsize=32)
+def encode_header(name, dtype, channels=None):
+    '''
+    Header frame for records of dtype published as name, encoded once per name, dtype and channels
+    (JSON string of ChannelRegistry.wire)
+    '''
+    header = {'name': name, 'dtype': np.lib.format.dtype_to_descr(np.dtype(dtype))}
+    if channels is not None:
+        header.update(json.loads(channels))
+    return MAGIC + json.dumps(header).encode()
+
+
+@functools.lru_cache(maxsize=32)
+def decode_header(header):
+    ''' Header dict and record dtype (None without records) of a header frame '''
+    header = json.loads(header[len(MAGIC):])
+    dtype = None
+    if 'dtype' in header:
+        dtype = np.lib.format.descr_to_dtype([tuple(field) for field in header['dtype']])
+    return header, dtype
+
+
+def send_records(socket, records, name="CoolingData", sequence=None, channels=None):
+    '''
+    Publish a structured array (or a single record) without blocking and without copying the data.
+    Returns False if the message was dropped.
+    '''
+    import zmq
+
+    if records.ndim != 1 or not records.flags.c_contiguous:
+        records = np.ascontiguousarray(np.atleast_1d(records))
+    frames = [encode_header(name, records.dtype, channels), records]
+    if sequence is not None:
+        frames.append(struct.pack('<Q', sequence))
+    try:
+        socket.send_multipart(frames, flags=zmq.NOBLOCK, copy=False)
+    except zmq.Again:
+        return False
+    return True
+
+
+def send_meta(socket, name, **meta):
+    ''' Publish a message without records, meta has to be JSON serializable '''
+    import zmq
+
+    meta['name'] = name
+    try:
+        socket.send_multipart([MAGIC + json.dumps(meta).encode()], flags=zmq.NOBLOCK)
+    except zmq.Again:
+        return False
+    return True
+
+
+def _bytes(frame):
+    return frame.bytes if hasattr(frame, 'bytes') else bytes(frame)
+
+
+def is_wire_message(frames):
+    return _bytes(frames[0]).startswith(MAGIC)
+
+
+def decode(frames):
+    '''
+    Header dict and records of a multipart message (list of bytes or zmq.Frame).
+    The records are a read-only view of the received buffer, None for messages without records.
+    '''
+    header = _bytes(frames[0])
+    if len(frames) == 1:
+        return None, json.loads(header[len(MAGIC):])  # header only messages differ every time, not cached
+    header, dtype = decode_header(header)
+    header = dict(header)
+    if len(frames) > 2:
+        header['seq'] = struct.unpack('<Q', _bytes(frames[2]))[0]
+    return np.frombuffer(getattr(frames[1], 'buffer', frames[1]), dtype=dtype), header
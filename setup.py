@@ -29,5 +29,13 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     platforms='any',
-    entry_points={'console_scripts': 'n2cooling = n2_cooling.cooling:main'},
+    entry_points={'console_scripts': [
+        'n2cooling = n2_cooling.cooling:main',
+        'n2cooling-benchmark = n2_cooling.simulator.benchmark:main',
+        'n2cooling-replay = n2_cooling.replay:main',
+        'n2cooling-manager = n2_cooling.manager:main',
+        'n2cooling-analyze = n2_cooling.analysis:main',
+        'n2cooling-command = n2_cooling.commands:main',
+        'n2cooling-tune = n2_cooling.tuning:main',
+    ]},
 )
@@ -0,0 +1,83 @@
+import os
+import json
+import atexit
+import numpy as np
+import pytest
+
+from n2_cooling import segments
+from n2_cooling.channels import ChannelRegistry
+from n2_cooling.segments import RotatingWriter, SegmentReader, catalog_file
+
+DTYPE = ChannelRegistry().dtype
+
+
+def records(n, start=1.6e9):
+    rows = np.zeros(n, dtype=DTYPE)
+    rows['timestamp'] = start + 0.5 * np.arange(n)
+    rows['temperature_dut'] = np.linspace(20., -20., n)
+    return rows
+
+
+class Clock(object):
+    ''' Wall clock of the segments module, one second per call '''
+
+    def __init__(self, module_time):
+        self.now = 0.
+        self.monotonic = module_time.monotonic
+
+    def time(self):
+        self.now += 1.
+        return self.now
+
+
+def write(run, rows, directory, **kwargs):
+    writer = RotatingWriter(run, DTYPE, directory=str(directory), batch_size=16, index_columns=('timestamp',), **kwargs)
+    for row in rows:
+        writer.append(row)
+    return writer
+
+
+def test_rotation_with_directory_in_run_name(tmp_path, monkeypatch):
+    monkeypatch.setattr(segments, 'time', Clock(segments.time))
+    data = records(100)
+    write(os.path.join('data', 'run2'), data, tmp_path, max_interval=25.).close()
+
+    catalog = tmp_path / 'data' / 'run2.catalog.json'
+    entries = json.loads(catalog.read_text())['segments']
+    assert [entry['file'] for entry in entries] == ['run2_%04d.h5' % i for i in range(4)]
+    assert all((tmp_path / 'data' / entry['file']).exists() for entry in entries)
+    assert sum(entry['rows'] for entry in entries) == len(data)
+    assert not any(entry['open'] for entry in entries)
+
+    reader = SegmentReader(str(catalog))
+    assert all(os.path.exists(filename) for filename in reader.files())
+    assert np.array_equal(reader.read(), data)
+    assert np.array_equal(reader.read(data['timestamp'][10], data['timestamp'][60]), data[10:60])
+    assert len(reader.files(data['timestamp'][10], data['timestamp'][40])) == 2
+
+
+def test_restart_continues_and_recovers_open_segment(tmp_path):
+    data = records(300)
+    write('run', data[:100], tmp_path).close()
+    crashed = write('run', data[100:200], tmp_path)
+    # rows on disk, but the process ends without closing the segment in the catalog
+    crashed.writer.close()
+    atexit.unregister(crashed.close)
+
+    write('run', data[200:], tmp_path).close()
+    with open(catalog_file('run', str(tmp_path))) as f:
+        entries = json.load(f)['segments']
+    assert [entry['file'] for entry in entries] == ['run_0000.h5', 'run_0001.h5', 'run_0002.h5']
+    assert [entry['rows'] for entry in entries] == [100, 100, 100]
+    assert not any(entry['open'] for entry in entries)
+    assert entries[1]['t_min'] == data['timestamp'][100] and entries[1]['t_max'] == data['timestamp'][199]
+
+    reader = SegmentReader(catalog_file('run', str(tmp_path)))
+    assert np.array_equal(reader.read(), data)
+    assert len(reader.files(data['timestamp'][250])) == 1
+
+
+def test_other_columns_are_refused(tmp_path):
+    write('run', records(10), tmp_path).close()
+    with pytest.raises(ValueError):
+        RotatingWriter('run', np.dtype([('timestamp', 'f8'), ('x', 'f4')]), directory=str(tmp_path))